@@ -0,0 +1,369 @@
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Characters of the reply sent in each event of a streamed response
+STREAM_CHUNK_CHARS = 16
+# Journey steps returned for every journey prompt
+CANNED_STEPS = [
+    "Discovering the Service", "Comparing Options", "Booking", "Payment", "Confirmation and Updates",
+    "Preparing to Use the Service", "Using the Service", "Getting Support", "Resolving Problems", "Refunds and Compensation"
+]
+
+
+# This class holds the server settings and request counters. Latency is drawn per request from the
+# configured distribution, and a fraction of requests are rejected with a 429.
+class MockSettings:
+    """Settings and counters for the mock OpenAI server"""
+
+    def __init__(self, latency_ms=200.0, latency_distribution="lognormal", latency_sigma=0.5,
+                 rate_limit_probability=0.0, seed=None, batch_seconds=2.0, mini_drop_probability=0.0):
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.latency_sigma = latency_sigma
+        self.rate_limit_probability = rate_limit_probability
+        # Fraction of review items left out of replies from -mini models, to exercise model escalation
+        self.mini_drop_probability = mini_drop_probability
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Batch API stand-in: uploaded files and batches, which complete batch_seconds after creation
+        self.batch_seconds = batch_seconds
+        self.files = {}
+        self.batches = {}
+        self.reset()
+
+    def reset(self):
+        """Zero the request counters"""
+        with self.lock:
+            self.stats = {"requests": 0, "rate_limited": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def latency(self):
+        """Return the latency in seconds for one request"""
+        with self.lock:
+            if self.latency_distribution == "fixed":
+                ms = self.latency_ms
+            elif self.latency_distribution == "uniform":
+                ms = self.random.uniform(0, 2 * self.latency_ms)
+            else:
+                ms = self.latency_ms * self.random.lognormvariate(0, self.latency_sigma)
+        return ms / 1000
+
+    def rate_limited(self):
+        """Return True if this request should be rejected with a 429"""
+        with self.lock:
+            return self.random.random() < self.rate_limit_probability
+
+
+def count_tokens(text):
+    """Estimate tokens the same way the pipeline does without tiktoken"""
+    return max(1, len(text) // 4)
+
+
+def analysis_reply(user_text):
+    """Return one summary per review line in an analysis prompt"""
+    summaries = []
+    for line in user_text.splitlines():
+        try:
+            review = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(review, dict) and "id" in review:
+            summaries.append({
+                "id": review["id"],
+                "sentimentSummary": f"The customer describes booking and using the service: {review.get('title', '')}"
+            })
+    return json.dumps({"reviews": summaries})
+
+
+def journey_reply():
+    """Return a canned set of journey steps"""
+    return json.dumps({"journey_steps": [
+        {"step_number": i + 1, "step_name": name, "description": f"The customer is {name.lower()}"}
+        for i, name in enumerate(CANNED_STEPS)
+    ]})
+
+
+def mapping_reply(user_text, rng):
+    """Return one step per review item id found in a mapping prompt"""
+    item_ids = re.findall(r'"id"\s*:\s*"([^"]+)"', user_text)
+    return json.dumps({"reviews_by_journey_step": [
+        {"id": item_id, "step_name": rng.choice(CANNED_STEPS)} for item_id in item_ids
+    ]})
+
+
+def canned_reply(messages, rng):
+    """Pick a canned reply that matches the stage the prompt comes from"""
+    system_text = messages[0].get("content", "") if messages else ""
+    user_text = "\n".join(str(m.get("content", "")) for m in messages[1:])
+    if "data processing assistant" in system_text:
+        return analysis_reply(user_text)
+    if "analyzing customer journey" in system_text:
+        return journey_reply()
+    if "mapping customer reviews" in system_text:
+        return mapping_reply(user_text, rng)
+    return "Condensed summary: " + user_text[:400]
+
+
+def drop_items(content, rng, probability):
+    """Leave a random fraction of the review items out of an analysis or mapping reply"""
+    data = json.loads(content)
+    for key in ("reviews", "reviews_by_journey_step"):
+        if isinstance(data, dict) and key in data:
+            data[key] = [item for item in data[key] if rng.random() >= probability]
+            return json.dumps(data)
+    return content
+
+
+def chat_completion(settings, body):
+    """Return a canned chat completion for a request body and count its tokens"""
+    messages = body.get("messages", [])
+    with settings.lock:
+        content = canned_reply(messages, settings.random)
+        if settings.mini_drop_probability and "mini" in str(body.get("model")) and content.startswith("{"):
+            content = drop_items(content, settings.random, settings.mini_drop_probability)
+    prompt_tokens = sum(count_tokens(str(m.get("content", ""))) for m in messages)
+    completion_tokens = count_tokens(content)
+    with settings.lock:
+        settings.stats["requests"] += 1
+        settings.stats["prompt_tokens"] += prompt_tokens
+        settings.stats["completion_tokens"] += completion_tokens
+        request_number = settings.stats["requests"]
+
+    return {
+        "id": f"chatcmpl-mock-{request_number}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+def file_object(file_id, filename, size, purpose):
+    """Return the API representation of an uploaded file"""
+    return {"id": file_id, "object": "file", "bytes": size, "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed"}
+
+
+# Batches are answered in full when they are created, and report in_progress until batch_seconds have
+# passed, so clients exercise their polling.
+def create_batch(settings, body):
+    """Run every request in an uploaded batch input file and return the batch object"""
+    with settings.lock:
+        lines = settings.files[body["input_file_id"]]["content"].decode('utf-8').splitlines()
+        batch_id = f"batch_mock_{len(settings.batches) + 1}"
+
+    output = []
+    for line in filter(str.strip, lines):
+        request = json.loads(line)
+        output.append({
+            "id": f"batch_req_{len(output) + 1}",
+            "custom_id": request["custom_id"],
+            "response": {"status_code": 200, "request_id": f"req_{len(output) + 1}",
+                         "body": chat_completion(settings, request["body"])},
+            "error": None
+        })
+
+    output_id = f"file-{batch_id}-output"
+    content = "".join(json.dumps(item) + "\n" for item in output).encode('utf-8')
+    with settings.lock:
+        settings.files[output_id] = {"content": content, **file_object(output_id, f"{batch_id}_output.jsonl", len(content), "batch_output")}
+        settings.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint"),
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "metadata": body.get("metadata"),
+            "created_at": int(time.time()),
+            "ready_at": time.time() + settings.batch_seconds,
+            "output_file_id": output_id,
+            "total": len(output)
+        }
+    return batch_view(settings.batches[batch_id])
+
+
+def batch_view(batch):
+    """Return the API representation of a batch at the current time"""
+    done = time.time() >= batch["ready_at"]
+    view = {key: value for key, value in batch.items() if key not in ("ready_at", "total", "output_file_id")}
+    view.update({
+        "status": "completed" if done else "in_progress",
+        "output_file_id": batch["output_file_id"] if done else None,
+        "error_file_id": None,
+        "completed_at": int(batch["ready_at"]) if done else None,
+        "request_counts": {"total": batch["total"], "completed": batch["total"] if done else 0, "failed": 0}
+    })
+    return view
+
+
+def make_handler(settings):
+    """Build a request handler class bound to the given settings"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def send_not_found(self):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            batch_match = re.search(r"/batches/([^/]+)$", path)
+            file_match = re.search(r"/files/([^/]+)/content$", path)
+            if path == "/stats":
+                with settings.lock:
+                    self.send_json(200, dict(settings.stats))
+            elif batch_match and batch_match.group(1) in settings.batches:
+                with settings.lock:
+                    self.send_json(200, batch_view(settings.batches[batch_match.group(1)]))
+            elif file_match and file_match.group(1) in settings.files:
+                content = settings.files[file_match.group(1)]["content"]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            else:
+                self.send_not_found()
+
+        def upload_file(self, payload):
+            """Store a multipart file upload and return the file object"""
+            message = BytesParser(policy=default_policy).parsebytes(
+                f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('utf-8') + payload
+            )
+            fields = {}
+            for part in message.iter_parts():
+                fields[part.get_param("name", header="content-disposition")] = part
+            upload = fields["file"]
+            content = upload.get_payload(decode=True)
+            purpose = fields["purpose"].get_content().strip() if "purpose" in fields else "batch"
+            with settings.lock:
+                file_id = f"file-mock-{len(settings.files) + 1}"
+                settings.files[file_id] = {"content": content, **file_object(file_id, upload.get_filename(), len(content), purpose)}
+                return {key: value for key, value in settings.files[file_id].items() if key != "content"}
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = self.rfile.read(length)
+            path = self.path.rstrip("/")
+
+            if path.endswith("/files"):
+                self.send_json(200, self.upload_file(payload))
+                return
+
+            body = json.loads(payload or b"{}")
+            if path.endswith("/batches"):
+                if body.get("input_file_id") not in settings.files:
+                    self.send_json(400, {"error": {"message": "Unknown input_file_id"}})
+                else:
+                    self.send_json(200, create_batch(settings, body))
+                return
+            if path == "/stats/reset":
+                settings.reset()
+                self.send_json(200, {})
+                return
+            if not path.endswith("/chat/completions"):
+                self.send_not_found()
+                return
+
+            time.sleep(settings.latency())
+            if settings.rate_limited():
+                with settings.lock:
+                    settings.stats["rate_limited"] += 1
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                               headers={"Retry-After": "1"})
+                return
+
+            completion = chat_completion(settings, body)
+            if body.get("stream"):
+                self.send_stream(completion, (body.get("stream_options") or {}).get("include_usage"))
+            else:
+                self.send_json(200, completion)
+
+        def send_stream(self, completion, include_usage):
+            """Send a completion as server-sent events, a few characters per chunk"""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+
+            content = completion["choices"][0]["message"]["content"]
+            base = {key: completion[key] for key in ("id", "created", "model")}
+            events = [{**base, "object": "chat.completion.chunk",
+                       "choices": [{"index": 0, "delta": {"content": content[i:i + STREAM_CHUNK_CHARS]}, "finish_reason": None}]}
+                      for i in range(0, len(content), STREAM_CHUNK_CHARS)]
+            events.append({**base, "object": "chat.completion.chunk",
+                           "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if include_usage:
+                events.append({**base, "object": "chat.completion.chunk", "choices": [], "usage": completion["usage"]})
+            for event in events:
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            self.wfile.write(b"data: [DONE]\n\n")
+
+    return Handler
+
+
+def serve(port, settings):
+    """Run the mock server until interrupted"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(settings))
+    server.daemon_threads = True
+    print(f"Mock OpenAI server listening on http://127.0.0.1:{server.server_address[1]}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in for benchmarking the pipeline")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="median request latency")
+    parser.add_argument("--latency-distribution", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="sigma of the lognormal distribution")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="fraction of requests rejected with 429")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--batch-seconds", type=float, default=2.0, help="time before a submitted batch completes")
+    parser.add_argument("--mini-drop-probability", type=float, default=0.0,
+                        help="fraction of review items left out of replies from -mini models")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    serve(args.port, MockSettings(
+        latency_ms=args.latency_ms,
+        latency_distribution=args.latency_distribution,
+        latency_sigma=args.latency_sigma,
+        rate_limit_probability=args.rate_limit_probability,
+        seed=args.seed,
+        batch_seconds=args.batch_seconds,
+        mini_drop_probability=args.mini_drop_probability
+    ))
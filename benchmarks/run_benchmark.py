@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCHMARK_DIR)
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_STAGES = ['analyze', 'compile', 'journey', 'map', 'plot']
+RESULTS_DIR = "benchmark-results"
+
+
+def free_port():
+    """Return a free local TCP port"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def request_json(url, data=None):
+    """Send a GET (or POST when data is given) and decode the JSON response"""
+    body = json.dumps(data).encode('utf-8') if data is not None else None
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read() or b"{}")
+
+
+def start_mock_server(args):
+    """Start the mock OpenAI server in a subprocess and wait until it answers"""
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARK_DIR, "mock_openai_server.py"),
+        "--port", str(port),
+        "--latency-ms", str(args.latency_ms),
+        "--latency-distribution", args.latency_distribution,
+        "--latency-sigma", str(args.latency_sigma),
+        "--rate-limit-probability", str(args.rate_limit_probability),
+        "--seed", str(args.seed)
+    ], stdout=subprocess.DEVNULL)
+
+    root_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            request_json(f"{root_url}/stats")
+            return process, root_url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock OpenAI server did not start")
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+# This function runs the pipeline stages for one dataset size inside a scratch directory. It must run in
+# its own process: the OpenAI clients read OPENAI_BASE_URL when the functions package is imported, and
+# peak RSS is only meaningful per process.
+async def benchmark_size(size, args):
+    """Run the pipeline against the mock server for one dataset size and return per-stage results"""
+    from synthetic_reviews import write_dataset
+
+    server, root_url = start_mock_server(args)
+    os.environ["OPENAI_BASE_URL"] = f"{root_url}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    sys.path.insert(0, PROJECT_ROOT)
+
+    try:
+        with tempfile.TemporaryDirectory(prefix=f"benchmark_{size}_") as work_dir:
+            os.chdir(work_dir)
+            input_file = write_dataset(os.path.join(work_dir, f"synthetic_{size}.json"), size, args.seed)
+
+            import main
+            from functions import configure_cache, configure_store, initialize_directories, PipelineState
+            configure_cache(enabled=args.use_cache, cache_dir=os.path.join(work_dir, "llm-cache"))
+            configure_store(store_file=os.path.join(work_dir, "review-store", "reviews.db"))
+            main.MAX_CONCURRENT_REQUESTS = args.max_concurrency
+            initialize_directories()
+
+            state = PipelineState(os.path.join(work_dir, "pipeline-state", "state.json"))
+            base_name = os.path.splitext(os.path.basename(input_file))[0]
+            stages = {name: run for name, run, _ in main.build_stages(input_file, base_name, state)}
+
+            results = []
+            for name in args.stages:
+                request_json(f"{root_url}/stats/reset", {})
+                started = time.perf_counter()
+                result = stages[name]()
+                if asyncio.iscoroutine(result):
+                    await result
+                wall_seconds = time.perf_counter() - started
+                stats = request_json(f"{root_url}/stats")
+
+                results.append({
+                    "size": size,
+                    "stage": name,
+                    "wall_seconds": round(wall_seconds, 3),
+                    "requests": stats["requests"],
+                    "requests_per_second": round(stats["requests"] / wall_seconds, 2) if wall_seconds else 0.0,
+                    "rate_limited": stats["rate_limited"],
+                    "prompt_tokens": stats["prompt_tokens"],
+                    "completion_tokens": stats["completion_tokens"],
+                    "peak_rss_mb": peak_rss_mb()
+                })
+            os.chdir(PROJECT_ROOT)
+            return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def print_table(results):
+    """Print benchmark results as a table"""
+    columns = ["size", "stage", "wall_seconds", "requests", "requests_per_second", "rate_limited",
+               "prompt_tokens", "completion_tokens", "peak_rss_mb"]
+    widths = [max(len(column), *(len(str(row[column])) for row in results)) for column in columns]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in results:
+        print("  ".join(str(row[column]).rjust(width) for column, width in zip(columns, widths)))
+
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against a local mock OpenAI server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="dataset sizes to run")
+    parser.add_argument("--stages", nargs="+", default=DEFAULT_STAGES,
+                        choices=['analyze', 'compile', 'journey', 'map', 'plot'])
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="median mock request latency")
+    parser.add_argument("--latency-distribution", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--use-cache", action="store_true", help="let stages use the LLM response cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file for the results (default benchmark-results/benchmark_<time>.json)")
+    parser.add_argument("--single-size", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Child process: benchmark one size and print the results as JSON on the last line
+    if args.single_size:
+        results = asyncio.run(benchmark_size(args.single_size, args))
+        print(json.dumps(results))
+        return
+
+    results = []
+    for size in args.sizes:
+        print(f"Benchmarking {size:,} reviews...")
+        child_args = [a for a in (argv if argv is not None else sys.argv[1:])]
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *child_args, "--single-size", str(size)],
+            capture_output=True, text=True, cwd=BENCHMARK_DIR
+        )
+        if completed.returncode != 0:
+            print(completed.stdout[-2000:])
+            print(completed.stderr[-2000:])
+            raise RuntimeError(f"Benchmark for {size:,} reviews failed")
+        results.extend(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    print()
+    print_table(results)
+
+    output_file = args.output or os.path.join(RESULTS_DIR, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, 'w') as f:
+        json.dump({
+            "settings": {key: value for key, value in vars(args).items() if key != "single_size"},
+            "results": results
+        }, f, indent=2)
+    print(f"\nBenchmark results saved to: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+
+COMPANY_NAME = "Example Airways"
+BUSINESS_UNIT_ID = "46d2e587000064000500a0e0"
+COMPANY_PAGE_URL = "https://www.trustpilot.com/review/www.example.com?languages=English&sort=recency"
+
+TITLES = {
+    1: ["Absolutely horrible", "Never again", "Worst experience", "Lost my luggage", "No refund"],
+    2: ["Disappointing", "Poor service", "Delayed again", "Not worth the price"],
+    3: ["Average", "Okay but could be better", "Mixed experience"],
+    4: ["Good flight", "Pleasant crew", "Smooth booking", "Mostly good"],
+    5: ["Excellent service", "Fantastic crew", "Best airline", "Great experience", "Highly recommend"]
+}
+SENTENCES = [
+    "Booking on the website was quick and easy.",
+    "The app kept crashing when I tried to choose seats.",
+    "Check-in took over an hour because only two desks were open.",
+    "Our flight was delayed by four hours with no explanation.",
+    "The cabin crew were friendly and attentive throughout.",
+    "The food was cold and there was no vegetarian option.",
+    "My bag did not arrive and customer service never replied.",
+    "I was promised a refund that never came.",
+    "The lounge was clean and the staff were helpful.",
+    "Boarding was chaotic and the gate changed twice.",
+    "Seats were comfortable and there was plenty of legroom.",
+    "I spent hours on hold trying to change my booking.",
+    "Compensation was paid within two weeks, which I appreciated.",
+    "The price was good value compared to other airlines."
+]
+# Fraction of reviews that repeat an earlier review, as templated or re-scraped reviews do
+DUPLICATE_FRACTION = 0.05
+
+
+def make_review(rng, index, date):
+    """Build one synthetic review in the scraper's schema"""
+    rating = rng.choices([1, 2, 3, 4, 5], weights=[35, 10, 8, 12, 35])[0]
+    review_id = f"{rng.getrandbits(96):024x}"
+    # Lengths vary from one-liners to long essays
+    description = " ".join(rng.choice(SENTENCES) for _ in range(max(1, int(rng.expovariate(1 / 5)))))
+    return {
+        "companyPageUrl": COMPANY_PAGE_URL,
+        "reviewId": review_id,
+        "companyName": COMPANY_NAME,
+        "businessUnitId": BUSINESS_UNIT_ID,
+        "reviewUrl": f"https://trustpilot.com/reviews/{review_id}",
+        "reviewDate": date.strftime("%A, %B %d, %Y at %I:%M:%S %p"),
+        "reviewDateOfExperience": (date - timedelta(days=rng.randint(0, 60))).strftime("%B %d, %Y"),
+        "reviewLabel": "",
+        "isReviewVerified": rng.random() < 0.3,
+        "reviewer": f"Reviewer {index}",
+        "reviewTitle": rng.choice(TITLES[rating]),
+        "reviewDescription": description,
+        "reviewRatingScore": rating,
+        "reviewersCountry": rng.choice(["GB", "US", "IE", "DE", "FR"]),
+        "reviewLanguage": "all",
+        "reviewCompanyResponse": "",
+        "scrapedDateTime": "2025-01-17T17:48:48.653Z",
+        "scrapedAtReviewPageNumber": index // 20 + 1
+    }
+
+
+# Reviews are written one at a time so 100k-review datasets do not need to be held in memory.
+def write_dataset(path, size, seed=0):
+    """Write a synthetic raw export with size reviews to path"""
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 17, 16, 43, 12)
+    recent = []
+
+    with open(path, 'w') as f:
+        f.write("[\n")
+        for index in range(size):
+            if recent and rng.random() < DUPLICATE_FRACTION:
+                review = dict(rng.choice(recent), reviewId=f"{rng.getrandbits(96):024x}")
+            else:
+                review = make_review(rng, index, start - timedelta(minutes=index * 7))
+                recent = (recent + [review])[-200:]
+            f.write(("," if index else "") + json.dumps(review, indent=2) + "\n")
+        f.write("]\n")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Trustpilot export")
+    parser.add_argument("path")
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_dataset(args.path, args.size, args.seed)
+    print(f"Wrote {args.size:,} reviews to {args.path}")
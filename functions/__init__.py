@@ -1,19 +1,113 @@
-from .get_input_file import get_input_file
+from .get_input_file import get_input_file, get_input_files
 from .process_chunks import process_chunks
 from .clean_markdown import clean_markdown
+from .convert_date_format import convert_date_format
 from .initialize_directories import initialize_directories
 from .generate_journey_steps import generate_journey_steps
 from .map_reviews_to_journey import map_reviews_to_journey
-from .plot_average_ratings import plot_average_ratings
+from .plot_average_ratings import plot_average_ratings, plot_rating_trends, save_figure
+from .render_dashboards import render_dashboards
+from .rate_limiter import AdaptiveRateLimiter
+from .llm_cache import LLMCache, cached_completion, configure_cache, get_cache
+from .review_manifest import load_manifest, save_manifest, mark_processed, load_latest_analyses, select_reviews_to_process, select_changed_keys, review_key
+from .stream_reviews import iter_reviews
+from .token_budget import estimate_tokens, pack_reviews, iter_token_batches
+from .process_chunks import format_review
+from .analysis_records import extract_analysis_records, analysis_rows
+from .journey_classifier import classify_records
+from .deduplicate import find_duplicate_groups, iter_representatives
+from .stage_runner import PipelineState, run_stages, fingerprint, file_fingerprint
+from .telemetry import Telemetry, get_telemetry, configure_telemetry, set_company
+from .openai_client import OpenAITransport, get_transport, configure_transport
+from .record_store import write_records, analysis_texts, SUMMARY_COLUMNS, MAPPED_COLUMNS
+from .company_batches import company_namespace, plan_company_runs, run_companies
+from .batch_api import run_batch
+from .streaming import JsonArrayParser, streamed
+from .review_sampling import stratified_sample, review_stratum, interval_width, unconverged_steps
+from .pipelined_mapping import PipelinedMapper, split_sample_batches
+from .map_reviews_to_journey import map_rows, save_mapped_reviews
+from .review_store import ReviewStore, get_store, configure_store
+from .corpus_sketch import corpus_sketch, sketch_drift
+from .model_cascade import ModelCascade, get_cascade, configure_cascade, run_cascade
+from .prompt_builder import build_prompt, compact_json, compact_journey_steps, PromptTooLargeError
 
 __version__ = '1.0.0'
 
 __all__ = [
     'get_input_file',
+    'get_input_files',
     'clean_markdown',
+    'convert_date_format',
     'process_chunks',
     'initialize_directories',
     'generate_journey_steps',
     'map_reviews_to_journey',
-    'plot_average_ratings'
+    'plot_average_ratings',
+    'plot_rating_trends',
+    'save_figure',
+    'render_dashboards',
+    'AdaptiveRateLimiter',
+    'LLMCache',
+    'cached_completion',
+    'configure_cache',
+    'get_cache',
+    'load_manifest',
+    'save_manifest',
+    'mark_processed',
+    'load_latest_analyses',
+    'select_reviews_to_process',
+    'select_changed_keys',
+    'review_key',
+    'iter_reviews',
+    'estimate_tokens',
+    'pack_reviews',
+    'iter_token_batches',
+    'format_review',
+    'extract_analysis_records',
+    'analysis_rows',
+    'classify_records',
+    'find_duplicate_groups',
+    'iter_representatives',
+    'PipelineState',
+    'run_stages',
+    'fingerprint',
+    'file_fingerprint',
+    'Telemetry',
+    'get_telemetry',
+    'configure_telemetry',
+    'set_company',
+    'OpenAITransport',
+    'get_transport',
+    'configure_transport',
+    'company_namespace',
+    'plan_company_runs',
+    'run_companies',
+    'write_records',
+    'analysis_texts',
+    'SUMMARY_COLUMNS',
+    'MAPPED_COLUMNS',
+    'build_prompt',
+    'compact_json',
+    'compact_journey_steps',
+    'PromptTooLargeError',
+    'run_batch',
+    'JsonArrayParser',
+    'streamed',
+    'stratified_sample',
+    'review_stratum',
+    'interval_width',
+    'unconverged_steps',
+    'PipelinedMapper',
+    'split_sample_batches',
+    'map_rows',
+    'save_mapped_reviews',
+    'ReviewStore',
+    'get_store',
+    'configure_store',
+    'corpus_sketch',
+    'sketch_drift',
+    'ModelCascade',
+    'get_cascade',
+    'configure_cascade',
+    'run_cascade'
 ]
\ No newline at end of file
@@ -0,0 +1,61 @@
+import json
+
+# Keys that mark a decoded JSON object as a per-review analysis record
+RECORD_KEYS = {'date', 'rating', 'sentimentSummary'}
+
+
+# Parser for legacy chunk analyses and text replies only: analyzed chunks written before the analysis stage
+# validated replies hold the model's reply as text, which usually has one JSON object per review (sometimes
+# wrapped in an array). This scans the text and decodes every such object it can find.
+def extract_analysis_records(text):
+    """Extract per-review analysis records from the text of a chunk analysis"""
+    decoder = json.JSONDecoder()
+    records = []
+    pos = 0
+
+    while pos < len(text):
+        if text[pos] not in '{[':
+            pos += 1
+            continue
+        try:
+            value, end = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            pos += 1
+            continue
+
+        for item in value if isinstance(value, list) else [value]:
+            if isinstance(item, dict) and RECORD_KEYS & item.keys():
+                records.append(item)
+        pos = end
+
+    return records
+
+
+# Each analysis record becomes one summary row. A record whose reviewId belongs to the chunk covers that
+# review and its duplicates; otherwise it covers the whole chunk. Analyzed files written before records
+# were validated hold the reply as text instead; a reply with no readable records is kept as a text row.
+def analysis_rows(chunk, analysis):
+    """Turn one analyzed chunk file into summary store rows"""
+    review_ids = analysis.get("reviewIds", [])
+    duplicate_counts = analysis.get("duplicateCounts", {})
+    duplicate_reviews = analysis.get("duplicateReviews", {})
+
+    if "records" in analysis:
+        records = analysis["records"]
+    else:
+        records = extract_analysis_records(analysis["response"])
+    if not records:
+        return [{"chunk": chunk, "analysis": analysis["response"], "reviewIds": review_ids}]
+
+    rows = []
+    for record in records:
+        review_id = record.get("reviewId")
+        known = review_id in review_ids
+        rows.append({
+            **record,
+            "chunk": chunk,
+            "reviewId": review_id if known else None,
+            "count": duplicate_counts.get(review_id, 1) if known else 1,
+            "reviewIds": [review_id] + duplicate_reviews.get(review_id, []) if known else review_ids
+        })
+    return rows
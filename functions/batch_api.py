@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import asyncio
+from datetime import datetime
+from functions.llm_cache import get_cache
+from functions.openai_client import get_transport
+from functions.telemetry import get_telemetry
+
+# Submitted jobs are recorded here (under each output root) so a restarted run polls them instead of resubmitting
+BATCH_DIR = "batch-jobs"
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# The Batch API accepts at most this many requests per input file
+MAX_BATCH_REQUESTS = 50_000
+# Seconds between status checks of a submitted batch
+BATCH_POLL_SECONDS = 60
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def load_job(job_file):
+    """Return the recorded batch job, or None if there is none"""
+    if not os.path.exists(job_file):
+        return None
+    with open(job_file, 'r') as f:
+        return json.load(f)
+
+
+def save_job(job_file, job):
+    """Record a submitted batch job"""
+    os.makedirs(os.path.dirname(job_file), exist_ok=True)
+    tmp_file = f"{job_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_file, job_file)
+
+
+async def submit_batch(client, name, stage, requests):
+    """Upload {custom_id: params} as a batch input file and create the batch, returning its ID"""
+    lines = "".join(
+        json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": params},
+                   ensure_ascii=False) + "\n"
+        for custom_id, params in requests.items()
+    )
+    input_file = await client.files.create(file=(f"{name}.jsonl", lines.encode('utf-8')), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata={"stage": stage, "name": name}
+    )
+    print(f"Submitted {len(requests):,} {stage} requests as batch {batch.id}")
+    return batch.id
+
+
+async def wait_for_batch(client, batch_id, poll_seconds):
+    """Poll a batch until it reaches a terminal status and return it"""
+    progress = None
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        current = (batch.status, counts.completed if counts else 0)
+        if current != progress:
+            total = counts.total if counts else 0
+            print(f"Batch {batch_id}: {batch.status}, {current[1]:,} of {total:,} requests done")
+            progress = current
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        await asyncio.sleep(poll_seconds)
+
+
+async def read_batch_output(client, batch):
+    """Return {custom_id: response body} for the successful requests in a finished batch"""
+    if not batch.output_file_id:
+        return {}
+    output = await client.files.content(batch.output_file_id)
+    results = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") == 200 and response.get("body"):
+            results[item["custom_id"]] = response["body"]
+    return results
+
+
+# This function ingests a finished batch: each reply that passes its request's validate function is
+# stored in the LLM cache under the request's key, exactly as a synchronous call would have stored it.
+def ingest_results(batch, results, requests, stage, label):
+    """Cache the valid replies of a finished batch, returning how many were stored"""
+    cache = get_cache()
+    latency = (batch.completed_at or time.time()) - batch.created_at
+    stored = 0
+    for custom_id, (params, validate) in requests.items():
+        body = results.get(custom_id)
+        usage = (body or {}).get("usage") or {}
+        get_telemetry().record(
+            f"{stage}-batch", f"{label} {custom_id[:12]}", params.get("model"), "ok" if body else "error", latency,
+            prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0), batch=True
+        )
+        choices = (body or {}).get("choices") or []
+        content = choices[0].get("message", {}).get("content") if choices else None
+        if not content:
+            continue
+        try:
+            if validate:
+                validate(content)
+        except (ValueError, json.JSONDecodeError):
+            continue
+        cache.set(custom_id, content, params)
+        stored += 1
+    return stored
+
+
+async def run_batch_part(client, requests, stage, job_file, poll_seconds):
+    """Submit (or resume) one batch job, wait for it and ingest its results"""
+    name = os.path.splitext(os.path.basename(job_file))[0]
+    job = load_job(job_file)
+    if job and set(requests) <= set(job["custom_ids"]):
+        batch_id = job["batch_id"]
+        print(f"Resuming batch {batch_id} submitted at {job['submitted']}")
+    else:
+        batch_id = await submit_batch(client, name, stage, {key: params for key, (params, _) in requests.items()})
+        save_job(job_file, {
+            "batch_id": batch_id,
+            "stage": stage,
+            "submitted": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "custom_ids": list(requests)
+        })
+
+    batch = await wait_for_batch(client, batch_id, poll_seconds)
+    results = await read_batch_output(client, batch)
+    stored = ingest_results(batch, results, requests, stage, name)
+    os.remove(job_file)
+
+    if batch.status != "completed":
+        print(f"Batch {batch_id} ended as {batch.status}")
+    return stored
+
+
+# Batch mode for non-interactive runs: the stage's requests are sent through the Batch API, which is
+# cheaper and has its own rate budget, and the valid replies are stored in the LLM cache. The stage then
+# runs as usual and is served from the cache; requests the batch did not answer validly are sent
+# synchronously. requests is a list of (params, validate) pairs, where params are the arguments the
+# stage passes to cached_completion. Requests already in the cache are not submitted again.
+async def run_batch(requests, stage, job_dir, transport=None, poll_seconds=None):
+    """Answer chat completion requests with the Batch API and store the replies in the LLM cache"""
+    cache = get_cache()
+    if not cache.enabled:
+        raise ValueError("Batch API mode stores replies in the LLM cache, so the cache must be enabled")
+
+    pending = {}
+    for params, validate in requests:
+        key = cache.make_key(params)
+        if key not in pending and not cache.contains(key):
+            pending[key] = (params, validate)
+    if not pending:
+        print(f"All {len(requests):,} {stage} requests are already cached")
+        return 0
+
+    # The custom_id of each request is its cache key, so replies are stored without matching prompts
+    keys = list(pending)
+    parts = [keys[i:i + MAX_BATCH_REQUESTS] for i in range(0, len(keys), MAX_BATCH_REQUESTS)]
+    client = (transport or get_transport()).client
+    stored = await asyncio.gather(*(
+        run_batch_part(client, {key: pending[key] for key in part}, stage,
+                       os.path.join(job_dir, f"{stage}_{i + 1}.json"), poll_seconds or BATCH_POLL_SECONDS)
+        for i, part in enumerate(parts)
+    ))
+
+    print(f"Batch API answered {sum(stored):,} of {len(pending):,} {stage} requests; the rest are sent directly")
+    return sum(stored)
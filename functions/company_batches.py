@@ -0,0 +1,53 @@
+import os
+import re
+import asyncio
+from functions.stream_reviews import iter_reviews
+
+# Batch mode writes each company's outputs under COMPANIES_DIR/<namespace>
+COMPANIES_DIR = "companies"
+
+
+def company_namespace(input_file, base_name):
+    """Return an output directory name for the company in an export, from its first review"""
+    company_name, business_unit_id = None, None
+    for review in iter_reviews(input_file):
+        company_name = review.get('companyName')
+        business_unit_id = review.get('businessUnitId')
+        break
+
+    slug = re.sub(r"[^a-z0-9]+", "-", (company_name or base_name).lower()).strip("-") or base_name
+    return f"{slug}_{business_unit_id}" if business_unit_id else slug
+
+
+def plan_company_runs(input_files, companies_dir=COMPANIES_DIR):
+    """Return (input_file, base_name, output_root) for each export, with one output root per export"""
+    runs = []
+    used = set()
+    for input_file, base_name in input_files:
+        namespace = company_namespace(input_file, base_name)
+        # Two exports of the same company must not write into the same directory at the same time
+        if namespace in used:
+            namespace = f"{namespace}_{base_name}"
+        used.add(namespace)
+        runs.append((input_file, base_name, os.path.join(companies_dir, namespace)))
+    return runs
+
+
+# Companies are processed by max_parallel workers; each run_company call is one company's whole
+# pipeline. A failure is recorded and the remaining companies carry on.
+async def run_companies(runs, run_company, max_parallel=4):
+    """Run run_company(input_file, base_name, output_root) for every company, returning {output_root: error}"""
+    pending = iter(runs)
+    errors = {}
+
+    async def worker():
+        for input_file, base_name, output_root in pending:
+            try:
+                await run_company(input_file, base_name, output_root)
+                errors[output_root] = None
+            except Exception as e:
+                print(f"Error processing {output_root}: {str(e)}")
+                errors[output_root] = str(e)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, max_parallel))))
+    return errors
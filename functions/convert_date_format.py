@@ -0,0 +1,19 @@
+from datetime import datetime
+
+def convert_date_format(date_str):
+    """Convert various date formats to YYYY-MM-DD"""
+    try:
+        # Try parsing common date formats
+        for fmt in [
+            "%B %d, %Y",      # January 17, 2025
+            "%d %B %Y",       # 17 January 2025
+            "%Y-%m-%d",       # 2025-01-17
+            "%d/%m/%Y"        # 17/01/2025
+        ]:
+            try:
+                return datetime.strptime(date_str, fmt).strftime("%Y-%m-%d")
+            except ValueError:
+                continue
+        raise ValueError(f"Unsupported date format: {date_str}")
+    except Exception as e:
+        raise ValueError(f"Date conversion error: {date_str} - {str(e)}")
@@ -0,0 +1,30 @@
+import math
+from collections import Counter
+from functions.journey_classifier import tokenize, record_text
+
+# Number of most frequent terms kept in a corpus sketch
+SKETCH_TERMS = 500
+
+
+def corpus_sketch(rows, size=SKETCH_TERMS):
+    """Return the relative frequencies of the most frequent terms in summary rows"""
+    counts = Counter()
+    for row in rows:
+        # Each row stands for its duplicates as well
+        weight = row.get("count") or 1
+        for term, count in Counter(tokenize(row.get("analysis") or record_text(row))).items():
+            counts[term] += count * weight
+
+    top = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:size]
+    total = sum(count for _, count in top)
+    return {term: count / total for term, count in top} if total else {}
+
+
+def sketch_drift(sketch, previous):
+    """Return 1 minus the cosine similarity of two corpus sketches (0 is the same mix of terms, 1 nothing shared)"""
+    norm = math.sqrt(sum(value * value for value in sketch.values()))
+    previous_norm = math.sqrt(sum(value * value for value in previous.values()))
+    if not norm or not previous_norm:
+        return 1.0
+    dot = sum(value * previous.get(term, 0.0) for term, value in sketch.items())
+    return max(0.0, 1.0 - dot / (norm * previous_norm))
@@ -0,0 +1,109 @@
+import re
+import zlib
+import hashlib
+import numpy as np
+from functions.review_manifest import review_key, review_fingerprint
+
+# Estimated Jaccard similarity of word shingles above which two reviews count as near duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# MinHash signature length, split into LSH bands of NUM_PERMUTATIONS // NUM_BANDS rows
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+SHINGLE_SIZE = 3
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_random = np.random.RandomState(1)
+_PERM_A = _random.randint(1, _MERSENNE_PRIME, size=NUM_PERMUTATIONS).astype(np.uint64)
+_PERM_B = _random.randint(0, _MERSENNE_PRIME, size=NUM_PERMUTATIONS).astype(np.uint64)
+
+
+def normalise_text(review):
+    """Return the lower-cased words of a review's title and description"""
+    text = f"{review.get('reviewTitle', '')} {review.get('reviewDescription', '')}".lower()
+    return re.findall(r"[a-z0-9]+", text)
+
+
+def minhash_signature(words):
+    """Return the MinHash signature of a review's word shingles"""
+    size = min(SHINGLE_SIZE, len(words))
+    shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+    return ((np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME).min(axis=0).astype(np.uint32)
+
+
+class _UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        self.parent.setdefault(item, item)
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            # The earlier review stays the representative
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+# This function groups reviews that are exact duplicates after normalisation, or near duplicates by
+# MinHash/LSH, among reviews with the same rating. Only keys, fingerprints and signatures are kept,
+# so the reviews can be streamed from the raw export.
+def find_duplicate_groups(reviews, threshold=NEAR_DUPLICATE_THRESHOLD):
+    """Return {representative_key: {member_key: fingerprint}} for every review"""
+    rows = NUM_PERMUTATIONS // NUM_BANDS
+    union_find = _UnionFind()
+    keys = []
+    fingerprints = []
+    signatures = {}
+    exact = {}
+    buckets = {}
+
+    for index, review in enumerate(reviews):
+        keys.append(review_key(review))
+        fingerprints.append(review_fingerprint(review))
+        union_find.find(index)
+        rating = review.get('reviewRatingScore')
+        words = normalise_text(review)
+
+        # Exact duplicates of the normalised text
+        text_hash = hashlib.sha1(f"{rating}|{' '.join(words)}".encode('utf-8')).hexdigest()
+        if text_hash in exact:
+            union_find.union(exact[text_hash], index)
+            continue
+        exact[text_hash] = index
+        if not words:
+            continue
+
+        # Near duplicates: compare against reviews that share an LSH band
+        signature = minhash_signature(words)
+        signatures[index] = signature
+        for band in range(NUM_BANDS):
+            bucket = (band, rating, signature[band * rows:(band + 1) * rows].tobytes())
+            for other in buckets.setdefault(bucket, []):
+                if union_find.find(other) != union_find.find(index) and \
+                        np.mean(signatures[other] == signature) >= threshold:
+                    union_find.union(other, index)
+            buckets[bucket].append(index)
+
+    groups = {}
+    for index, key in enumerate(keys):
+        groups.setdefault(keys[union_find.find(index)], {})[key] = fingerprints[index]
+    return groups
+
+
+def iter_representatives(reviews, groups):
+    """Yield one review per duplicate group, annotated with the group's size and members"""
+    yielded = set()
+    for review in reviews:
+        key = review_key(review)
+        members = groups.get(key)
+        if members is None or key in yielded:
+            continue
+        yielded.add(key)
+        if len(members) > 1:
+            review = {**review, 'duplicateCount': len(members), 'duplicateReviews': members}
+        yield review
@@ -2,100 +2,215 @@ import os
 import json
 from datetime import datetime
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+import asyncio
+from functions.llm_cache import cached_completion
+from functions.rate_limiter import AdaptiveRateLimiter, limited
+from functions.token_budget import estimate_tokens, group_by_tokens
+from functions.openai_client import get_transport
+from functions.record_store import analysis_texts
+from functions.review_store import get_store, DEFAULT_COMPANY
+from functions.corpus_sketch import corpus_sketch, sketch_drift
+from functions.stage_runner import fingerprint
+from functions.model_cascade import get_cascade, run_cascade
+from functions.prompt_builder import build_prompt
 
 # Load environment variables
 load_dotenv()
 
-# Initialize AsyncOpenAI client
-client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Maximum tokens of review analyses sent with the journey prompt (gpt-4 has an 8k context)
+JOURNEY_TOKEN_BUDGET = 6000
+# Maximum tokens of analyses condensed together in one request
+CONDENSE_GROUP_TOKEN_BUDGET = 3000
+# Summary store columns read for the journey prompt
+JOURNEY_COLUMNS = ["chunk", "title", "rating", "sentimentSummary", "count", "analysis"]
+# Fields of each analysis sent with the journey prompt; review IDs and dates do not shape the journey
+JOURNEY_FIELDS = ["title", "rating", "sentimentSummary"]
+# Number of steps the journey prompt asks for; a reply with a different number is escalated to a stronger model
+JOURNEY_STEP_COUNT = 10
 
-async def generate_journey_steps():
-    """Generate customer journey steps from summarized reviews"""
-    try:
-        # Find latest sentiment analysis file
-        summary_dir = "summarized-reviews"
-        if not os.path.exists(summary_dir):
-            raise FileNotFoundError(f"Directory not found: {summary_dir}")
-        
-        files = sorted([f for f in os.listdir(summary_dir) 
-                       if f.startswith('summarized_reviews_')])
-        
-        if not files:
-            raise FileNotFoundError("No sentiment analysis files found")
-        
-        summarized_reviews_file = os.path.join(summary_dir, files[-1])
-        print(f"Found latest analysis file: {summarized_reviews_file}")
+CONDENSE_PROMPT = """Condense the following customer review analyses into one shorter summary. Keep what the analyses say about the type of service the company offers, every stage of the customer experience that is mentioned, and recurring praise and complaints with specific details. Return plain text only."""
+
+JOURNEY_PROMPT = """Review the provided data to determine the type of service the company offers. Identify 10 steps in a typical customer journey, starting when a potential customer becomes aware of the product or service through decision-making, purchase, using the product or service, and following up.
+
+Output:
+• Provide a descriptive list of named customer journey stages that are specific to this service or product.
+• Ensure several of the steps describe the customer's use of the product or service.
+• DO NOT includ "feedback" as a step.
+• Title each step to reflect its relevance to the service offered.
+• Capture every significant stage in the journey comprehensively.
+• Ensure you have identified 10 distinct steps.
+
+Please return the response in this JSON format:
+{"journey_steps": [{"step_number": 1, "step_name": "step name", "description": "description of this step"}]}"""
+
+
+async def condense_group(texts, limiter, label, transport=None):
+    """Ask OpenAI to condense a group of analyses into one summary"""
+    messages, tokens = build_prompt("condense", label, CONDENSE_PROMPT, "\n\n".join(texts))
+    content = await cached_completion(
+        limited((transport or get_transport()).completion("condense", label), limiter, tokens, label),
+        model=get_cascade().model("condense", 1),
+        messages=messages
+    )
+    if not content:
+        raise ValueError(f"Empty response from OpenAI for {label}")
+    return content.strip()
+
+
+# This function tree-reduces the per-chunk analyses: each level condenses groups of analyses in parallel,
+# and levels repeat until the remaining text fits the journey prompt budget.
+async def condense_analyses(texts, token_budget=JOURNEY_TOKEN_BUDGET, group_token_budget=CONDENSE_GROUP_TOKEN_BUDGET,
+                            max_concurrency=8, transport=None, limiter=None):
+    """Condense analysis texts in parallel levels until they fit token_budget"""
+    limiter = limiter or AdaptiveRateLimiter(max_concurrency=max_concurrency)
+    level = 0
+    
+    while sum(estimate_tokens(text) for text in texts) > token_budget:
+        level += 1
+        groups = group_by_tokens(texts, group_token_budget)
+        print(f"Condensing {len(texts):,} analyses into {len(groups):,} summaries (level {level})...")
         
-        # Read and clean sentiment analysis data
-        with open(summarized_reviews_file, 'r') as f:
-            content = f.read()
-            # Remove both actual newlines and escaped newlines
-            cleaned_content = content.replace('\n', '').replace('\\n', '')
-            analysis_data = json.loads(cleaned_content)
+        condensed = await asyncio.gather(*(
+            condense_group(group, limiter, f"condense level {level} group {i + 1}", transport)
+            for i, group in enumerate(groups)
+        ))
         
-        if not analysis_data:
+        # Stop if a level fails to shrink the text, rather than looping forever
+        if len(condensed) >= len(texts) and sum(map(estimate_tokens, condensed)) >= sum(map(estimate_tokens, texts)):
+            raise ValueError("Condensing analyses did not reduce their size")
+        texts = list(condensed)
+    
+    return texts
+
+
+def parse_journey_response(content):
+    """Parse and validate the journey steps returned by OpenAI"""
+    content = content.strip().replace('```json', '').replace('```', '').strip()
+    
+    try:
+        journey_data = json.loads(content)
+    except json.JSONDecodeError as e:
+        print(f"JSON Parse Error: {str(e)}\nContent: {content}")
+        raise
+    
+    if "journey_steps" not in journey_data:
+        raise ValueError("Response missing journey_steps key")
+    
+    steps = journey_data["journey_steps"]
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("Response has no journey steps")
+    names = [step.get("step_name") if isinstance(step, dict) else None for step in steps]
+    if not all(isinstance(name, str) and name.strip() for name in names) or len(set(names)) != len(names):
+        raise ValueError("Journey steps must have distinct, non-empty step names")
+    return journey_data
+
+
+def journey_prompt_fingerprint():
+    """Fingerprint the models and prompt that journey steps are generated with"""
+    return fingerprint(get_cascade().models("journey"), JOURNEY_PROMPT)
+
+
+def save_journey_file(journey_data, output_root="."):
+    """Write journey steps to a new file in journey-steps and return its path"""
+    journey_dir = os.path.join(output_root, "journey-steps")
+    if not os.path.exists(journey_dir):
+        os.makedirs(journey_dir)
+    
+    output_file = os.path.join(
+        journey_dir, 
+        f"customer_journey_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    
+    with open(output_file, 'w') as f:
+        json.dump({
+            "journey_steps": journey_data["journey_steps"]
+        }, f, indent=2)
+    return output_file
+
+
+# The company's latest journey is reused when it came from the same prompt and the term-frequency sketch of
+# the corpus has drifted at most drift_threshold (see sketch_drift) from the sketch of the corpus it came
+# from, so routine refreshes skip the journey prompt. Drift is measured against that original corpus, so
+# gradual changes add up until the steps are regenerated. A drift_threshold of None always regenerates.
+def reusable_journey(company, sketch, drift_threshold):
+    """Return the company's latest journey data if it can be reused for a corpus sketch, or None"""
+    if drift_threshold is None:
+        return None
+    store = get_store()
+    basis = store.journey_basis(company)
+    if not basis or basis["prompt"] != journey_prompt_fingerprint():
+        return None
+    
+    drift = sketch_drift(sketch, basis["sketch"])
+    if drift > drift_threshold:
+        print(f"Corpus drift {drift:.3f} exceeds {drift_threshold}; generating new journey steps")
+        return None
+    print(f"Corpus drift {drift:.3f} is within {drift_threshold}; reusing the previous journey steps")
+    return {"journey_steps": store.journey_steps(company)}
+
+# Summaries larger than token_budget are condensed with condense_analyses before the journey prompt.
+# In batch mode a shared limiter is passed in so every request counts against one rate budget.
+# Summary rows can be passed in (e.g. a sample in pipelined mode) instead of reading the company's latest
+# analyses from the review store. The steps are stored as the company's latest journey, unless the previous
+# journey is reused (see reusable_journey).
+async def generate_journey_steps(token_budget=JOURNEY_TOKEN_BUDGET, max_concurrency=8, transport=None, limiter=None,
+                                 output_root=".", rows=None, company=DEFAULT_COMPANY, drift_threshold=None):
+    """Generate customer journey steps from summarized reviews"""
+    try:
+        if rows is None:
+            # Only the analysis text is needed for the journey prompt, so review IDs are not read
+            rows = get_store().analyses(company, JOURNEY_COLUMNS)
+            print(f"Loaded {len(rows):,} analyses of {company} from the review store")
+        if not rows:
             raise ValueError("Empty or invalid analysis data")
         
-        # Set up journey analysis prompt
-        journey_prompt = """Review the provided data to determine the type of service the company offers. Identify 10 steps in a typical customer journey, starting when a potential customer becomes aware of the product or service through decision-making, purchase, using the product or service, and following up.
-
-        Output:
-        • Provide a descriptive list of named customer journey stages that are specific to this service or product. 
-        • Ensure several of the steps describe the customer's use of the product or service.
-        • DO NOT includ "feedback" as a step.
-        • Title each step to reflect its relevance to the service offered.
-        • Capture every significant stage in the journey comprehensively.
-        • Ensure you have identified 10 distinct steps.
-
-        Please return the response in this JSON format:
-        {
-            "journey_steps": [
-                {
-                    "step_number": 1,
-                    "step_name": "step name",
-                    "description": "description of this step"
-                }
-            ]
-        }"""
+        sketch = corpus_sketch(rows)
+        journey_data = reusable_journey(company, sketch, drift_threshold)
+        if journey_data:
+            print(f"Journey steps saved to: {save_journey_file(journey_data, output_root)}")
+            return journey_data
+        
+        texts = analysis_texts(rows, JOURNEY_FIELDS)
+        if sum(estimate_tokens(text) for text in texts) > token_budget:
+            texts = await condense_analyses(texts, token_budget, max_concurrency=max_concurrency, transport=transport,
+                                            limiter=limiter)
         
-        # Make OpenAI API call
-        response = await client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are analyzing customer journey data."},
-                {"role": "user", "content": json.dumps(analysis_data)},
-                {"role": "user", "content": journey_prompt}
-            ]
+        # The analyses go as plain lines of text rather than JSON-encoded strings, which escape every quote
+        messages, tokens = build_prompt(
+            "journey", "journey_steps", "You are analyzing customer journey data.", "\n".join(texts), JOURNEY_PROMPT
         )
         
-        # Parse and validate response
-        # content = response.choices[0].message.content.strip()
-        # print(f"Raw response content: {content[:200]}...")
+        create = (transport or get_transport()).completion("journey", "journey_steps")
+        if limiter is not None:
+            create = limited(create, limiter, tokens, "journey_steps")
+        last_model = get_cascade().models("journey")[-1]
         
-        try:
-            journey_data = json.loads(content)
-        except json.JSONDecodeError as e:
-            print(f"JSON Parse Error: {str(e)}\nContent: {content}")
-            raise
+        async def request_steps(_, model, attempt):
+            # Make OpenAI API call (served from the cache when the prompt is unchanged)
+            content = await cached_completion(
+                create,
+                validate=parse_journey_response,
+                model=model,
+                messages=messages
+            )
+            if not content:
+                raise ValueError("Empty response from OpenAI")
+            
+            # Parse and validate response
+            journey_data = parse_journey_response(content)
+            if len(journey_data["journey_steps"]) != JOURNEY_STEP_COUNT and model != last_model:
+                raise ValueError(f"Expected {JOURNEY_STEP_COUNT} journey steps, got {len(journey_data['journey_steps'])}")
+            return {0: journey_data}
         
-        if "journey_steps" not in journey_data:
-            raise ValueError("Response missing journey_steps key")
+        # The cheapest model is asked first; a reply that fails validation goes to the next model tier
+        results, _ = await run_cascade("journey", [messages], request_steps, "journey_steps")
+        if not results:
+            raise ValueError("No model returned valid journey steps")
+        journey_data = results[0]
         
         # Save journey steps
-        journey_dir = "journey-steps"
-        if not os.path.exists(journey_dir):
-            os.makedirs(journey_dir)
-        
-        output_file = os.path.join(
-            journey_dir, 
-            f"customer_journey_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        )
-        
-        with open(output_file, 'w') as f:
-            json.dump({
-                "journey_steps": journey_data["journey_steps"]
-            }, f, indent=2)
+        get_store().save_journey_steps(company, journey_data["journey_steps"], sketch, journey_prompt_fingerprint())
+        output_file = save_journey_file(journey_data, output_root)
         
         print(f"Journey steps saved to: {output_file}")
         return journey_data
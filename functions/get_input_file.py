@@ -24,4 +24,16 @@ def get_input_file() -> tuple[str, str]:
         
     except Exception as e:
         print(f"Error finding input file: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+
+def get_input_files() -> list[tuple[str, str]]:
+    """Get the path and base name of every JSON export in the raw_trustpilot_data directory"""
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    data_dir = os.path.join(project_root, "raw_trustpilot_data")
+    
+    json_files = sorted(f for f in os.listdir(data_dir) if f.endswith('.json')) if os.path.exists(data_dir) else []
+    if not json_files:
+        raise FileNotFoundError(f"No JSON files found in {data_dir}")
+    
+    print(f"Found {len(json_files)} input files in {data_dir}")
+    return [(os.path.join(data_dir, f), os.path.splitext(f)[0]) for f in json_files]
@@ -2,8 +2,18 @@ import shutil
 from datetime import datetime
 import os
 
+# Outputs from earlier runs that incremental mode merges new analyses into
+INCREMENTAL_KEPT_DIRECTORIES = [
+    'summarized-reviews',
+    'journey-steps',
+    'reviews-by-journey-step',
+    'visualizations'
+]
+
 # This deletes and recreates the working directories to ensure a clean start
-def initialize_directories():
+# In incremental mode the outputs of earlier runs are kept so new analyses can be merged into them
+# The directories are created under output_root, so each company in batch mode gets its own set
+def initialize_directories(incremental=False, output_root="."):
     """Initialize working directories by removing and recreating them"""
     directories = [
         'analyzed-chunks',
@@ -16,8 +26,14 @@ def initialize_directories():
     
     print(f"\nInitializing directories at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     
-    for directory in directories:
+    for name in directories:
+        directory = os.path.join(output_root, name)
         try:
+            if incremental and name in INCREMENTAL_KEPT_DIRECTORIES:
+                os.makedirs(directory, exist_ok=True)
+                print(f"Kept existing directory: {directory}")
+                continue
+            
             # Remove directory and contents if exists
             if os.path.exists(directory):
                 shutil.rmtree(directory)
@@ -0,0 +1,99 @@
+import re
+import math
+from collections import Counter
+import numpy as np
+
+# Reviews whose best cosine similarity to a journey step is below this are sent to the LLM instead
+CONFIDENCE_THRESHOLD = 0.1
+# Reviews whose best similarity beats the second best step by less than this are also sent to the LLM
+CONFIDENCE_MARGIN = 0.05
+# Number of reviews scored per NumPy matrix product
+SCORING_BATCH_SIZE = 4096
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'been', 'but', 'by', 'for', 'from', 'had', 'has', 'have',
+    'i', 'in', 'is', 'it', 'its', 'me', 'my', 'of', 'on', 'or', 'our', 'so', 'that', 'the', 'their',
+    'them', 'they', 'this', 'to', 'was', 'we', 'were', 'with', 'you', 'your', 'customer', 'review'
+}
+
+
+def tokenize(text):
+    """Split text into lower-case word tokens without stopwords"""
+    tokens = []
+    for word in re.findall(r"[a-z][a-z']+", str(text).lower()):
+        word = word.strip("'")
+        if word in STOPWORDS or len(word) < 3:
+            continue
+        # Fold simple plurals so "flights" matches "flight"
+        if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def step_text(step):
+    """Return the text that describes a journey step"""
+    return f"{step['step_name']} {step['step_name']} {step.get('description', '')}"
+
+
+def record_text(record):
+    """Return the text of a review analysis record used for classification"""
+    return f"{record.get('title') or ''} {record.get('sentimentSummary') or ''}"
+
+
+# This function scores reviews against journey steps with TF-IDF cosine similarity. Only terms that
+# appear in a step description can contribute to a similarity, so review vectors are built over the
+# step vocabulary alone (keeping the matrices small) and normalised by their full TF-IDF norm. A review
+# is only classified when its best step is both similar enough and clearly ahead of the runner-up.
+def classify_records(records, journey_steps, threshold=CONFIDENCE_THRESHOLD, margin=CONFIDENCE_MARGIN):
+    """Return (step_name, confidence) for each record, with step_name None below threshold or margin"""
+    if not records:
+        return []
+
+    step_counts = [Counter(tokenize(step_text(step))) for step in journey_steps]
+    record_counts = [Counter(tokenize(record_text(record))) for record in records]
+
+    # Inverse document frequency over steps and reviews together
+    document_frequency = Counter()
+    for counts in step_counts + record_counts:
+        document_frequency.update(counts.keys())
+    total_documents = len(step_counts) + len(record_counts)
+    idf = {term: math.log((1 + total_documents) / (1 + df)) + 1 for term, df in document_frequency.items()}
+
+    vocabulary = {term: i for i, term in enumerate(sorted({t for counts in step_counts for t in counts}))}
+    idf_vector = np.array([idf[term] for term in vocabulary])
+
+    step_matrix = np.zeros((len(journey_steps), len(vocabulary)))
+    for i, counts in enumerate(step_counts):
+        for term, count in counts.items():
+            step_matrix[i, vocabulary[term]] = count
+    step_matrix *= idf_vector
+    step_norms = np.linalg.norm(step_matrix, axis=1, keepdims=True)
+    step_matrix /= np.where(step_norms == 0, 1, step_norms)
+
+    step_names = [step['step_name'] for step in journey_steps]
+    results = []
+    for start in range(0, len(record_counts), SCORING_BATCH_SIZE):
+        batch = record_counts[start:start + SCORING_BATCH_SIZE]
+        matrix = np.zeros((len(batch), len(vocabulary)))
+        norms = np.zeros(len(batch))
+        for i, counts in enumerate(batch):
+            norms[i] = math.sqrt(sum((count * idf[term]) ** 2 for term, count in counts.items()))
+            for term, count in counts.items():
+                if term in vocabulary:
+                    matrix[i, vocabulary[term]] = count
+        matrix *= idf_vector
+        matrix /= np.where(norms == 0, 1, norms)[:, None]
+
+        similarities = matrix @ step_matrix.T
+        best = similarities.argmax(axis=1)
+        confidence = similarities[np.arange(len(batch)), best]
+        if len(journey_steps) > 1:
+            runner_up = np.partition(similarities, -2, axis=1)[:, -2]
+        else:
+            runner_up = np.zeros(len(batch))
+        for index, score, second in zip(best, confidence, runner_up):
+            confident = score >= threshold and score - second >= margin
+            results.append((step_names[index] if confident else None, float(score)))
+
+    return results
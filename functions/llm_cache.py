@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import hashlib
+
+# Cached responses live outside the directories that initialize_directories wipes
+CACHE_DIR = "llm-cache"
+# Entries older than this are treated as misses and evicted
+MAX_CACHE_AGE_SECONDS = 30 * 24 * 60 * 60
+# Oldest entries are evicted once the cache grows past this size
+MAX_CACHE_SIZE_BYTES = 500 * 1024 * 1024
+# Run eviction after this many writes
+EVICT_EVERY_WRITES = 100
+
+
+# This class stores chat completion content on disk, keyed by a hash of the request parameters
+# (model, messages and any other arguments), so identical prompts are never sent twice.
+class LLMCache:
+    """Content-addressed on-disk cache for chat completion responses"""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_age_seconds=MAX_CACHE_AGE_SECONDS,
+                 max_size_bytes=MAX_CACHE_SIZE_BYTES, enabled=True):
+        self.cache_dir = cache_dir
+        self.max_age_seconds = max_age_seconds
+        self.max_size_bytes = max_size_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(params):
+        """Hash the request parameters into a stable cache key"""
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """Return cached content for a key, or None on a miss"""
+        if not self.enabled:
+            return None
+
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_seconds:
+                os.remove(path)
+                self.evictions += 1
+                raise FileNotFoundError(path)
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry["content"]
+
+    def contains(self, key):
+        """Return True if an unexpired entry exists for a key, without counting a lookup"""
+        if not self.enabled:
+            return False
+        try:
+            return time.time() - os.path.getmtime(self._path(key)) <= self.max_age_seconds
+        except OSError:
+            return False
+
+    def set(self, key, content, params=None):
+        """Store content for a key"""
+        if not self.enabled or content is None:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                "model": (params or {}).get("model"),
+                "created": time.time(),
+                "content": content
+            }, f)
+        os.replace(tmp_path, path)
+
+        self.writes += 1
+        if self.writes % EVICT_EVERY_WRITES == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove expired entries, then the oldest entries until under the size limit"""
+        if not os.path.exists(self.cache_dir):
+            return
+
+        now = time.time()
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > self.max_age_seconds:
+                    os.remove(path)
+                    self.evictions += 1
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            os.remove(path)
+            total_size -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Return hit/miss counters"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions
+        }
+
+
+_cache = LLMCache()
+
+
+def get_cache():
+    """Return the shared LLM response cache"""
+    return _cache
+
+
+def configure_cache(**kwargs):
+    """Replace the shared LLM response cache with one built from the given settings"""
+    global _cache
+    _cache = LLMCache(**kwargs)
+    return _cache
+
+
+# Every stage calls this instead of client.chat.completions.create. The create argument is the
+# coroutine function that makes the network call, so stages can wrap it with rate limiting.
+# If validate is given it is called on fresh content and a response that raises is not cached.
+async def cached_completion(create, validate=None, **params):
+    """Return chat completion content, checking the on-disk cache before calling the API"""
+    cache = get_cache()
+    key = cache.make_key(params)
+
+    content = cache.get(key)
+    if content is not None:
+        return content
+
+    response = await create(**params)
+    content = response.choices[0].message.content if response.choices else None
+    if validate and content:
+        validate(content)
+    cache.set(key, content, params)
+    return content
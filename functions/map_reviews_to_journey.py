@@ -1,161 +1,339 @@
 import os
 import json
+import asyncio
+import hashlib
 from datetime import datetime
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from functions.llm_cache import cached_completion
+from functions.rate_limiter import AdaptiveRateLimiter, limited
+from functions.token_budget import group_by_tokens
+from functions.journey_classifier import classify_records, CONFIDENCE_THRESHOLD
+from functions.openai_client import get_transport
+from functions.record_store import write_records, MAPPED_COLUMNS
+from functions.review_store import get_store, DEFAULT_COMPANY
+from functions.prompt_builder import build_prompt, compact_json, compact_journey_steps, PromptTooLargeError
+from functions.batch_api import run_batch, BATCH_DIR
+from functions.model_cascade import get_cascade, run_cascade
+from functions.streaming import collect_invalid
+from functions.convert_date_format import convert_date_format
 
-# Load environment variables and initialize client
+# Load environment variables
 load_dotenv()
-client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
+# Maximum tokens of review analyses sent in one mapping request
+MAPPING_BATCH_TOKEN_BUDGET = 3000
+# Summary store columns read for mapping
+MAPPING_COLUMNS = ["reviewId", "date", "title", "rating", "sentimentSummary", "count", "analysis"]
+# Number of times a batch's reviews are sent (through the map model tiers) before they are given up
+MAX_MAPPING_ATTEMPTS = 3
+# Confidently classified reviews also sent to the LLM to check the local classifier against it
+CALIBRATION_ROWS = 100
+# Share of those reviews the classifier must place on the LLM's step for its other mappings to be kept
+MIN_CLASSIFIER_AGREEMENT = 0.9
 
-def convert_date_format(date_str):
-    """Convert various date formats to YYYY-MM-DD"""
+
+def check_mapping(review, valid_steps):
+    """Validate one entry of the mapping reply and return its (id, step_name)"""
+    if not isinstance(review, dict) or "id" not in review or "step_name" not in review:
+        raise ValueError(f"Review missing required fields: {review}")
+    if review["step_name"] not in valid_steps:
+        raise ValueError(f"Invalid step_name: {review['step_name']}")
+    return str(review["id"]), review["step_name"]
+
+
+# The model only picks a step for each review; rating and date are joined from the summary rows.
+# Returns {review item id: step_name} for the ids in expected_ids mapped to a valid step; the rest are
+# left for the next model tier. Raises ValueError if no review is mapped to a valid step.
+def parse_mapped_reviews(content, valid_steps, expected_ids):
+    """Parse and validate the review mapping returned by OpenAI"""
+    mapped_data = json.loads(content)
+    
+    # Validate structure
+    if not isinstance(mapped_data, dict) or not isinstance(mapped_data.get("reviews_by_journey_step"), list):
+        raise ValueError("Response missing reviews_by_journey_step key")
+    
+    # Validate reviews
+    steps = {}
+    for review in mapped_data["reviews_by_journey_step"]:
+        try:
+            item_id, step_name = check_mapping(review, valid_steps)
+        except ValueError:
+            continue
+        if item_id in expected_ids:
+            steps[item_id] = step_name
+    
+    if not steps:
+        raise ValueError(f"Response maps none of {len(expected_ids)} reviews to a valid step")
+    return steps
+
+
+MAPPING_PROMPT = """Map each review to the most relevant customer journey step.
+
+Rules:
+1. Use ONLY the journey steps provided - do not create new steps
+2. Match each review to exactly one journey step
+3. Use exact step names from the journey steps list
+4. Every review id must appear exactly once
+
+Return ONLY this JSON structure:
+{"reviews_by_journey_step": [{"id": "id of the review", "step_name": "exact step name from journey steps"}]}"""
+
+
+def review_item(row, item_id):
+    """Return the compact form of a summary row sent for mapping"""
+    return {"id": item_id, "title": row.get("title"), "sentimentSummary": row.get("sentimentSummary")}
+
+
+def local_mapping(record, step_name):
+    """Build a mapped review from a summary row, or return None if its rating or date is invalid"""
     try:
-        # Try parsing common date formats
-        for fmt in [
-            "%B %d, %Y",      # January 17, 2025
-            "%d %B %Y",       # 17 January 2025
-            "%Y-%m-%d",       # 2025-01-17
-            "%d/%m/%Y"        # 17/01/2025
-        ]:
-            try:
-                return datetime.strptime(date_str, fmt).strftime("%Y-%m-%d")
-            except ValueError:
-                continue
-        raise ValueError(f"Unsupported date format: {date_str}")
-    except Exception as e:
-        raise ValueError(f"Date conversion error: {date_str} - {str(e)}")
+        rating = int(record.get("rating"))
+        date = convert_date_format(str(record.get("date", "")))
+    except (TypeError, ValueError):
+        return None
+    if not 1 <= rating <= 5:
+        return None
+    review = {"step_name": step_name, "rating": rating, "reviewDateOfExperience": date}
+    if record.get("reviewId"):
+        review["reviewId"] = record["reviewId"]
+    # Weight reviews by the duplicates they stand for so average ratings stay correct
+    if (record.get("count") or 1) > 1:
+        review["count"] = record["count"]
+    return review
+
+
+# This function maps summary rows with the local TF-IDF classifier. Rows it is not confident about are
+# returned to be mapped by the LLM. Up to calibration_rows of the confident ones (picked by a hash of their
+# reviewId, so reruns hold out the same reviews) are held out: they are mapped by the LLM as well, and
+# their local steps are returned to be compared with its answers (see map_rows).
+def classify_locally(rows, journey_steps, threshold=CONFIDENCE_THRESHOLD, calibration_rows=0):
+    """Map confident reviews locally and return (mapped_reviews, their rows, remaining_rows, {reviewId: local step})"""
+    mapped = []
+    mapped_rows = []
+    remaining = []
+    for row, (step_name, _) in zip(rows, classify_records(rows, journey_steps, threshold)):
+        review = local_mapping(row, step_name) if step_name else None
+        if review:
+            mapped.append(review)
+            mapped_rows.append(row)
+        else:
+            remaining.append(row)
+    
+    held_out = sorted((hashlib.sha256(review["reviewId"].encode('utf-8')).hexdigest(), i)
+                      for i, review in enumerate(mapped) if review.get("reviewId"))[:calibration_rows]
+    held_out = {i for _, i in held_out}
+    calibration = {mapped[i]["reviewId"]: mapped[i]["step_name"] for i in held_out}
+    remaining += [mapped_rows[i] for i in sorted(held_out)]
+    mapped_rows = [row for i, row in enumerate(mapped_rows) if i not in held_out]
+    mapped = [review for i, review in enumerate(mapped) if i not in held_out]
+    
+    print(f"Local classifier mapped {len(mapped):,} of {len(rows):,} reviews and held out {len(calibration):,} more "
+          f"to check against the LLM; {len(remaining):,} left for the LLM")
+    return mapped, mapped_rows, remaining, calibration
+
+
+def classifier_agreement(calibration, mapped_reviews):
+    """Return (reviews compared, share whose LLM step matches the local classifier's) for the held-out reviews"""
+    llm_steps = {review["reviewId"]: review["step_name"] for review in mapped_reviews
+                 if review.get("reviewId") in calibration}
+    if not llm_steps:
+        return 0, None
+    matches = sum(calibration[review_id] == step_name for review_id, step_name in llm_steps.items())
+    return len(llm_steps), matches / len(llm_steps)
+
 
+def mapping_request(batch, journey_json, label, model=None):
+    """Return (request params, item ids, estimated tokens) for mapping one batch of summary rows"""
+    items = [review_item(row, str(i + 1)) for i, row in enumerate(batch)]
+    messages, tokens = build_prompt(
+        "map", label, "You are mapping customer reviews to journey steps.",
+        f"Journey steps: {journey_json}", f"Reviews: {compact_json(items)}", MAPPING_PROMPT
+    )
+    model = model or get_cascade().model("map", 1)
+    params = {"model": model, "response_format": {"type": "json_object"}, "messages": messages}
+    return params, [item["id"] for item in items], tokens
 
-async def map_reviews_to_journey():
+
+# This function maps one batch of summary rows through the map model tiers (see run_cascade). Each
+# response is validated on its own, and only the reviews that were not mapped to a valid step are sent
+# again, to a stronger model. Reviews no model maps are left out; None is returned if none was mapped.
+# A batch whose prompt is over the stage's token budget is split in half and both halves are mapped.
+# With stream, the reply is streamed and each mapping is checked as it arrives; invalid mappings are
+# left for the next tier, and only a reply that is not valid JSON is abandoned early.
+async def map_batch(batch, journey_json, valid_steps, limiter, label, max_attempts=MAX_MAPPING_ATTEMPTS, transport=None,
+                    stream=False):
+    """Map a batch of summary rows to journey steps"""
+    try:
+        first_request = mapping_request(batch, journey_json, label)
+    except PromptTooLargeError as e:
+        if len(batch) < 2:
+            raise
+        print(f"{str(e)}; splitting it in two")
+        half = len(batch) // 2
+        results = await asyncio.gather(
+            map_batch(batch[:half], journey_json, valid_steps, limiter, f"{label} part 1", max_attempts, transport, stream),
+            map_batch(batch[half:], journey_json, valid_steps, limiter, f"{label} part 2", max_attempts, transport, stream)
+        )
+        return None if None in results else results[0] + results[1]
+    
+    async def map_items(rows, model, attempt):
+        # The first attempt sends the whole batch to the first model tier
+        params, item_ids, tokens = first_request if attempt == 1 else mapping_request(rows, journey_json, label, model)
+        invalid = []
+        check = collect_invalid(lambda review: check_mapping(review, valid_steps), invalid) if stream else None
+        create = (transport or get_transport()).completion("map", label, check, "reviews_by_journey_step")
+        # Make OpenAI API call (served from the cache when the prompt is unchanged)
+        content = await cached_completion(
+            limited(create, limiter, tokens, label),
+            validate=lambda content: parse_mapped_reviews(content, valid_steps, item_ids),
+            **params
+        )
+        if not content:
+            raise ValueError("Empty response from OpenAI")
+        if invalid:
+            print(f"{len(invalid)} invalid mappings in the streamed reply for {label}: {invalid[0]}")
+        steps = parse_mapped_reviews(content, valid_steps, item_ids)
+        return {i: steps[item_id] for i, item_id in enumerate(item_ids) if item_id in steps}
+    
+    steps, unmapped = await run_cascade("map", batch, map_items, label, max_attempts)
+    if unmapped:
+        print(f"{len(unmapped)} of {len(batch)} reviews of {label} were not mapped by any model")
+    if not steps:
+        return None
+    
+    # Join the chosen steps back to the rows; rows with an invalid rating or date are left out
+    mapped = (local_mapping(batch[i], step_name) for i, step_name in sorted(steps.items()))
+    return [review for review in mapped if review]
+
+
+def batch_rows(rows, token_budget):
+    """Split summary rows into consecutive batches whose compact items fit token_budget"""
+    batches = []
+    start = 0
+    for group in group_by_tokens([compact_json(review_item(row, "0")) for row in rows], token_budget):
+        batches.append(rows[start:start + len(group)])
+        start += len(group)
+    return batches
+
+
+async def submit_mapping_batch(batches, journey_json, valid_steps, transport=None, output_root="."):
+    """Send the mapping requests through the Batch API"""
+    requests = []
+    for i, batch in enumerate(batches):
+        try:
+            params, expected_ids, _ = mapping_request(batch, journey_json, f"mapping batch {i + 1} of {len(batches)}")
+        except PromptTooLargeError:
+            # Split and sent directly by map_batch
+            continue
+        requests.append((params, lambda content, expected_ids=expected_ids: parse_mapped_reviews(content, valid_steps, expected_ids)))
+    await run_batch(requests, "map", os.path.join(output_root, BATCH_DIR), transport)
+
+
+# Rows are mapped in concurrent batches of up to batch_token_budget tokens. Only reviews that fail
+# validation are retried (see map_batch), and reviews that never pass are left out of the result.
+# With use_local_classifier, rows are first mapped locally and only low-confidence ones go to the LLM,
+# along with a held-out sample of confident ones. When the classifier agrees with the LLM on less than
+# MIN_CLASSIFIER_AGREEMENT of that sample, its mappings are dropped and those rows go to the LLM too.
+# With batch_api, the batches are first sent through the Batch API and then mapped from the cached replies.
+# With stream, replies are streamed and checked as they arrive (see map_batch).
+# Returns (mapped_reviews, numbers of the failed batches, number of batches sent to the LLM).
+async def map_rows(rows, journey_steps, batch_token_budget=MAPPING_BATCH_TOKEN_BUDGET, max_concurrency=8,
+                   max_attempts=MAX_MAPPING_ATTEMPTS, use_local_classifier=False, confidence_threshold=CONFIDENCE_THRESHOLD,
+                   transport=None, limiter=None, output_root=".", batch_api=False, stream=False, label="mapping batch",
+                   calibration_rows=CALIBRATION_ROWS):
+    """Map summary rows to the given journey steps"""
+    # Create set of valid step names for validation
+    valid_steps = {step['step_name'] for step in journey_steps}
+    
+    # Rows holding unparsed reply text from older analyses have no rating or date to map
+    text_rows = [row for row in rows if row.get("analysis")]
+    rows = [row for row in rows if not row.get("analysis")]
+    if text_rows:
+        print(f"Skipping {len(text_rows):,} unstructured analyses; run a full analysis to include them")
+    limiter = limiter or AdaptiveRateLimiter(max_concurrency=max_concurrency)
+    # Steps are sent with only their names and shortened descriptions
+    journey_json = compact_journey_steps(journey_steps)
+    
+    async def map_with_llm(rows, label):
+        """Map rows in batches of compact items, concurrently"""
+        batches = batch_rows(rows, batch_token_budget)
+        if batch_api and batches:
+            await submit_mapping_batch(batches, journey_json, valid_steps, transport, output_root)
+        results = await asyncio.gather(*(
+            map_batch(batch, journey_json, valid_steps, limiter, f"{label} {i + 1} of {len(batches)}", max_attempts,
+                      transport, stream)
+            for i, batch in enumerate(batches)
+        ))
+        failed = [i + 1 for i, result in enumerate(results) if result is None]
+        return [review for result in results if result for review in result], failed, len(batches)
+    
+    if not use_local_classifier:
+        return await map_with_llm(rows, label)
+    
+    # Map confident reviews locally and leave the rest for the LLM
+    local_reviews, local_rows, rows, calibration = classify_locally(rows, journey_steps, confidence_threshold,
+                                                                    calibration_rows)
+    mapped_reviews, failed_batches, batch_count = await map_with_llm(rows, label)
+    
+    compared, agreement = classifier_agreement(calibration, mapped_reviews)
+    if agreement is not None:
+        print(f"Local classifier agreed with the LLM on {agreement:.0%} of {compared:,} held-out reviews")
+    if agreement is not None and agreement < MIN_CLASSIFIER_AGREEMENT and local_rows:
+        print(f"Agreement is below {MIN_CLASSIFIER_AGREEMENT:.0%}; mapping the classifier's "
+              f"{len(local_rows):,} reviews with the LLM instead")
+        llm_reviews, llm_failed, llm_count = await map_with_llm(local_rows, f"{label} (reclassified)")
+        return (mapped_reviews + llm_reviews, failed_batches + [batch_count + i for i in llm_failed],
+                batch_count + llm_count)
+    return mapped_reviews + local_reviews, failed_batches, batch_count
+
+
+def save_mapped_reviews(mapped_reviews, output_root=".", company=DEFAULT_COMPANY):
+    """Store mapped reviews as the company's latest mapping, also writing a record file, and return its path"""
+    get_store().save_mappings(company, mapped_reviews)
+    target_dir = os.path.join(output_root, "reviews-by-journey-step")
+    os.makedirs(target_dir, exist_ok=True)
+    return write_records(
+        os.path.join(target_dir, f"journey_mapped_reviews_{datetime.now().strftime('%Y%m%d_%H%M%S')}"),
+        mapped_reviews, MAPPED_COLUMNS
+    )
+
+
+# This function maps the company's latest analyses to its latest journey steps, both read from the
+# review store, with map_rows.
+async def map_reviews_to_journey(batch_token_budget=MAPPING_BATCH_TOKEN_BUDGET, max_concurrency=8,
+                                 max_attempts=MAX_MAPPING_ATTEMPTS, use_local_classifier=False,
+                                 confidence_threshold=CONFIDENCE_THRESHOLD, transport=None, limiter=None, output_root=".",
+                                 batch_api=False, stream=False, company=DEFAULT_COMPANY):
     """Map reviews to customer journey steps"""
     try:
-        # Find latest files
-        summary_dir = "summarized-reviews"
-        journey_dir = "journey-steps"
-        target_dir = "reviews-by-journey-step"
-        
-        # Get latest summarized reviews
-        summary_files = sorted([f for f in os.listdir(summary_dir) 
-                              if f.startswith('summarized_reviews_')])
-        if not summary_files:
+        store = get_store()
+        rows = store.analyses(company, MAPPING_COLUMNS)
+        if not rows:
             raise FileNotFoundError("No summarized reviews found")
-        latest_summary = os.path.join(summary_dir, summary_files[-1])
         
-        # Get latest journey steps
-        journey_files = sorted([f for f in os.listdir(journey_dir) 
-                              if f.startswith('customer_journey_')])
-        if not journey_files:
+        journey_steps = store.journey_steps(company)
+        if not journey_steps:
             raise FileNotFoundError("No journey steps found")
-        latest_journey = os.path.join(journey_dir, journey_files[-1])
-        
-        # Load and validate source files
-        with open(latest_summary, 'r') as f:
-            reviews_data = json.load(f)
-        with open(latest_journey, 'r') as f:
-            journey_data = json.load(f)
-            
-        # Validate journey data structure
-        if not journey_data.get('journey_steps'):
-            raise ValueError("Journey data missing journey_steps")
-        
-        # Create set of valid step names for validation
-        valid_steps = {step['step_name'] for step in journey_data['journey_steps']}
+        journey_data = {"journey_steps": journey_steps}
         
-        mapping_prompt = """Map each review to the most relevant customer journey step.
-
-        Rules:
-        1. Use ONLY the journey steps provided - do not create new steps
-        2. Match each review to exactly one journey step
-        3. Convert dates to YYYY-MM-DD format (e.g., 2028-01-17)
-        4. Use exact step names from the journey steps list
-
-        Return ONLY this JSON structure:
-        {
-            "reviews_by_journey_step": [
-                {
-                    "step_name": "exact step name from journey steps",
-                    "rating": 5,
-                    "reviewDateOfExperience": "YYYY-MM-DD"
-                }
-            ]
-        }
-
-        Requirements:
-        - reviewDateOfExperience must match original review date exactly and in the format YYYY-MM-DD (e.g., 2028-01-17)
-        - rating must be integer 1-5
-        - step_name must exactly match one from provided journey steps
-        - all fields are required"""
-        
-        # Make OpenAI API call
-        response = await client.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=[
-                {"role": "system", "content": "You are mapping customer reviews to journey steps."},
-                {"role": "user", "content": f"Journey steps: {json.dumps(journey_data)}"},
-                {"role": "user", "content": f"Reviews: {json.dumps(reviews_data)}"},
-                {"role": "user", "content": mapping_prompt}
-            ]
+        mapped_reviews, failed_batches, batch_count = await map_rows(
+            rows, journey_data['journey_steps'], batch_token_budget, max_concurrency, max_attempts, use_local_classifier,
+            confidence_threshold, transport, limiter, output_root, batch_api, stream
         )
         
-        # Clean and validate response
-        content = response.choices[0].message.content.strip()
-        # print(f"Raw response: {content[:200]}...")  # Debug log
-        
-        # Remove markdown code block markers
-        content = content.replace('```json', '').replace('```', '').strip()
-        # print(f"Cleaned content: {content[:200]}...")  # Debug log
-        
-        try:
-            mapped_data = json.loads(content)
-        except json.JSONDecodeError as e:
-            print(f"JSON Parse Error: {str(e)}\nContent: {content}")
-            raise
-        
-        # Validate structure
-        if "reviews_by_journey_step" not in mapped_data:
-            raise ValueError("Response missing reviews_by_journey_step key")
-            
-        # Validate reviews
-        for review in mapped_data["reviews_by_journey_step"]:
-            required_fields = ["step_name", "rating", "reviewDateOfExperience"]
-            missing_fields = [f for f in required_fields if f not in review]
-            if missing_fields:
-                raise ValueError(f"Review missing required fields: {missing_fields}")
-            
-            # Convert and validate date
-            try:
-                review["reviewDateOfExperience"] = convert_date_format(review["reviewDateOfExperience"])
-            except ValueError as e:
-                raise ValueError(f"Date format error: {str(e)}")
-            
-            # Validate field types and values
-            if review["step_name"] not in valid_steps:
-                raise ValueError(f"Invalid step_name: {review['step_name']}")
-
-            if not isinstance(review["rating"], int) or not 1 <= review["rating"] <= 5:
-                raise ValueError(f"Invalid rating value: {review['rating']}")
-                
-            try:
-                datetime.strptime(review["reviewDateOfExperience"], "%Y-%m-%d")
-            except ValueError:
-                raise ValueError(f"Invalid date format: {review['reviewDateOfExperience']}")
+        # Merge the batches that passed validation
+        if batch_count and len(failed_batches) == batch_count and not mapped_reviews:
+            raise ValueError("All mapping batches failed validation")
+        if failed_batches:
+            print(f"Mapping failed for batches {failed_batches}; their reviews are left out")
+        mapped_data = {"reviews_by_journey_step": mapped_reviews}
         
         # Save mapped reviews
-        output_file = os.path.join(
-            target_dir, 
-            f"journey_mapped_reviews_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        )
-        
-        with open(output_file, 'w') as f:
-            json.dump({
-                "reviews_by_journey_step": mapped_data["reviews_by_journey_step"]
-            }, f, indent=2)
+        output_file = save_mapped_reviews(mapped_reviews, output_root, company)
         
         print(f"\nMapped reviews saved to: {output_file}")
         return mapped_data
         
     except Exception as e:
         print(f"/nError mapping reviews to journey: {str(e)}")
-        raise
+        raise
\ No newline at end of file
@@ -0,0 +1,93 @@
+import json
+from functions.telemetry import get_telemetry, attempt_kind
+from functions.prompt_builder import PromptTooLargeError
+
+# Models tried for each stage, fastest and cheapest first. Items that fail validation on one model are
+# sent again to the next; once the last model is reached it is retried with the items that still fail.
+MODEL_TIERS = {
+    "analyze": ["gpt-4o-mini", "gpt-4o"],
+    "condense": ["gpt-4o-mini"],
+    "journey": ["gpt-4o-mini", "gpt-4"],
+    "map": ["gpt-4o-mini", "gpt-4o-2024-08-06"]
+}
+
+
+class ModelCascade:
+    """Per-stage tiers of models, cheapest first"""
+
+    def __init__(self, tiers=None):
+        self.tiers = {**MODEL_TIERS, **(tiers or {})}
+
+    def models(self, stage):
+        """Return the models of a stage, cheapest first"""
+        return list(self.tiers[stage])
+
+    def model(self, stage, attempt):
+        """Return the model for an attempt (from 1) at a stage; attempts past the last tier stay on it"""
+        models = self.tiers[stage]
+        return models[min(attempt, len(models)) - 1]
+
+    def attempts(self, stage, max_attempts=1):
+        """Return how many attempts a stage makes: every tier once, and at least max_attempts"""
+        return max(max_attempts, len(self.tiers[stage]))
+
+
+_cascade = ModelCascade()
+
+
+def get_cascade():
+    """Return the shared model cascade"""
+    return _cascade
+
+
+def configure_cascade(tiers=None):
+    """Replace the shared model cascade, overriding the tiers of the given stages"""
+    global _cascade
+    _cascade = ModelCascade(tiers)
+    return _cascade
+
+
+# This function runs the items of one request (the reviews of a chunk or mapping batch) through the
+# stage's model tiers. request(items, model, attempt) sends a subset of the items and returns
+# {position in the subset: result} for the ones whose answers passed validation; it raises ValueError
+# when the reply is unusable. Only the items that failed go to the next attempt, so most items are
+# answered by the cheapest model. Escalations are recorded in the telemetry.
+async def run_cascade(stage, items, request, label, max_attempts=1):
+    """Return ({item position: result}, positions of the items no model answered)"""
+    cascade = get_cascade()
+    first_model = cascade.model(stage, 1)
+    attempts = cascade.attempts(stage, max_attempts)
+    results = {}
+    answered_by = {}
+    escalated = set()
+    pending = list(range(len(items)))
+
+    previous_model = None
+    for attempt in range(1, attempts + 1):
+        model = cascade.model(stage, attempt)
+        if model != first_model:
+            escalated.update(pending)
+        # Later attempts on the same model are retries; moving to a stronger model is an escalation
+        kind = None if attempt == 1 else ("retry" if model == previous_model else "escalation")
+        previous_model = model
+        try:
+            with attempt_kind(kind):
+                answers = await request([items[i] for i in pending], model, attempt)
+        except PromptTooLargeError:
+            raise
+        except (ValueError, json.JSONDecodeError) as e:
+            print(f"Invalid response for {label} from {model} (attempt {attempt} of {attempts}): {str(e)}")
+            answers = {}
+
+        for position, result in answers.items():
+            results[pending[position]] = result
+            answered_by[model] = answered_by.get(model, 0) + 1
+        failed = [item for position, item in enumerate(pending) if position not in answers]
+        if failed and answers:
+            print(f"{len(failed)} of {len(pending)} items of {label} failed validation on {model}")
+        pending = failed
+        if not pending:
+            break
+
+    get_telemetry().record_cascade(stage, len(items), len(escalated), answered_by, len(pending))
+    return results, pending
@@ -0,0 +1,151 @@
+import os
+import asyncio
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError, InternalServerError
+from functions.rate_limiter import backoff_delay, current_slot
+from functions.telemetry import instrumented, attempt_kind
+from functions.streaming import streamed
+
+# Load environment variables
+load_dotenv()
+
+# Keep-alive connection pool shared by every stage
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
+KEEPALIVE_EXPIRY_SECONDS = 30
+CONNECT_TIMEOUT_SECONDS = 10
+# Read timeout per stage; the journey prompt is large and goes to a slower model
+STAGE_TIMEOUTS = {"analyze": 60, "condense": 60, "journey": 180, "map": 120}
+DEFAULT_TIMEOUT_SECONDS = 60
+# Retries after timeouts, dropped connections and 5xx responses (429s are retried by the rate limiter)
+MAX_TRANSIENT_RETRIES = 3
+# APITimeoutError is a subclass of APIConnectionError
+TRANSIENT_ERRORS = (APIConnectionError, InternalServerError)
+
+
+# This class owns the one AsyncOpenAI client used by every stage. Stages call completion(stage, label)
+# to get a create function with the stage's timeout, jittered retries of transient errors and, when
+# hedge_after is set, a duplicate request sent if the first has not answered within hedge_after seconds.
+# The duplicate takes its own slot and token reservation from the request's limiter, and is not sent when
+# the limiter has none to spare. Hedged requests cost twice as much, so hedging is off by default.
+# With on_element, the reply is streamed and each element of its array_key array is passed to on_element
+# as it arrives (see functions.streaming); streamed requests are never hedged.
+class OpenAITransport:
+    """Shared pooled OpenAI client with per-stage timeouts, retries and request hedging"""
+
+    def __init__(self, client=None, stage_timeouts=None, max_retries=MAX_TRANSIENT_RETRIES, hedge_after=None,
+                 max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS):
+        self.stage_timeouts = {**STAGE_TIMEOUTS, **(stage_timeouts or {})}
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.hedged_count = 0
+        self.hedge_wins = 0
+        self.client = client or AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            # Retries are handled here and in the rate limiter, not by the SDK
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                    keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS
+                ),
+                timeout=httpx.Timeout(DEFAULT_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS)
+            )
+        )
+
+    def timeout(self, stage):
+        """Return the request timeout for a stage"""
+        return httpx.Timeout(self.stage_timeouts.get(stage, DEFAULT_TIMEOUT_SECONDS), connect=CONNECT_TIMEOUT_SECONDS)
+
+    async def _hedged(self, create, params):
+        """Send a request, and a duplicate if it is slow, returning whichever succeeds first"""
+        first = asyncio.ensure_future(create(**params))
+        if not self.hedge_after:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+
+        # The duplicate counts against the rate budget like any other request
+        slot = current_slot()
+        limiter, tokens = slot if slot else (None, 0)
+        if limiter is not None and not await limiter.try_acquire(tokens):
+            return await first
+
+        async def duplicate():
+            rate_limited = False
+            try:
+                with attempt_kind("hedge"):
+                    return await create(**params)
+            except Exception as e:
+                rate_limited = getattr(e, "status_code", None) == 429
+                raise
+            finally:
+                if limiter is not None:
+                    await limiter.release(rate_limited=rate_limited)
+
+        self.hedged_count += 1
+        second = asyncio.ensure_future(duplicate())
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.hedge_wins += task is second
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def completion(self, stage, label, on_element=None, array_key=None):
+        """Return a chat completion function for one stage and chunk"""
+        create = self.client.chat.completions.create
+        if on_element:
+            create = streamed(create, on_element, array_key)
+        create = instrumented(create, stage, label)
+
+        async def transport_create(**params):
+            params = {**params, "timeout": self.timeout(stage)}
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with attempt_kind("retry" if attempt else None):
+                        if on_element:
+                            return await create(**params)
+                        return await self._hedged(create, params)
+                except TRANSIENT_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = backoff_delay(attempt)
+                    print(f"{type(e).__name__} on {label}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+        return transport_create
+
+    async def close(self):
+        """Close the connection pool"""
+        await self.client.close()
+
+
+_transport = None
+
+
+def get_transport():
+    """Return the shared OpenAI transport, creating it on first use"""
+    global _transport
+    if _transport is None:
+        _transport = OpenAITransport()
+    return _transport
+
+
+def configure_transport(**kwargs):
+    """Replace the shared OpenAI transport with one built from the given settings"""
+    global _transport
+    _transport = OpenAITransport(**kwargs)
+    return _transport
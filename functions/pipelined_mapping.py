@@ -0,0 +1,96 @@
+import asyncio
+from itertools import chain
+from functions.analysis_records import analysis_rows
+
+# Once the journey steps are known, analyzed rows are mapped in groups of at least this many
+MAP_GROUP_ROWS = 200
+
+
+def split_sample_batches(batches, sample_prefix):
+    """Return (sample batches, all batches) for batches whose sample chunks come first"""
+    batches = iter(batches)
+    sample = []
+    for batch in batches:
+        if not batch[0].startswith(sample_prefix):
+            return sample, chain(sample, [batch], batches)
+        sample.append(batch)
+    return sample, iter(sample)
+
+
+# This class is the on_analyzed callback of process_chunks in pipelined mode. When the last sample chunk
+# is analyzed it starts generate_journey(sample_rows); rows are then passed to map_rows(rows, journey_steps,
+# label) in groups of group_rows while the remaining chunks are still being analyzed. Rows analyzed before
+# the journey steps exist wait in the first group. With streamed replies, add_record is the on_record
+# callback of process_chunks and queues each summary row as it arrives; the chunk's rows are then not
+# queued again when the chunk completes.
+class PipelinedMapper:
+    """Map analyzed reviews to journey steps while the remaining chunks are analyzed"""
+
+    def __init__(self, sample_chunks, generate_journey, map_rows, group_rows=MAP_GROUP_ROWS):
+        self.sample_chunks = {name for name, _ in sample_chunks}
+        self.generate_journey = generate_journey
+        self.map_rows = map_rows
+        self.group_rows = group_rows
+        self.sample_rows = []
+        self.pending = []
+        self.queued = set()
+        self.journey_task = None
+        self.map_tasks = []
+
+    def __call__(self, chunk_file, analysis):
+        """Queue the rows of an analyzed chunk for mapping"""
+        rows = analysis_rows(chunk_file, analysis)
+        if chunk_file in self.sample_chunks:
+            self.sample_rows.extend(rows)
+            self.sample_chunks.discard(chunk_file)
+            if not self.sample_chunks:
+                self.start_journey()
+        self.add_rows([row for row in rows if row.get("reviewId") not in self.queued])
+
+    def add_record(self, chunk_file, row):
+        """Queue a summary row that arrived before its chunk was complete"""
+        if row.get("reviewId") is not None and row["reviewId"] not in self.queued:
+            self.queued.add(row["reviewId"])
+            self.add_rows([row])
+
+    def add_rows(self, rows):
+        """Queue summary rows for mapping"""
+        self.pending.extend(rows)
+        self.flush()
+
+    def start_journey(self):
+        """Start generating journey steps from the sample rows"""
+        if self.journey_task is None:
+            print(f"Generating journey steps from a sample of {len(self.sample_rows):,} analyzed reviews")
+            self.journey_task = asyncio.ensure_future(self.generate_journey(self.sample_rows))
+
+    def flush(self, force=False):
+        """Start mapping the queued rows once there are enough of them and journey steps are on the way"""
+        if self.journey_task is None or not self.pending or (len(self.pending) < self.group_rows and not force):
+            return
+        rows, self.pending = self.pending, []
+        self.map_tasks.append(asyncio.ensure_future(self._map(rows, len(self.map_tasks) + 1)))
+
+    async def _map(self, rows, group):
+        journey_data = await self.journey_task
+        return await self.map_rows(rows, journey_data['journey_steps'], f"mapping group {group} batch")
+
+    async def finish(self):
+        """Map the remaining rows and return (journey_data, mapped_reviews, failed batch count, batch count)"""
+        if self.journey_task is None:
+            # Some sample chunks failed; derive the steps from everything that was analyzed
+            self.sample_rows = self.sample_rows or list(self.pending)
+            self.start_journey()
+        self.flush(force=True)
+
+        journey_data = await self.journey_task
+        results = await asyncio.gather(*self.map_tasks)
+        mapped_reviews = [review for mapped, _, _ in results for review in mapped]
+        return (journey_data, mapped_reviews, sum(len(failed) for _, failed, _ in results),
+                sum(batch_count for _, _, batch_count in results))
+
+    def cancel(self):
+        """Cancel journey generation and mapping that is still running"""
+        for task in self.map_tasks + [self.journey_task]:
+            if task is not None:
+                task.cancel()
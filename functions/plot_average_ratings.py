@@ -1,71 +1,62 @@
 import os
-import json
-import glob
+import math
 from datetime import datetime
 import pandas as pd
 import plotly.express as px
+from functions.review_store import get_store, DEFAULT_COMPANY
+from functions.review_sampling import interval_width
 
-def get_latest_file(pattern):
-    """Get the most recent file matching the pattern"""
-    files = glob.glob(pattern)
-    if not files:
-        raise FileNotFoundError(f"No files found matching pattern: {pattern}")
-    return max(files, key=os.path.getctime)
+# Static images (png, svg, pdf) need kaleido; without it only the HTML is written
+try:
+    import kaleido  # noqa: F401
+    IMAGES_AVAILABLE = True
+except ImportError:
+    IMAGES_AVAILABLE = False
 
-def validate_data(data, required_keys):
-    """Validate JSON data structure"""
-    if not isinstance(data, dict):
-        raise ValueError("Data must be a dictionary")
-    missing_keys = [key for key in required_keys if key not in data]
-    if missing_keys:
-        raise ValueError(f"Missing required keys: {missing_keys}")
 
-def plot_average_ratings():
+def save_figure(fig, output_root, name, image_format=None, timestamped=True):
+    """Write a figure to visualizations/<name>_<timestamp>.html (and a static image when asked), returning the HTML path"""
+    output_dir = os.path.join(output_root, "visualizations")
+    os.makedirs(output_dir, exist_ok=True)
+    
+    stem = os.path.join(output_dir, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}" if timestamped else name)
+    fig.write_html(f"{stem}.html")
+    if image_format:
+        if IMAGES_AVAILABLE:
+            fig.write_image(f"{stem}.{image_format}")
+        else:
+            print(f"Skipping {image_format} image of {name}: install kaleido to write static images")
+    return f"{stem}.html"
+
+# Journey steps and average ratings come from the company's latest journey and mapping in the review store;
+# the averages are read from the store's step rollups, weighting each review by the duplicates it stands for.
+# Error bars show the 95% confidence interval of each average (none for steps with fewer than two reviews).
+# The plot is only opened in a browser when show is set, so headless runs just write the files.
+def plot_average_ratings(output_root=".", show=False, company=DEFAULT_COMPANY, image_format=None, timestamped=True):
     """Generate interactive plot of average ratings by journey step"""
     try:
-        # Find latest files
-        reviews_file = get_latest_file("reviews-by-journey-step/journey_mapped_reviews_*.json")
-        journey_file = get_latest_file("journey-steps/customer_journey_*.json")
-        
-        # Load and validate reviews data
-        with open(reviews_file, 'r') as f:
-            reviews_data = json.load(f)
-        validate_data(reviews_data, ["reviews_by_journey_step"])
-        
-        # Load and validate journey steps
-        with open(journey_file, 'r') as f:
-            steps_data = json.load(f)
-        validate_data(steps_data, ["journey_steps"])
+        store = get_store()
         
         # Get required steps
-        required_steps = [step['step_name'] for step in steps_data['journey_steps']]
+        required_steps = [step['step_name'] for step in store.journey_steps(company)]
         if not required_steps:
             raise ValueError("No journey steps found")
         
-        # Create DataFrame
-        reviews_df = pd.json_normalize(reviews_data['reviews_by_journey_step'])
-        if reviews_df.empty:
+        # Average ratings (5 -> +2 ... 1 -> -2) by step
+        step_ratings = store.step_ratings(company)
+        if not step_ratings:
             raise ValueError("No review data found")
         
-        # Validate required columns
-        required_columns = ['step_name', 'rating']
-        missing_columns = [col for col in required_columns if col not in reviews_df.columns]
-        if missing_columns:
-            raise ValueError(f"Missing required columns: {missing_columns}")
-        
-        # Map ratings
-        mapping = {5: 2, 4: 1, 3: 0, 2: -1, 1: -2}
-        reviews_df['rating'] = reviews_df['rating'].map(mapping)
-        
-        # Calculate averages
-        average_ratings = (reviews_df.groupby('step_name')['rating']
-                         .mean()
-                         .reset_index())
-        
-        # Reorder based on journey steps
-        average_ratings = (average_ratings.set_index('step_name')
-                         .reindex(required_steps, fill_value=0)
-                         .reset_index())
+        # Reorder based on journey steps; steps without mapped reviews show 0
+        ratings = [step_ratings.get(step, (0, 0, None)) for step in required_steps]
+        widths = [interval_width(count, variance) for _, count, variance in ratings]
+        average_ratings = pd.DataFrame({
+            'step_name': required_steps,
+            'rating': [mean for mean, _, _ in ratings],
+            # Error bars extend half the interval width above and below the average
+            'interval': [width / 2 if width != math.inf else None for width in widths],
+            'reviews': [count for _, count, _ in ratings]
+        })
         
         # Create plot
         fig = px.bar(
@@ -74,7 +65,9 @@ def plot_average_ratings():
             y='rating',
             title='Average Rating By Journey Step',
             labels={'step_name': 'Journey Step', 'rating': 'Average Rating'},
-            category_orders={'step_name': required_steps}
+            category_orders={'step_name': required_steps},
+            error_y='interval',
+            hover_data=['reviews']
         )
         
         # Customize plot
@@ -87,21 +80,57 @@ def plot_average_ratings():
         )
         
         # Save plot
-        output_dir = "visualizations"
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-            
-        output_file = os.path.join(
-            output_dir, 
-            f"ratings_by_step_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
-        )
-        fig.write_html(output_file)
+        output_file = save_figure(fig, output_root, "ratings_by_step", image_format, timestamped)
         print(f"\nPlot saved to: {output_file}")
         
-        # Display plot
-        fig.show()
+        # Display plot (headless and batch runs only save it)
+        if show:
+            fig.show()
         
     except Exception as e:
         print(f"/nError generating plot: {str(e)}")
         raise
 
+
+# Weekly average rating of each step (by date of experience), read from the store's step rollups
+def plot_rating_trends(output_root=".", show=False, company=DEFAULT_COMPANY, image_format=None, timestamped=True):
+    """Generate interactive plot of weekly average ratings by journey step"""
+    try:
+        store = get_store()
+        
+        required_steps = [step['step_name'] for step in store.journey_steps(company)]
+        if not required_steps:
+            raise ValueError("No journey steps found")
+        
+        step_trends = store.step_trends(company)
+        if not step_trends:
+            raise ValueError("No dated review data found")
+        
+        trends = pd.DataFrame(
+            [(step, week, rating, count) for step, weeks in step_trends.items() for week, rating, count in weeks],
+            columns=['step_name', 'week', 'rating', 'reviews']
+        )
+        
+        fig = px.line(
+            trends,
+            x='week',
+            y='rating',
+            color='step_name',
+            markers=True,
+            title='Weekly Average Rating By Journey Step',
+            labels={'week': 'Week Of Experience', 'rating': 'Average Rating', 'step_name': 'Journey Step'},
+            category_orders={'step_name': required_steps},
+            hover_data=['reviews']
+        )
+        fig.update_yaxes(tickvals=[-2, -1, 0, 1, 2], range=[-2.2, 2.2])
+        fig.update_layout(yaxis_title="Average Rating (-2 to +2)", xaxis_title="Week Of Experience")
+        
+        output_file = save_figure(fig, output_root, "rating_trends", image_format, timestamped)
+        print(f"\nTrend plot saved to: {output_file}")
+        
+        if show:
+            fig.show()
+        
+    except Exception as e:
+        print(f"\nError generating trend plot: {str(e)}")
+        raise
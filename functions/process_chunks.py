@@ -1,11 +1,18 @@
-import pandas as pd
 import os
-from openai import OpenAI
-from datetime import datetime
 import json
-from openai import AsyncOpenAI
+import asyncio
 from dotenv import load_dotenv
-from functions.clean_markdown import clean_markdown
+from functions.rate_limiter import AdaptiveRateLimiter, limited
+from functions.llm_cache import cached_completion
+from functions.review_manifest import review_key, review_fingerprint, mark_processed, save_manifest
+from functions.stage_runner import fingerprint
+from functions.openai_client import get_transport
+from functions.convert_date_format import convert_date_format
+from functions.prompt_builder import build_prompt, compact_json, PromptTooLargeError
+from functions.batch_api import run_batch, BATCH_DIR
+from functions.model_cascade import get_cascade, run_cascade
+from functions.streaming import collect_invalid
+from functions.analysis_records import analysis_rows
 
 # This function processes each chunk file and sends the reviews to the OpenAI API for analysis. The function returns the sentiment analysis for each review.
 
@@ -14,75 +21,276 @@ load_dotenv()
 
 SYSTEM_PROMPT = """You are a data processing assistant. You are tasked with analyzing the sentiment of customer reviews for a company. The reviews are in the form of text data. Your task is to read each review and determine the sentiment.You should then provide a brief summary of the sentiment analysis for each review - sentiment summary. The reviews are from a variety of sources, so you may encounter different writing styles and topics. Your goal is to provide an accurate and consistent analysis of the sentiment of each review. Please highlight specific details that evidence the customer experience.
 
-Date format always "YYYY-MM-DD"
+Each line of the input is one review as JSON with its id, rating (out of 5), title and text.
 
-Return ONLY this exact JSON structure:
-
-{
-  "date": "string",
-  "title": "string",
-  "rating": "integer",
-  "sentimentSummary": "string"
-}
+Return ONLY this exact JSON structure, with one entry for every review id in the input:
+{"reviews": [{"id": "string", "sentimentSummary": "string"}]}
 """
 
+# Number of times a chunk's reviews are sent (through the analyze model tiers) before it is recorded as failed
+MAX_ANALYSIS_ATTEMPTS = 3
 
-# Initialize OpenAI client
-client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
+# Reviews are sent as compact JSON lines under short numeric ids rather than their full review IDs;
+# the date is left out because it is copied from the source review.
+def format_review(review, item_id="0"):
+    """Format a single raw review as one line of prompt text"""
+    return compact_json({
+        "id": item_id,
+        "rating": review.get('reviewRatingScore'),
+        "title": review.get('reviewTitle'),
+        "text": review.get('reviewDescription')
+    })
 
-# This function processes each chunk file and sends the reviews to the OpenAI API for analysis. The function returns the sentiment analysis for each review.
-async def process_chunks():
-    """Process each chunk file and send to OpenAI API"""
-    chunk_files = sorted([f for f in os.listdir('data-chunks') if f.endswith('.json')])
-    
+
+def format_chunk(chunk_data):
+    """Format a chunk of raw reviews as prompt text"""
+    return "\n".join(format_review(review, str(i + 1)) for i, review in enumerate(chunk_data))
+
+
+def source_date(review):
+    """Return a review's date of experience as YYYY-MM-DD, or as written if it cannot be parsed"""
+    try:
+        return convert_date_format(review['reviewDateOfExperience'])
+    except (KeyError, ValueError):
+        return review.get('reviewDateOfExperience')
+
+
+def check_summary(item, review_count):
+    """Validate one entry of the analysis reply and return its (id, sentimentSummary)"""
+    # Ids are sent as strings but some replies give them as numbers
+    item_id = str(item.get("id")) if isinstance(item, dict) else ""
+    if not item_id.isdecimal() or not 1 <= int(item_id) <= review_count:
+        raise ValueError(f"Summary for an unknown review: {str(item)[:100]}")
+    summary = item.get("sentimentSummary")
+    if not isinstance(summary, str) or not summary.strip():
+        raise ValueError(f"Empty sentiment summary for review {item_id}")
+    return str(int(item_id)), summary.strip()
+
+
+# The model only writes the sentiment summary. Each summary is joined back to its review by its position
+# in the chunk, and the date, title and rating are copied from the source review rather than regenerated.
+# Returns {position in the chunk: record} for the reviews with a valid summary; the rest are left for the
+# next model tier. A reply that is not valid JSON, or has no valid summary at all, raises ValueError.
+def parse_analysis_response(content, chunk_data):
+    """Parse the analysis reply into records for the reviews of the chunk it summarizes"""
+    data = json.loads(content)
+    if not isinstance(data, dict) or not isinstance(data.get("reviews"), list):
+        raise ValueError("Response missing reviews list")
+
+    summaries = {}
+    for item in data["reviews"]:
+        try:
+            item_id, summary = check_summary(item, len(chunk_data))
+        except ValueError:
+            continue
+        summaries[int(item_id) - 1] = summary
+    if not summaries:
+        raise ValueError(f"Response has no valid summary for any of {len(chunk_data)} reviews")
+
+    return {i: analysis_record(review, summaries[i]) for i, review in enumerate(chunk_data) if i in summaries}
+
+
+def analysis_record(review, summary):
+    """Return the analysis record of a review from its sentiment summary"""
+    return {
+        "reviewId": review_key(review),
+        "date": source_date(review),
+        "title": review.get('reviewTitle'),
+        "rating": review.get('reviewRatingScore'),
+        "sentimentSummary": summary
+    }
+
+
+def covered_review_ids(chunk_data):
+    """Return the keys of the reviews in a chunk, including duplicates collapsed into them"""
+    review_ids = []
+    for review in chunk_data:
+        key = review_key(review)
+        review_ids.append(key)
+        review_ids.extend(member for member in review.get('duplicateReviews', {}) if member != key)
+    return review_ids
+
+
+def chunk_analysis(chunk_data, records):
+    """Return the saved analysis of a chunk: its records and the duplicate reviews they stand for"""
+    return {
+        "records": records,
+        "reviewIds": covered_review_ids(chunk_data),
+        "duplicateCounts": {
+            review_key(review): review['duplicateCount']
+            for review in chunk_data if review.get('duplicateCount', 1) > 1
+        },
+        "duplicateReviews": {
+            review_key(review): [member for member in review['duplicateReviews'] if member != review_key(review)]
+            for review in chunk_data if review.get('duplicateReviews')
+        }
+    }
+
+
+def iter_chunk_files(chunk_dir='data-chunks'):
+    """Yield (chunk_name, reviews) pairs from the chunk files on disk"""
+    chunk_files = sorted([f for f in os.listdir(chunk_dir) if f.endswith('.json')])
     for chunk_file in chunk_files:
         try:
             # Read JSON chunk file
-            chunk_path = os.path.join('data-chunks', chunk_file)
-            with open(chunk_path, 'r') as f:
-                chunk_data = json.load(f)
-            chunk_df = pd.DataFrame(chunk_data)
-            
-            # Format reviews
-            reviews = []
-            for _, row in chunk_df.iterrows():
-                review = (
-                    f"Date: {row['reviewDateOfExperience']}\n"
-                    f"Title: {row['reviewTitle']}\n"
-                    f"Rating: {row['reviewRatingScore']}/5\n"
-                    f"Description: {row['reviewDescription']}\n"
-                    f"{'='*50}"
-                )
-                reviews.append(review)
+            with open(os.path.join(chunk_dir, chunk_file), 'r') as f:
+                yield chunk_file, json.load(f)
+        except Exception as e:
+            print(f"Error reading {chunk_file}: {str(e)}")
+
+
+def chunk_fingerprint(chunk_data):
+    """Fingerprint the reviews in a chunk"""
+    return fingerprint([[review_key(review), review_fingerprint(review)] for review in chunk_data])
+
+
+def analysis_request(chunk_file, chunk_data, model=None):
+    """Return (request params, estimated tokens) for analyzing one chunk, by default with the first model tier"""
+    messages, tokens = build_prompt("analyze", chunk_file, SYSTEM_PROMPT, format_chunk(chunk_data))
+    model = model or get_cascade().model("analyze", 1)
+    return {"model": model, "response_format": {"type": "json_object"}, "messages": messages}, tokens
+
+
+def chunk_complete(chunk_file, chunk_data, state, output_root="."):
+    """Return True if the pipeline state records the chunk as analyzed and its output exists"""
+    output_file = os.path.join(output_root, "analyzed-chunks", f"analyzed_{chunk_file}")
+    return state is not None and state.chunk_complete(chunk_file, chunk_fingerprint(chunk_data)) and os.path.exists(output_file)
+
+
+# Reviews go through the analyze model tiers (see run_cascade), and the chunk fails if any review is
+# never summarized. on_analyzed(chunk_file, analysis) receives each saved analysis; with stream,
+# on_record(chunk_file, row) also receives each summary row as it arrives (possibly twice on a retry).
+# Returns True if the chunk was analyzed or was already complete.
+async def process_chunk(chunk_file, chunk_data, limiter, manifest=None, state=None, transport=None, output_root=".",
+                        stream=False, on_analyzed=None, on_record=None):
+    """Send one chunk of reviews to OpenAI and save the analysis"""
+    analyzed_dir = os.path.join(output_root, "analyzed-chunks")
+    output_file = os.path.join(analyzed_dir, f"analyzed_{chunk_file}")
+    chunk_id = chunk_fingerprint(chunk_data) if state is not None else None
+    
+    # Skip chunks a previous attempt already analyzed
+    if chunk_complete(chunk_file, chunk_data, state, output_root):
+        if manifest is not None:
+            mark_processed(chunk_data, manifest)
+        if on_analyzed is not None:
+            with open(output_file, 'r') as f:
+                on_analyzed(chunk_file, json.load(f))
+        return True
+
+    try:
+        async def analyze(reviews, model, attempt):
+            params, tokens = analysis_request(chunk_file, reviews, model)
+            invalid = []
             
-            chunk_text = "\n".join(reviews)
+            def check(item):
+                item_id, summary = check_summary(item, len(reviews))
+                # Hand each valid summary downstream as soon as it arrives
+                if on_record is not None:
+                    review = reviews[int(item_id) - 1]
+                    for row in analysis_rows(chunk_file, chunk_analysis([review], [analysis_record(review, summary)])):
+                        on_record(chunk_file, row)
             
-            print(f"Sending batch to OpenAI: {chunk_file}...")
-
-            # Wait for API response
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": chunk_text}
-                ]
+            # Wait for API response (served from the cache when these reviews were analyzed before); replies
+            # without any valid summary are not cached, so a retry is a fresh request
+            content = await cached_completion(
+                limited((transport or get_transport()).completion("analyze", chunk_file,
+                                                                  collect_invalid(check, invalid) if stream else None,
+                                                                  "reviews"),
+                        limiter, tokens, chunk_file),
+                validate=lambda content: parse_analysis_response(content, reviews),
+                **params
             )
-            # Changing this now.
-            if response.choices and response.choices[0].message.content:
-                # Clean markdown before saving
-                cleaned_content = clean_markdown(response.choices[0].message.content)
-                
-                analyzed_dir = "analyzed-chunks"
-                if not os.path.exists(analyzed_dir):
-                    os.makedirs(analyzed_dir)
-                    
-                output_file = os.path.join(analyzed_dir, f"analyzed_{chunk_file}")
-                with open(output_file, 'w') as f:
-                    json.dump({
-                        "response": cleaned_content,
-                    }, f, indent=2)
-            
-        except Exception as e:
-            print(f"Error processing {chunk_file}: {str(e)}")
-            continue
\ No newline at end of file
+            if not content:
+                raise ValueError("Empty response from OpenAI")
+            if invalid:
+                print(f"{len(invalid)} invalid summaries in the streamed reply for {chunk_file}: {invalid[0]}")
+            return parse_analysis_response(content, reviews)
+
+        results, unanswered = await run_cascade("analyze", chunk_data, analyze, chunk_file, MAX_ANALYSIS_ATTEMPTS)
+        if unanswered:
+            raise ValueError(f"{len(unanswered)} of {len(chunk_data)} reviews were not analyzed")
+        records = [results[i] for i in range(len(chunk_data))]
+
+        if not os.path.exists(analyzed_dir):
+            os.makedirs(analyzed_dir)
+
+        analysis = chunk_analysis(chunk_data, records)
+        with open(output_file, 'w') as f:
+            json.dump(analysis, f)
+
+        if manifest is not None:
+            mark_processed(chunk_data, manifest)
+
+        if state is not None:
+            state.mark_chunk(chunk_file, "complete", chunk_id)
+        if on_analyzed is not None:
+            on_analyzed(chunk_file, analysis)
+        return True
+
+    except Exception as e:
+        print(f"Error processing {chunk_file}: {str(e)}")
+        if state is not None:
+            state.mark_chunk(chunk_file, "failed", chunk_id, error=str(e))
+        return False
+
+
+async def submit_analysis_batch(batches, state=None, transport=None, output_root="."):
+    """Send the analysis requests of chunks not yet analyzed through the Batch API"""
+    requests = []
+    for chunk_file, chunk_data in batches:
+        if chunk_complete(chunk_file, chunk_data, state, output_root):
+            continue
+        try:
+            params, _ = analysis_request(chunk_file, chunk_data)
+        except PromptTooLargeError:
+            # Reported when the chunk is processed
+            continue
+        requests.append((params, lambda content, chunk_data=chunk_data: parse_analysis_response(content, chunk_data)))
+    await run_batch(requests, "analyze", os.path.join(output_root, BATCH_DIR), transport)
+
+
+# This function processes each chunk file and sends the reviews to the OpenAI API for analysis. The function returns the sentiment analysis for each review.
+# Chunks are pulled from batches ((chunk_name, reviews) pairs, by default the data-chunks files) by
+# max_concurrency workers under the limiter. Chunks complete in the pipeline state are skipped, and the
+# manifest is saved only if every chunk succeeded. With batch_api the chunks are first sent through the
+# Batch API and then processed from the cached replies. Returns the names of the chunks that failed.
+async def process_chunks(max_concurrency=8, requests_per_minute=None, tokens_per_minute=None, manifest=None,
+                         batches=None, state=None, transport=None, limiter=None, output_root=".", batch_api=False,
+                         stream=False, on_analyzed=None, on_record=None):
+    """Process each chunk file and send to OpenAI API"""
+    batches = iter(batches if batches is not None else iter_chunk_files(os.path.join(output_root, 'data-chunks')))
+    transport = transport or get_transport()
+
+    if batch_api:
+        batches = list(batches)
+        await submit_analysis_batch(batches, state, transport, output_root)
+        batches = iter(batches)
+
+    limiter = limiter or AdaptiveRateLimiter(
+        max_concurrency=max_concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute
+    )
+
+    failed_chunks = []
+
+    async def worker():
+        for chunk_file, chunk_data in batches:
+            if not await process_chunk(chunk_file, chunk_data, limiter, manifest, state, transport, output_root, stream,
+                                       on_analyzed, on_record):
+                failed_chunks.append(chunk_file)
+
+    await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+
+    if state is not None:
+        state.save()
+    if manifest is not None and not failed_chunks:
+        save_manifest(manifest)
+    if failed_chunks:
+        print(f"{len(failed_chunks)} chunks failed: {sorted(failed_chunks)}")
+
+    if limiter.rate_limited_count:
+        print(f"Rate limited {limiter.rate_limited_count} times; final concurrency {int(limiter.limit)}")
+
+    return sorted(failed_chunks)
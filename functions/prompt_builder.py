@@ -0,0 +1,55 @@
+import json
+from functions.token_budget import estimate_tokens, truncate_to_tokens
+from functions.telemetry import get_telemetry
+
+# Largest prompt each stage may send: the model's context window less room for the reply
+MAX_PROMPT_TOKENS = {"analyze": 100_000, "condense": 100_000, "journey": 7_000, "map": 100_000}
+# Tokens the chat format adds to every message on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+# Journey step descriptions are cut to this many tokens when sent for mapping
+MAX_STEP_DESCRIPTION_TOKENS = 40
+
+
+class PromptTooLargeError(ValueError):
+    """A prompt's estimated size exceeds the budget for its stage"""
+
+    def __init__(self, label, tokens, max_tokens):
+        super().__init__(f"Prompt for {label} is ~{tokens:,} tokens, over the {max_tokens:,} token budget")
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+
+
+def compact_json(value):
+    """Serialise a value as JSON without whitespace"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def compact_journey_steps(journey_steps, max_description_tokens=MAX_STEP_DESCRIPTION_TOKENS):
+    """Serialise journey steps with only their names and shortened descriptions"""
+    return compact_json([
+        {
+            "step_name": step["step_name"],
+            "description": truncate_to_tokens(str(step.get("description") or ""), max_description_tokens)
+        }
+        for step in journey_steps
+    ])
+
+
+def prompt_tokens(messages):
+    """Estimate the prompt tokens of a list of chat messages"""
+    return sum(estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+# Every stage builds its messages here. The estimated size is recorded in the run telemetry (next to the
+# usage the API reports) and prompts over the stage's budget are refused before anything is sent.
+def build_prompt(stage, label, system, *user_parts, max_tokens=None):
+    """Return (messages, estimated_tokens) for a system prompt and user messages"""
+    messages = [{"role": "system", "content": system}] + [{"role": "user", "content": part} for part in user_parts]
+    tokens = prompt_tokens(messages)
+
+    max_tokens = max_tokens or MAX_PROMPT_TOKENS.get(stage)
+    if max_tokens and tokens > max_tokens:
+        raise PromptTooLargeError(label, tokens, max_tokens)
+
+    get_telemetry().record_estimate(stage, tokens)
+    return messages, tokens
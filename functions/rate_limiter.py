@@ -0,0 +1,155 @@
+import asyncio
+import time
+import random
+import contextvars
+from collections import deque
+from contextlib import asynccontextmanager
+from openai import RateLimitError
+from functions.telemetry import attempt_kind
+
+# Length of the sliding window used for the per-minute request and token budgets
+WINDOW_SECONDS = 60
+# Number of times a request is retried after the API returns a 429
+MAX_RATE_LIMIT_RETRIES = 5
+# Cap on the delay between retries
+MAX_BACKOFF_SECONDS = 30
+
+# (limiter, tokens) of the request being sent by limited(), so a hedged duplicate can reserve its own slot
+_current_slot = contextvars.ContextVar("limiter_slot", default=None)
+
+
+# This class limits the number of OpenAI requests in flight. The limit is halved whenever
+# the API returns a 429 and grows back by about one slot per round of successful requests (AIMD).
+class AdaptiveRateLimiter:
+    """Bound in-flight requests with AIMD back-off and per-minute request/token budgets"""
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, requests_per_minute=None,
+                 tokens_per_minute=None, increase_step=1.0, decrease_factor=0.5):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = max(1, min(min_concurrency, max_concurrency))
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.rate_limited_count = 0
+        self._window = deque()  # (timestamp, tokens) for requests started in the last minute
+        self._window_tokens = 0
+        self._condition = asyncio.Condition()
+
+    def _expire_window(self, now):
+        while self._window and now - self._window[0][0] >= WINDOW_SECONDS:
+            _, tokens = self._window.popleft()
+            self._window_tokens -= tokens
+
+    def _budget_wait(self, tokens, now):
+        """Return seconds to wait before the per-minute budgets allow another request"""
+        self._expire_window(now)
+        if not self._window:
+            return 0
+
+        waits = []
+        if self.requests_per_minute and len(self._window) >= self.requests_per_minute:
+            waits.append(self._window[0][0] + WINDOW_SECONDS - now)
+
+        if self.tokens_per_minute and self._window_tokens + tokens > self.tokens_per_minute:
+            # Release the oldest entries until the new request fits the token budget
+            freed = self._window_tokens + tokens - self.tokens_per_minute
+            for started, used in self._window:
+                freed -= used
+                if freed <= 0:
+                    waits.append(started + WINDOW_SECONDS - now)
+                    break
+
+        return max(waits, default=0)
+
+    async def acquire(self, tokens=0):
+        """Wait for a free slot and enough per-minute budget, then reserve them"""
+        async with self._condition:
+            while True:
+                if self.in_flight < int(self.limit):
+                    wait = self._budget_wait(tokens, time.monotonic())
+                    if wait <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._condition.wait()
+
+            self._reserve(tokens)
+
+    async def try_acquire(self, tokens=0):
+        """Reserve a slot and per-minute budget if both are free right now, returning whether it did"""
+        async with self._condition:
+            if self.in_flight >= int(self.limit) or self._budget_wait(tokens, time.monotonic()) > 0:
+                return False
+            self._reserve(tokens)
+            return True
+
+    def _reserve(self, tokens):
+        self.in_flight += 1
+        self._window.append((time.monotonic(), tokens))
+        self._window_tokens += tokens
+
+    async def release(self, rate_limited=False):
+        """Free a slot and adjust the concurrency limit based on the outcome"""
+        async with self._condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.rate_limited_count += 1
+                self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + self.increase_step / max(1, int(self.limit)))
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self, tokens=0):
+        """Hold a request slot for the duration of the block"""
+        await self.acquire(tokens)
+        rate_limited = False
+        try:
+            yield
+        except Exception as e:
+            rate_limited = getattr(e, "status_code", None) == 429
+            raise
+        finally:
+            await self.release(rate_limited=rate_limited)
+
+
+def current_slot():
+    """Return (limiter, tokens) of the limited request being sent, or None outside limited()"""
+    return _current_slot.get()
+
+
+def backoff_delay(attempt, base=1.0, cap=MAX_BACKOFF_SECONDS):
+    """Return a jittered exponential delay so retried requests do not arrive in lockstep"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def limited(create, limiter, tokens, label):
+    """Wrap an API call so it runs inside a limiter slot and is retried on 429s"""
+    async def limited_create(**params):
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            try:
+                async with limiter.slot(tokens):
+                    print(f"Sending batch to OpenAI: {label}...")
+                    slot = _current_slot.set((limiter, tokens))
+                    try:
+                        with attempt_kind("retry" if attempt else None):
+                            return await create(**params)
+                    finally:
+                        _current_slot.reset(slot)
+            except RateLimitError:
+                if attempt == MAX_RATE_LIMIT_RETRIES:
+                    raise
+                delay = backoff_delay(attempt + 1)
+                print(f"Rate limited on {label}, retrying in {delay:.1f}s (concurrency now {int(limiter.limit)})")
+                await asyncio.sleep(delay)
+
+    return limited_create
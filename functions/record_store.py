@@ -0,0 +1,82 @@
+import json
+import pandas as pd
+
+# Parquet needs pyarrow; without it records are stored as line-delimited JSON
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+# One row per analyzed review. Rows for chunk replies that held no readable records keep the reply
+# text in analysis instead. reviewIds lists every review a row covers (for incremental mode).
+SUMMARY_COLUMNS = {
+    "chunk": "string",
+    "reviewId": "string",
+    "date": "string",
+    "rating": "Int64",
+    "title": "string",
+    "sentimentSummary": "string",
+    "count": "Int64",
+    "analysis": "string",
+    "reviewIds": "list"
+}
+# One row per review mapped to a journey step; count is the number of duplicate reviews it stands for
+MAPPED_COLUMNS = {
+    "reviewId": "string",
+    "step_name": "string",
+    "rating": "Int64",
+    "reviewDateOfExperience": "string",
+    "count": "Int64"
+}
+# Fields of a summary row that make up the review's analysis text
+ANALYSIS_FIELDS = ["reviewId", "date", "title", "rating", "sentimentSummary"]
+
+
+def _typed(value, column_type):
+    """Coerce a value to a column type, or None if it is missing or does not fit"""
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+    if column_type == "Int64":
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    if column_type == "string":
+        return str(value)
+    return list(value)
+
+
+def write_records(path_stem, records, columns):
+    """Write records with typed columns to path_stem.parquet (with pyarrow) or path_stem.jsonl, returning the path"""
+    rows = [{column: _typed(record.get(column), column_type) for column, column_type in columns.items()}
+            for record in records]
+
+    if PARQUET_AVAILABLE:
+        path = f"{path_stem}.parquet"
+        df = pd.DataFrame.from_records(rows, columns=list(columns))
+        df = df.astype({column: column_type for column, column_type in columns.items() if column_type != "list"})
+        df.to_parquet(path, index=False)
+        return path
+
+    path = f"{path_stem}.jsonl"
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + "\n")
+    return path
+
+
+def analysis_text(row, fields=ANALYSIS_FIELDS):
+    """Return the analysis text of a summary row, keeping only the given fields"""
+    if row.get("analysis"):
+        return row["analysis"]
+    return json.dumps({field: row.get(field) for field in fields if row.get(field) not in (None, "")},
+                      ensure_ascii=False, separators=(',', ':'))
+
+
+def analysis_texts(rows, fields=ANALYSIS_FIELDS):
+    """Join the analysis texts of summary rows into one text per source chunk"""
+    chunks = {}
+    for row in rows:
+        chunks.setdefault(row.get("chunk"), []).append(analysis_text(row, fields))
+    return ["\n".join(texts) for texts in chunks.values()]
@@ -0,0 +1,26 @@
+import os
+from functions.review_store import get_store
+from functions.plot_average_ratings import plot_average_ratings, plot_rating_trends
+
+# Dashboard charts are written here, one directory per company
+DASHBOARD_DIR = "dashboards"
+
+
+# This function renders the charts of many companies in one process without opening a browser. Every
+# chart is drawn from the review store's step rollups, so no mapped review is read, and the files keep
+# fixed names (dashboards/<company>/visualizations/ratings_by_step.html and rating_trends.html) so a
+# refresh replaces them in place.
+def render_dashboards(companies=None, output_root=DASHBOARD_DIR, image_format=None):
+    """Render the charts of the given companies (default: every company in the store), returning {company: error}"""
+    companies = companies or get_store().companies()
+    errors = {}
+    for company in companies:
+        company_root = os.path.join(output_root, company)
+        try:
+            plot_average_ratings(company_root, company=company, image_format=image_format, timestamped=False)
+            plot_rating_trends(company_root, company=company, image_format=image_format, timestamped=False)
+            errors[company] = None
+        except Exception as e:
+            print(f"Error rendering {company}: {str(e)}")
+            errors[company] = str(e)
+    return errors
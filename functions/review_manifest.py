@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+from functions.review_store import get_store, DEFAULT_COMPANY
+
+# Manifest file of runs from before the review store kept the processed fingerprints; load_manifest imports it once
+MANIFEST_DIR = "review-manifest"
+MANIFEST_FILE = os.path.join(MANIFEST_DIR, "processed_reviews.json")
+
+# Review fields that are sent to OpenAI; a change to any of them means the review is reprocessed
+FINGERPRINT_FIELDS = ['reviewDateOfExperience', 'reviewTitle', 'reviewRatingScore', 'reviewDescription']
+
+
+def review_key(review):
+    """Return the manifest key for a review"""
+    return review.get('reviewId') or review_fingerprint(review)
+
+
+def review_fingerprint(review):
+    """Hash the fields of a review that affect its analysis"""
+    if review.get('reviewFingerprint'):
+        return review['reviewFingerprint']
+    payload = json.dumps([review.get(field) for field in FINGERPRINT_FIELDS], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# The manifest of processed reviews is the processed column of the review store's reviews table, so the
+# export must be saved to the store (save_reviews) before it is loaded. The returned manifest collects the
+# reviews analyzed in this run, which save_manifest writes to the store.
+def load_manifest(company=DEFAULT_COMPANY, manifest_file=MANIFEST_FILE):
+    """Load the manifest of a company's processed reviews, importing a manifest file written before the store"""
+    store = get_store()
+    if os.path.exists(manifest_file) and not store.has_processed_reviews(company):
+        try:
+            with open(manifest_file, 'r') as f:
+                store.mark_processed(company, json.load(f)["reviews"])
+        except json.JSONDecodeError as e:
+            print(f"Error reading manifest {manifest_file}: {str(e)}")
+            raise
+        print(f"Imported manifest {manifest_file} into the review store")
+    return {"company": company, "reviews": {}}
+
+
+def save_manifest(manifest):
+    """Record the reviews processed in this run in the review store"""
+    get_store().mark_processed(manifest["company"], manifest["reviews"])
+
+
+def mark_processed(reviews, manifest):
+    """Record reviews as processed in the manifest, to be saved with save_manifest"""
+    for review in reviews:
+        manifest["reviews"][review_key(review)] = review_fingerprint(review)
+        # Duplicates collapsed into this review are covered by its analysis
+        manifest["reviews"].update(review.get('duplicateReviews', {}))
+
+
+def load_latest_analyses(company=DEFAULT_COMPANY):
+    """Load a company's latest summary rows from the review store"""
+    return get_store().analyses(company)
+
+
+# Reviews whose reviewId is new, or whose fingerprint changed since the last run, are reprocessed. They are
+# found with one query against the review store, which compares each review's fingerprint in the latest
+# export with the one it had when it was last analyzed.
+# Previous analyses (summary rows) covering a changed review are dropped, and the unchanged reviews they covered are
+# reprocessed with it, so the merged summary never contains a stale analysis.
+# Only keys are kept in memory, so reviews can be streamed from the raw export.
+def select_changed_keys(manifest, previous_analyses):
+    """Return the keys of reviews to send for analysis and the previous analyses to keep"""
+    changed_keys = get_store().changed_reviews(manifest["company"])
+
+    kept_analyses = []
+    for analysis in previous_analyses:
+        covered = set(analysis.get("reviewIds", []))
+        if covered and not covered & changed_keys:
+            kept_analyses.append(analysis)
+        else:
+            changed_keys |= covered
+
+    print(f"Incremental mode: {len(changed_keys):,} new or changed reviews, "
+          f"{len(kept_analyses):,} previous analyses kept")
+    return changed_keys, kept_analyses
+
+
+def select_reviews_to_process(reviews_data, manifest, previous_analyses):
+    """Return the reviews to send for analysis and the previous analyses to keep"""
+    changed_keys, kept_analyses = select_changed_keys(manifest, previous_analyses)
+    reviews_to_process = [review for review in reviews_data if review_key(review) in changed_keys]
+    return reviews_to_process, kept_analyses
@@ -0,0 +1,64 @@
+import math
+import hashlib
+from functions.review_manifest import review_key
+from functions.convert_date_format import convert_date_format
+
+# z value of a two-sided 95% confidence interval
+CONFIDENCE_Z = 1.96
+
+
+def review_stratum(review):
+    """Return the (rating, quarter of experience) stratum of a raw review"""
+    try:
+        date = convert_date_format(review['reviewDateOfExperience'])
+        quarter = f"{date[:4]}-Q{(int(date[5:7]) - 1) // 3 + 1}"
+    except (KeyError, TypeError, ValueError):
+        quarter = "unknown"
+    return str(review.get('reviewRatingScore')), quarter
+
+
+# Strata get sample places in proportion to their size (largest remainders first), and every stratum
+# gets at least one so rare ratings and quiet quarters are represented. Within a stratum reviews are
+# picked by a hash of their key, so the same reviews give the same sample on every run.
+def stratified_sample(reviews, sample_size):
+    """Return the keys of a sample of reviews spread over rating and date strata"""
+    strata = {}
+    for review in reviews:
+        key = review_key(review)
+        strata.setdefault(review_stratum(review), []).append((hashlib.sha256(key.encode('utf-8')).hexdigest(), key))
+
+    total = sum(len(members) for members in strata.values())
+    if total <= sample_size:
+        return {key for members in strata.values() for _, key in members}
+
+    quotas = {stratum: sample_size * len(members) / total for stratum, members in strata.items()}
+    allocation = {stratum: max(1, int(quota)) for stratum, quota in quotas.items()}
+    spare = sample_size - sum(allocation.values())
+    for stratum in sorted(quotas, key=lambda stratum: quotas[stratum] - int(quotas[stratum]), reverse=True)[:max(0, spare)]:
+        allocation[stratum] += 1
+
+    sample = set()
+    for stratum, members in strata.items():
+        sample.update(key for _, key in sorted(members)[:allocation[stratum]])
+    return sample
+
+
+def interval_width(count, variance, z=CONFIDENCE_Z):
+    """Return the width of the confidence interval of a mean, or infinity below two observations"""
+    if variance is None or count < 2:
+        return math.inf
+    return 2 * z * math.sqrt(variance / count)
+
+
+# step_ratings is {step_name: (mean rating, review count, rating variance)} as returned by
+# ReviewStore.step_ratings. Steps holding less than min_share of the mapped reviews are not required
+# to converge, since a rare step could otherwise need every review to be analyzed.
+def unconverged_steps(step_ratings, target_width, min_share=0.0):
+    """Return {step_name: interval width} for the steps whose interval is still wider than target_width"""
+    total = sum(count for _, count, _ in step_ratings.values())
+    widths = {}
+    for step_name, (_, count, variance) in step_ratings.items():
+        width = interval_width(count, variance)
+        if count >= min_share * total and width > target_width:
+            widths[step_name] = width
+    return widths
@@ -0,0 +1,378 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+from itertools import islice
+from functions.record_store import _typed, SUMMARY_COLUMNS, MAPPED_COLUMNS
+
+# The review store lives outside the directories that initialize_directories wipes; every company
+# (in single and batch mode) shares it, keyed by company
+STORE_DIR = "review-store"
+STORE_FILE = os.path.join(STORE_DIR, "reviews.db")
+# Company key used when a caller does not name one
+DEFAULT_COMPANY = "default"
+# Rows are upserted in transactions of this many
+UPSERT_BATCH_ROWS = 10_000
+
+# One row per raw review; reviewId is the manifest key (see review_key)
+REVIEW_COLUMNS = {
+    "reviewId": "string",
+    "date": "string",
+    "rating": "Int64",
+    "title": "string",
+    "fingerprint": "string"
+}
+SQL_TYPES = {"string": "TEXT", "Int64": "INTEGER", "list": "TEXT"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    company TEXT NOT NULL,
+    started TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    company TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    {reviews},
+    processed TEXT,
+    PRIMARY KEY (company, reviewId)
+);
+CREATE INDEX IF NOT EXISTS reviews_run ON reviews (company, run_id);
+CREATE INDEX IF NOT EXISTS reviews_date ON reviews (company, date);
+CREATE INDEX IF NOT EXISTS reviews_rating ON reviews (company, rating);
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY,
+    company TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    {analyses},
+    UNIQUE (company, reviewId)
+);
+CREATE INDEX IF NOT EXISTS analyses_run ON analyses (company, run_id);
+CREATE INDEX IF NOT EXISTS analyses_date ON analyses (company, date);
+CREATE INDEX IF NOT EXISTS analyses_rating ON analyses (company, rating);
+CREATE TABLE IF NOT EXISTS journey_steps (
+    company TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    step_number INTEGER NOT NULL,
+    step_name TEXT NOT NULL,
+    description TEXT,
+    PRIMARY KEY (company, run_id, step_number)
+);
+CREATE INDEX IF NOT EXISTS journey_steps_step ON journey_steps (company, step_name);
+CREATE TABLE IF NOT EXISTS journeys (
+    company TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    sketch TEXT,
+    prompt TEXT,
+    PRIMARY KEY (company, run_id)
+);
+CREATE TABLE IF NOT EXISTS mappings (
+    id INTEGER PRIMARY KEY,
+    company TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    {mappings},
+    UNIQUE (company, reviewId)
+);
+CREATE INDEX IF NOT EXISTS mappings_step ON mappings (company, run_id, step_name);
+CREATE INDEX IF NOT EXISTS mappings_date ON mappings (company, reviewDateOfExperience);
+CREATE INDEX IF NOT EXISTS mappings_rating ON mappings (company, rating);
+CREATE TABLE IF NOT EXISTS step_rollups (
+    company TEXT NOT NULL,
+    run_id INTEGER NOT NULL,
+    step_name TEXT NOT NULL,
+    week TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    squares INTEGER NOT NULL,
+    PRIMARY KEY (company, run_id, step_name, week)
+);
+CREATE TRIGGER IF NOT EXISTS mappings_rollup_insert AFTER INSERT ON mappings
+WHEN {new_counted} BEGIN
+    {add_new}
+END;
+CREATE TRIGGER IF NOT EXISTS mappings_rollup_update_old AFTER UPDATE ON mappings
+WHEN {old_counted} BEGIN
+    {remove_old}
+END;
+CREATE TRIGGER IF NOT EXISTS mappings_rollup_update_new AFTER UPDATE ON mappings
+WHEN {new_counted} BEGIN
+    {add_new}
+END;
+CREATE TRIGGER IF NOT EXISTS mappings_rollup_delete AFTER DELETE ON mappings
+WHEN {old_counted} BEGIN
+    {remove_old}
+END;
+"""
+
+# Mapped reviews count towards the rollups when they have a step and a 1-5 rating. Each review weighs
+# as many duplicates as it stands for; ratings are stored as -2 to +2 and weeks start on Monday
+# ('' when the date of experience is unknown).
+ROLLUP_COUNTED = "{row}.step_name IS NOT NULL AND {row}.rating BETWEEN 1 AND 5"
+ROLLUP_WEEK = "COALESCE(date({row}.reviewDateOfExperience, '-6 days', 'weekday 1'), '')"
+ROLLUP_WEIGHT = "COALESCE({row}.count, 1)"
+ROLLUP_ADD = """INSERT INTO step_rollups (company, run_id, step_name, week, count, total, squares)
+    VALUES (new.company, new.run_id, new.step_name, {week}, {weight}, (new.rating - 3) * {weight},
+            (new.rating - 3) * (new.rating - 3) * {weight})
+    ON CONFLICT (company, run_id, step_name, week) DO UPDATE SET
+        count = count + excluded.count, total = total + excluded.total, squares = squares + excluded.squares;"""
+ROLLUP_REMOVE = """UPDATE step_rollups SET count = count - {weight}, total = total - (old.rating - 3) * {weight},
+        squares = squares - (old.rating - 3) * (old.rating - 3) * {weight}
+    WHERE company = old.company AND run_id = old.run_id AND step_name = old.step_name AND week = {week};"""
+
+# Tables whose rows carry the run that last wrote them
+RUN_TABLES = ("reviews", "analyses", "journey_steps", "mappings")
+
+
+def _column_sql(columns):
+    return ",\n    ".join(f"{column} {SQL_TYPES[column_type]}" for column, column_type in columns.items())
+
+
+def _column_values(record, columns):
+    """Return a record's values in column order, with list columns encoded as JSON"""
+    values = []
+    for column, column_type in columns.items():
+        value = _typed(record.get(column), column_type)
+        values.append(json.dumps(value) if column_type == "list" and value is not None else value)
+    return values
+
+
+def _record(row, columns):
+    """Return a stored row as a record, decoding list columns"""
+    record = dict(row)
+    for column, column_type in columns.items():
+        if column_type == "list" and record.get(column) is not None:
+            record[column] = json.loads(record[column])
+    return record
+
+
+# This class keeps reviews, their analyses, journey steps and mappings in one SQLite database, so stages
+# find their inputs with indexed queries instead of scanning output directories for the newest file.
+# Every write is tagged with a run ID (one per company and process); the analyses, journey steps and
+# mappings a stage reads are the ones written by the company's latest run of the stage before it.
+# Each review row also keeps the fingerprint it had when it was last analyzed (processed), which is
+# the manifest incremental mode compares the latest export against.
+# Analyses and mappings are upserted by reviewId, so the tables hold one row per review however
+# many runs there have been. Triggers on the mappings table keep per company, run, step and week rating
+# rollups up to date as mappings are written, so charts read a few hundred aggregate rows instead of
+# grouping every mapped review.
+class ReviewStore:
+    """Indexed SQLite store of reviews, analyses, journey steps and mappings"""
+
+    def __init__(self, store_file=STORE_FILE):
+        self.store_file = store_file
+        if os.path.dirname(store_file):
+            os.makedirs(os.path.dirname(store_file), exist_ok=True)
+        self.conn = sqlite3.connect(store_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        has_rollups = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'step_rollups'"
+        ).fetchone()
+        self.conn.executescript(SCHEMA.format(
+            reviews=_column_sql(REVIEW_COLUMNS),
+            analyses=_column_sql(SUMMARY_COLUMNS),
+            mappings=_column_sql(MAPPED_COLUMNS),
+            new_counted=ROLLUP_COUNTED.format(row="new"),
+            old_counted=ROLLUP_COUNTED.format(row="old"),
+            add_new=ROLLUP_ADD.format(week=ROLLUP_WEEK.format(row="new"), weight=ROLLUP_WEIGHT.format(row="new")),
+            remove_old=ROLLUP_REMOVE.format(week=ROLLUP_WEEK.format(row="old"), weight=ROLLUP_WEIGHT.format(row="old"))
+        ))
+        if not has_rollups:
+            # Stores created before the rollups existed already hold mappings
+            self.rebuild_rollups()
+        if "processed" not in {row["name"] for row in self.conn.execute("PRAGMA table_info(reviews)")}:
+            # Stores created before the manifest moved into the reviews table
+            with self.conn:
+                self.conn.execute("ALTER TABLE reviews ADD COLUMN processed TEXT")
+        self.run_ids = {}
+
+    def run_id(self, company):
+        """Return this process's run ID for a company, starting a run on first use"""
+        if company not in self.run_ids:
+            with self.conn:
+                cursor = self.conn.execute(
+                    "INSERT INTO runs (company, started) VALUES (?, ?)",
+                    (company, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+            self.run_ids[company] = cursor.lastrowid
+        return self.run_ids[company]
+
+    def latest_run(self, table, company):
+        """Return the latest run that wrote a company's rows to a table, as (run_id, started), or None"""
+        if table not in RUN_TABLES:
+            raise ValueError(f"Unknown table: {table}")
+        row = self.conn.execute(
+            f"SELECT runs.run_id, runs.started FROM runs "
+            f"WHERE runs.run_id = (SELECT MAX(run_id) FROM {table} WHERE company = ?)",
+            (company,)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def _upsert(self, table, company, records, columns):
+        """Insert or replace a company's records by reviewId, in transactions of UPSERT_BATCH_ROWS"""
+        run_id = self.run_id(company)
+        names = ", ".join(["company", "run_id"] + list(columns))
+        updates = ", ".join(f"{column} = excluded.{column}" for column in ["run_id"] + list(columns))
+        sql = (f"INSERT INTO {table} ({names}) VALUES ({', '.join('?' * (len(columns) + 2))}) "
+               f"ON CONFLICT (company, reviewId) DO UPDATE SET {updates}")
+
+        records = iter(records)
+        count = 0
+        while True:
+            batch = [[company, run_id] + _column_values(record, columns)
+                     for record in islice(records, UPSERT_BATCH_ROWS)]
+            if not batch:
+                return count
+            with self.conn:
+                self.conn.executemany(sql, batch)
+            count += len(batch)
+
+    def _latest_rows(self, table, company, columns, where="", parameters=()):
+        """Return the rows of a table written by the company's latest run"""
+        return self.conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} "
+            f"WHERE company = ? AND run_id = (SELECT MAX(run_id) FROM {table} WHERE company = ?) {where}",
+            (company, company) + tuple(parameters)
+        ).fetchall()
+
+    def save_reviews(self, company, reviews):
+        """Upsert raw review rows (see REVIEW_COLUMNS) and return how many were written"""
+        return self._upsert("reviews", company, reviews, REVIEW_COLUMNS)
+
+    def changed_reviews(self, company):
+        """Return the reviewIds of a company's latest export that are new or changed since they were last analyzed"""
+        rows = self._latest_rows("reviews", company, ["reviewId"], "AND processed IS NOT fingerprint")
+        return {row["reviewId"] for row in rows}
+
+    def has_processed_reviews(self, company):
+        """Return whether any of a company's reviews has been analyzed"""
+        return self.conn.execute(
+            "SELECT 1 FROM reviews WHERE company = ? AND processed IS NOT NULL LIMIT 1", (company,)
+        ).fetchone() is not None
+
+    def mark_processed(self, company, fingerprints):
+        """Record {reviewId: fingerprint} pairs as analyzed, for reviews already in the store"""
+        fingerprints = iter(fingerprints.items())
+        while True:
+            batch = [(fingerprint, company, key) for key, fingerprint in islice(fingerprints, UPSERT_BATCH_ROWS)]
+            if not batch:
+                return
+            with self.conn:
+                self.conn.executemany("UPDATE reviews SET processed = ? WHERE company = ? AND reviewId = ?", batch)
+
+    def save_analyses(self, company, rows):
+        """Store a company's complete set of summary rows as its latest analyses"""
+        with self.conn:
+            # Rows without a reviewId (unreadable chunk replies) cannot be upserted, so earlier ones are dropped
+            self.conn.execute("DELETE FROM analyses WHERE company = ? AND reviewId IS NULL", (company,))
+        return self._upsert("analyses", company, rows, SUMMARY_COLUMNS)
+
+    def analyses(self, company, columns=None):
+        """Return the summary rows of a company's latest analyses, keeping only the given columns"""
+        columns = columns or list(SUMMARY_COLUMNS)
+        return [_record(row, SUMMARY_COLUMNS) for row in self._latest_rows("analyses", company, columns, "ORDER BY id")]
+
+    def save_journey_steps(self, company, journey_steps, sketch=None, prompt=None):
+        """Store journey steps, numbered in order, as a company's latest journey with the sketch and prompt behind it"""
+        run_id = self.run_id(company)
+        with self.conn:
+            self.conn.execute("DELETE FROM journey_steps WHERE company = ? AND run_id = ?", (company, run_id))
+            self.conn.executemany(
+                "INSERT INTO journey_steps (company, run_id, step_number, step_name, description) VALUES (?, ?, ?, ?, ?)",
+                [(company, run_id, i + 1, step["step_name"], step.get("description"))
+                 for i, step in enumerate(journey_steps)]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO journeys (company, run_id, sketch, prompt) VALUES (?, ?, ?, ?)",
+                (company, run_id, json.dumps(sketch) if sketch is not None else None, prompt)
+            )
+
+    def journey_steps(self, company):
+        """Return the steps of a company's latest journey, in step order"""
+        rows = self._latest_rows("journey_steps", company, ["step_number", "step_name", "description"],
+                                 "ORDER BY step_number")
+        return [dict(row) for row in rows]
+
+    def journey_basis(self, company):
+        """Return the corpus sketch and prompt fingerprint of a company's latest journey, or None"""
+        latest = self.latest_run("journey_steps", company)
+        row = latest and self.conn.execute(
+            "SELECT sketch, prompt FROM journeys WHERE company = ? AND run_id = ?", (company, latest[0])
+        ).fetchone()
+        if not row or row["sketch"] is None:
+            return None
+        return {"sketch": json.loads(row["sketch"]), "prompt": row["prompt"]}
+
+    def save_mappings(self, company, mapped_reviews):
+        """Store a company's complete set of mapped reviews as its latest mapping"""
+        with self.conn:
+            self.conn.execute("DELETE FROM mappings WHERE company = ? AND reviewId IS NULL", (company,))
+        return self._upsert("mappings", company, mapped_reviews, MAPPED_COLUMNS)
+
+    def rebuild_rollups(self):
+        """Recompute the step rollups of every company from the stored mappings"""
+        week, weight = ROLLUP_WEEK.format(row="mappings"), ROLLUP_WEIGHT.format(row="mappings")
+        with self.conn:
+            self.conn.execute("DELETE FROM step_rollups")
+            self.conn.execute(
+                f"INSERT INTO step_rollups (company, run_id, step_name, week, count, total, squares) "
+                f"SELECT company, run_id, step_name, {week}, SUM({weight}), SUM((rating - 3) * {weight}), "
+                f"SUM((rating - 3) * (rating - 3) * {weight}) FROM mappings "
+                f"WHERE {ROLLUP_COUNTED.format(row='mappings')} GROUP BY company, run_id, step_name, {week}"
+            )
+
+    def _rollups(self, company, columns, group_by):
+        """Return grouped step rollups of a company's latest mapping"""
+        return self.conn.execute(
+            f"SELECT {', '.join(columns)}, SUM(count) AS count, SUM(total) AS total, SUM(squares) AS squares "
+            f"FROM step_rollups WHERE company = ? AND run_id = (SELECT MAX(run_id) FROM mappings WHERE company = ?) "
+            f"GROUP BY {group_by} HAVING SUM(count) > 0 ORDER BY {group_by}",
+            (company, company)
+        ).fetchall()
+
+    def step_ratings(self, company):
+        """Return {step_name: (average rating from -2 to +2, review count, variance)} of a company's latest mapping"""
+        ratings = {}
+        for row in self._rollups(company, ["step_name"], "step_name"):
+            count, mean = row["count"], row["total"] / row["count"]
+            # Each review (and each duplicate it stands for) is one observation
+            variance = max(0.0, (row["squares"] - count * mean * mean) / (count - 1)) if count > 1 else None
+            ratings[row["step_name"]] = (mean, count, variance)
+        return ratings
+
+    def step_trends(self, company):
+        """Return {step_name: [(week start, average rating from -2 to +2, review count)]} of a company's latest mapping"""
+        trends = {}
+        for row in self._rollups(company, ["step_name", "week"], "step_name, week"):
+            if row["week"]:
+                trends.setdefault(row["step_name"], []).append((row["week"], row["total"] / row["count"], row["count"]))
+        return trends
+
+    def companies(self):
+        """Return the companies with mapped reviews"""
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT company FROM mappings ORDER BY company")]
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+
+_store = None
+
+
+def get_store():
+    """Return the shared review store, opening it on first use"""
+    global _store
+    if _store is None:
+        _store = ReviewStore()
+    return _store
+
+
+def configure_store(**kwargs):
+    """Replace the shared review store with one built from the given settings"""
+    global _store
+    if _store is not None:
+        _store.close()
+    _store = ReviewStore(**kwargs)
+    return _store
@@ -0,0 +1,112 @@
+import os
+import json
+import asyncio
+import hashlib
+from datetime import datetime
+
+# Pipeline state lives outside the directories that initialize_directories wipes
+STATE_DIR = "pipeline-state"
+STATE_FILE = os.path.join(STATE_DIR, "state.json")
+# Save chunk progress after this many chunk updates
+SAVE_EVERY_CHUNKS = 20
+
+
+def fingerprint(*parts):
+    """Hash any JSON-serialisable values into a stable fingerprint"""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(path):
+    """Fingerprint a file by path, size and modification time, or None if it does not exist"""
+    if not path or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return fingerprint(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+# This class records which stages and chunks of a run have completed, together with a fingerprint of
+# their inputs, so an interrupted run can resume from the first incomplete unit.
+class PipelineState:
+    """Persistent per-stage and per-chunk completion state"""
+
+    def __init__(self, state_file=STATE_FILE):
+        self.state_file = state_file
+        self._unsaved = 0
+        self.data = {"stages": {}, "chunks": {}}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.data = json.load(f)
+
+    def save(self):
+        """Write the state to disk"""
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        self.data["updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+        self._unsaved = 0
+
+    def reset(self):
+        """Forget all recorded progress"""
+        self.data = {"stages": {}, "chunks": {}}
+        self.save()
+
+    def stage_complete(self, name, stage_fingerprint):
+        """Return True if the stage completed with the same input fingerprint"""
+        stage = self.data["stages"].get(name, {})
+        return stage.get("status") == "complete" and stage.get("fingerprint") == stage_fingerprint
+
+    def mark_stage(self, name, status, stage_fingerprint=None, error=None):
+        """Record the status of a stage"""
+        self.data["stages"][name] = {
+            "status": status,
+            "fingerprint": stage_fingerprint,
+            "error": error,
+            "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        self.save()
+
+    def chunk_complete(self, name, chunk_fingerprint):
+        """Return True if the chunk was analyzed with the same input fingerprint"""
+        chunk = self.data["chunks"].get(name, {})
+        return chunk.get("status") == "complete" and chunk.get("fingerprint") == chunk_fingerprint
+
+    def mark_chunk(self, name, status, chunk_fingerprint, error=None):
+        """Record the status of a chunk, saving every few updates"""
+        self.data["chunks"][name] = {"status": status, "fingerprint": chunk_fingerprint, "error": error}
+        self._unsaved += 1
+        if self._unsaved >= SAVE_EVERY_CHUNKS:
+            self.save()
+
+    def failed_chunks(self):
+        """Return the names of chunks whose last attempt failed"""
+        return sorted(name for name, chunk in self.data["chunks"].items() if chunk["status"] == "failed")
+
+
+# Each stage is a (name, run, input_fingerprint) tuple. The fingerprint function is called just before
+# the stage would run, after earlier stages have written their outputs. With resume, stages that
+# completed with the same fingerprint are skipped; with only, just the named stage runs.
+async def run_stages(stages, state, resume=False, only=None):
+    """Run pipeline stages in order, recording completion in the pipeline state"""
+    for name, run, input_fingerprint in stages:
+        if only and name != only:
+            continue
+
+        stage_fingerprint = input_fingerprint()
+        if resume and not only and state.stage_complete(name, stage_fingerprint):
+            print(f"\nSkipping stage '{name}': already complete for these inputs")
+            continue
+
+        print(f"\nRunning stage '{name}' at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        state.mark_stage(name, "running", stage_fingerprint)
+        try:
+            result = run()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            state.mark_stage(name, "failed", stage_fingerprint, error=str(e))
+            raise
+
+        state.mark_stage(name, "complete", stage_fingerprint)
@@ -0,0 +1,58 @@
+import json
+
+# Number of characters read from the raw export at a time
+READ_SIZE = 1024 * 1024
+
+
+# This function parses the top-level JSON array of a raw Trustpilot export one review at a time,
+# so memory use depends on the size of a single review rather than the size of the file.
+def iter_reviews(input_file, read_size=READ_SIZE):
+    """Yield reviews one by one from a raw JSON export without loading the whole file"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+
+    with open(input_file, 'r', encoding='utf-8') as f:
+        while True:
+            # Skip whitespace and separators between elements
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+
+            if pos >= len(buffer):
+                if eof:
+                    raise ValueError(f"Unexpected end of file in {input_file}")
+                buffer = f.read(read_size)
+                pos = 0
+                eof = not buffer
+                continue
+
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f"Expected a JSON array of reviews in {input_file}")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == ']':
+                return
+
+            try:
+                review, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                end = None
+
+            # An element that runs to the end of the buffer may be incomplete, so read more first
+            if end is None or (end == len(buffer) and not eof):
+                if eof:
+                    raise ValueError(f"Invalid review JSON near character {pos} in {input_file}")
+                more = f.read(read_size)
+                eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+
+            yield review
+            pos = end
+
@@ -0,0 +1,116 @@
+import json
+from types import SimpleNamespace
+
+
+# This class reads a JSON object as it streams in and returns each object element of one of its
+# top-level arrays (e.g. "reviews") as soon as the element's closing brace arrives. Only the element
+# being read is buffered. A reply that does not start with an object, or an element that is not valid
+# JSON, raises ValueError so the caller can abort the stream early.
+class JsonArrayParser:
+    """Incremental parser for the elements of one array in a streamed JSON object"""
+
+    def __init__(self, array_key):
+        self.array_key = array_key
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.key = None
+        self.last_key = None
+        self.in_array = False
+        self.element = None
+
+    def feed(self, text):
+        """Consume the next piece of the reply and return the elements it completed"""
+        elements = []
+        for char in text:
+            if self.element is not None:
+                self.element.append(char)
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.key is not None:
+                        self.last_key = "".join(self.key)
+                        self.key = None
+                elif self.key is not None:
+                    self.key.append(char)
+                continue
+
+            if not self.started:
+                if char.isspace():
+                    continue
+                if char != '{':
+                    raise ValueError("Reply is not a JSON object")
+                self.started = True
+
+            if char == '"':
+                self.in_string = True
+                # Strings directly inside the top-level object are keys (or values, which are never followed by '[')
+                if self.depth == 1:
+                    self.key = []
+            elif char in '{[':
+                if self.depth == 1 and char == '[' and self.last_key == self.array_key:
+                    self.in_array = True
+                elif self.in_array and self.depth == 2 and char == '{':
+                    self.element = [char]
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth < 0:
+                    raise ValueError("Unbalanced brackets in reply")
+                if self.in_array and self.depth == 2 and self.element is not None:
+                    elements.append(json.loads("".join(self.element)))
+                    self.element = None
+                elif self.in_array and self.depth == 1:
+                    self.in_array = False
+        return elements
+
+
+# Element checks of the model cascade validate items one at a time: an element the check rejects (an
+# unknown id, an empty answer) is collected in invalid and left for the next model tier, so one bad item
+# does not abandon the rest of the reply. Replies that are not JSON objects, or elements that are not
+# valid JSON, still abort the stream (see JsonArrayParser).
+def collect_invalid(check, invalid):
+    """Wrap an element check so the elements it rejects are collected instead of aborting the stream"""
+    def on_element(element):
+        try:
+            check(element)
+        except ValueError as e:
+            invalid.append(str(e))
+    return on_element
+
+
+# The wrapped call asks for a streamed reply and feeds it through a JsonArrayParser, handing each
+# completed element to on_element, which raises ValueError to abort on malformed output. It returns
+# an object shaped like a chat completion (content and usage), so cached_completion, telemetry and
+# retries treat it like any other call; the reply text is still assembled because the cache stores it.
+# on_element is where results leave the stream early (e.g. process_chunk's on_record), and must tolerate
+# seeing an element again when a request is retried.
+def streamed(create, on_element, array_key):
+    """Wrap a chat completion call so the reply is streamed and parsed as it arrives"""
+    async def streamed_create(**params):
+        parser = JsonArrayParser(array_key)
+        parts = []
+        usage = None
+        stream = await create(stream=True, stream_options={"include_usage": True}, **params)
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    for element in parser.feed(delta):
+                        on_element(element)
+        finally:
+            await stream.close()
+
+        message = SimpleNamespace(content="".join(parts))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    return streamed_create
@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import math
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+
+# Run summaries live outside the directories that initialize_directories wipes
+TELEMETRY_DIR = "telemetry"
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+# USD per million (prompt, completion) tokens, used for cost estimates only
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o-2024-08-06": (2.50, 10.00),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4": (30.00, 60.00)
+}
+# Batch API requests are billed at this fraction of the synchronous prices
+BATCH_PRICE_FACTOR = 0.5
+
+# Company whose pipeline is running in the current task, set by batch mode
+_company = contextvars.ContextVar("telemetry_company", default=None)
+# Why the API attempts in the current task are made: "first", "retry", "escalation" or "hedge"
+_attempt_kind = contextvars.ContextVar("telemetry_attempt_kind", default="first")
+
+
+def set_company(name):
+    """Record subsequent API calls in this task (and tasks it starts) against a company"""
+    _company.set(name)
+
+
+# Callers that send a request again mark the attempts they make: transient and rate limit retries as
+# "retry", the model cascade's later tiers as "escalation", duplicate requests as "hedge". The innermost
+# mark wins, so a retry of an escalated request counts as a retry.
+@contextmanager
+def attempt_kind(kind):
+    """Record the API attempts made in the block as kind; None keeps the enclosing kind"""
+    token = _attempt_kind.set(kind) if kind else None
+    try:
+        yield
+    finally:
+        if token is not None:
+            _attempt_kind.reset(token)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, batch=False):
+    """Return the estimated USD cost of a request (at the Batch API discount with batch), or 0 for unknown models"""
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0, 0))
+    cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+    return cost * BATCH_PRICE_FACTOR if batch else cost
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# This class records one entry per API attempt: the stage and chunk it belongs to, the model, its
+# latency, token usage from response.usage, whether it failed or was rate limited, and its kind (see
+# attempt_kind), so retries, cascade escalations and hedged duplicates are counted apart in the summary.
+class Telemetry:
+    """Per-call latency, token usage and cost records grouped by stage and chunk"""
+
+    def __init__(self):
+        self.started = datetime.now()
+        self.records = []
+        # {stage: [prompts built, estimated prompt tokens]}, recorded before each request is sent
+        self.estimates = {}
+        # {stage: counts of items sent through the model cascade}, see record_cascade
+        self.cascades = {}
+
+    def record(self, stage, label, model, status, latency_seconds, prompt_tokens=0, completion_tokens=0, batch=False):
+        """Record the outcome of one API attempt (batch for requests sent through the Batch API)"""
+        self.records.append({
+            "company": _company.get(),
+            "stage": stage,
+            "label": label,
+            "model": model,
+            "status": status,
+            "kind": _attempt_kind.get(),
+            "latency_seconds": latency_seconds,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "batch": batch
+        })
+
+    def record_estimate(self, stage, tokens):
+        """Record the estimated size of a prompt built for a stage"""
+        estimate = self.estimates.setdefault(stage, [0, 0])
+        estimate[0] += 1
+        estimate[1] += tokens
+
+    def record_cascade(self, stage, items, escalated, answered_by, unanswered):
+        """Record how the items of one request were answered by a stage's model tiers"""
+        cascade = self.cascades.setdefault(stage, {"items": 0, "escalated": 0, "answered_by": {}, "unanswered": 0})
+        cascade["items"] += items
+        cascade["escalated"] += escalated
+        cascade["unanswered"] += unanswered
+        for model, count in answered_by.items():
+            cascade["answered_by"][model] = cascade["answered_by"].get(model, 0) + count
+
+    def summary(self):
+        """Return totals, latency histograms and cost per stage, with per-chunk totals"""
+        stages = {}
+        companies = {}
+        for record in self.records:
+            stage = stages.setdefault(record["stage"], {
+                "requests": 0, "errors": 0, "rate_limited": 0, "retries": 0, "escalations": 0, "hedges": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0,
+                "models": {}, "latencies": [], "chunks": {}
+            })
+            chunk = stage["chunks"].setdefault(record["label"], {
+                "attempts": 0, "latency_seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0
+            })
+
+            stage["requests"] += 1
+            stage["errors"] += record["status"] == "error"
+            stage["rate_limited"] += record["status"] == "rate_limited"
+            kind = record.get("kind", "first")
+            stage["retries"] += kind == "retry"
+            stage["escalations"] += kind == "escalation"
+            stage["hedges"] += kind == "hedge"
+            stage["prompt_tokens"] += record["prompt_tokens"]
+            stage["completion_tokens"] += record["completion_tokens"]
+            cost = estimate_cost(record["model"], record["prompt_tokens"], record["completion_tokens"],
+                                 record.get("batch", False))
+            stage["cost_usd"] += cost
+            stage["models"][record["model"]] = stage["models"].get(record["model"], 0) + 1
+            stage["latencies"].append(record["latency_seconds"])
+
+            chunk["attempts"] += 1
+            chunk["latency_seconds"] = round(chunk["latency_seconds"] + record["latency_seconds"], 3)
+            chunk["prompt_tokens"] += record["prompt_tokens"]
+            chunk["completion_tokens"] += record["completion_tokens"]
+
+            if record["company"] is not None:
+                company = companies.setdefault(record["company"], {
+                    "requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0
+                })
+                company["requests"] += 1
+                company["prompt_tokens"] += record["prompt_tokens"]
+                company["completion_tokens"] += record["completion_tokens"]
+                company["cost_usd"] += cost
+
+        for stage in stages.values():
+            latencies = stage.pop("latencies")
+            stage["cost_usd"] = round(stage["cost_usd"], 4)
+            stage["latency_seconds"] = {
+                "total": round(sum(latencies), 3),
+                "mean": round(sum(latencies) / len(latencies), 3),
+                "p50": round(_percentile(latencies, 0.5), 3),
+                "p95": round(_percentile(latencies, 0.95), 3),
+                "max": round(max(latencies), 3),
+                "histogram": {
+                    ("+Inf" if bound == math.inf else str(bound)): sum(latency <= bound for latency in latencies)
+                    for bound in LATENCY_BUCKETS
+                }
+            }
+
+        for company in companies.values():
+            company["cost_usd"] = round(company["cost_usd"], 4)
+
+        return {
+            "started": self.started.strftime("%Y-%m-%d %H:%M:%S"),
+            "finished": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "requests": len(self.records),
+            "prompt_tokens": sum(stage["prompt_tokens"] for stage in stages.values()),
+            "completion_tokens": sum(stage["completion_tokens"] for stage in stages.values()),
+            "cost_usd": round(sum(stage["cost_usd"] for stage in stages.values()), 4),
+            "stages": stages,
+            "companies": companies,
+            # Cached replies are built but never sent, so these can exceed the reported usage
+            "prompt_estimates": {
+                stage: {"prompts": prompts, "estimated_tokens": tokens}
+                for stage, (prompts, tokens) in self.estimates.items()
+            },
+            # Items that needed a stronger model than the first tier of their stage
+            "cascade": {
+                stage: dict(cascade, escalation_rate=round(cascade["escalated"] / cascade["items"], 4) if cascade["items"] else 0.0)
+                for stage, cascade in self.cascades.items()
+            }
+        }
+
+    def write_summary(self, output_dir=TELEMETRY_DIR):
+        """Write the run summary JSON and return its path"""
+        os.makedirs(output_dir, exist_ok=True)
+        output_file = os.path.join(output_dir, f"run_summary_{self.started.strftime('%Y%m%d_%H%M%S')}.json")
+        with open(output_file, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        return output_file
+
+    def write_prometheus(self, path):
+        """Write the per-stage metrics in the Prometheus textfile collector format"""
+        lines = [
+            "# HELP llm_requests_total LLM API attempts by stage and status.",
+            "# TYPE llm_requests_total counter"
+        ]
+        counts = {}
+        for record in self.records:
+            key = (record["stage"], record["model"], record["status"])
+            counts[key] = counts.get(key, 0) + 1
+        for (stage, model, status), count in sorted(counts.items()):
+            lines.append(f'llm_requests_total{{stage="{stage}",model="{model}",status="{status}"}} {count}')
+
+        summary = self.summary()
+        stages = summary["stages"]
+        lines += ["# HELP llm_tokens_total Tokens used by stage and kind.", "# TYPE llm_tokens_total counter"]
+        for name, stage in sorted(stages.items()):
+            lines.append(f'llm_tokens_total{{stage="{name}",kind="prompt"}} {stage["prompt_tokens"]}')
+            lines.append(f'llm_tokens_total{{stage="{name}",kind="completion"}} {stage["completion_tokens"]}')
+
+        lines += ["# HELP llm_cost_usd_total Estimated cost by stage.", "# TYPE llm_cost_usd_total counter"]
+        for name, stage in sorted(stages.items()):
+            lines.append(f'llm_cost_usd_total{{stage="{name}"}} {stage["cost_usd"]}')
+
+        companies = summary["companies"]
+        if companies:
+            lines += ["# HELP llm_company_cost_usd_total Estimated cost by company.", "# TYPE llm_company_cost_usd_total counter"]
+            for name, company in sorted(companies.items()):
+                lines.append(f'llm_company_cost_usd_total{{company="{name}"}} {company["cost_usd"]}')
+
+        if summary["cascade"]:
+            lines += ["# HELP llm_cascade_escalation_rate Share of items sent past a stage's first model.",
+                      "# TYPE llm_cascade_escalation_rate gauge"]
+            for name, cascade in sorted(summary["cascade"].items()):
+                lines.append(f'llm_cascade_escalation_rate{{stage="{name}"}} {cascade["escalation_rate"]}')
+
+        lines += ["# HELP llm_request_latency_seconds LLM API attempt latency.", "# TYPE llm_request_latency_seconds histogram"]
+        for name, stage in sorted(stages.items()):
+            for bound, count in stage["latency_seconds"]["histogram"].items():
+                lines.append(f'llm_request_latency_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'llm_request_latency_seconds_sum{{stage="{name}"}} {stage["latency_seconds"]["total"]}')
+            lines.append(f'llm_request_latency_seconds_count{{stage="{name}"}} {stage["requests"]}')
+
+        # Write then rename so the node exporter never reads a partial file
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+_telemetry = Telemetry()
+
+
+def get_telemetry():
+    """Return the shared telemetry recorder"""
+    return _telemetry
+
+
+def configure_telemetry():
+    """Replace the shared telemetry recorder with an empty one"""
+    global _telemetry
+    _telemetry = Telemetry()
+    return _telemetry
+
+
+# Stages wrap the raw client call with this, inside limited(), so every attempt (including ones
+# that are rate limited and retried) is timed and recorded against its stage and chunk.
+def instrumented(create, stage, label):
+    """Wrap an API call so its latency and token usage are recorded"""
+    async def instrumented_create(**params):
+        started = time.perf_counter()
+        try:
+            response = await create(**params)
+        except Exception as e:
+            status = "rate_limited" if getattr(e, "status_code", None) == 429 else "error"
+            get_telemetry().record(stage, label, params.get("model"), status, time.perf_counter() - started)
+            raise
+
+        usage = getattr(response, "usage", None)
+        get_telemetry().record(
+            stage, label, params.get("model"), "ok", time.perf_counter() - started,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0
+        )
+        return response
+
+    return instrumented_create
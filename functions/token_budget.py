@@ -0,0 +1,92 @@
+from itertools import islice
+from functions.review_manifest import review_fingerprint
+
+# tiktoken gives exact counts when installed; otherwise fall back to ~4 characters per token
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARKER = " [truncated]"
+
+
+def estimate_tokens(text):
+    """Estimate the number of tokens in a piece of text"""
+    if _encoding is not None:
+        return max(1, len(_encoding.encode(text, disallowed_special=())))
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to roughly max_tokens tokens"""
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        return _encoding.decode(tokens[:max_tokens]) + TRUNCATION_MARKER
+    return text[:max_tokens * CHARS_PER_TOKEN] + TRUNCATION_MARKER
+
+
+def group_by_tokens(texts, token_budget):
+    """Split texts into consecutive groups whose combined tokens fit token_budget"""
+    groups = []
+    group = []
+    group_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if group and group_tokens + tokens > token_budget:
+            groups.append(group)
+            group = []
+            group_tokens = 0
+        group.append(truncate_to_tokens(text, token_budget))
+        group_tokens += min(tokens, token_budget)
+    if group:
+        groups.append(group)
+    return groups
+
+
+def fit_review(review, max_review_tokens, format_review):
+    """Truncate a review's description so the formatted review fits max_review_tokens"""
+    if estimate_tokens(format_review(review)) <= max_review_tokens:
+        return review
+    overhead = estimate_tokens(format_review({**review, 'reviewDescription': ''}))
+    description = str(review.get('reviewDescription') or '')
+    return {
+        **review,
+        'reviewDescription': truncate_to_tokens(description, max_review_tokens - overhead),
+        # Keep the fingerprint of the full review so incremental mode does not see it as changed
+        'reviewFingerprint': review_fingerprint(review)
+    }
+
+
+# This function packs reviews into batches that fill a prompt token budget, so short reviews share a
+# request and long ones get one to themselves. Reviews longer than max_review_tokens are truncated.
+def pack_reviews(reviews, token_budget, max_review_tokens, format_review):
+    """Yield lists of reviews whose formatted text fits within token_budget"""
+    max_review_tokens = min(max_review_tokens, token_budget)
+    batch = []
+    batch_tokens = 0
+
+    for review in reviews:
+        review = fit_review(review, max_review_tokens, format_review)
+        tokens = estimate_tokens(format_review(review))
+        if batch and batch_tokens + tokens > token_budget:
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(review)
+        batch_tokens += tokens
+
+    if batch:
+        yield batch
+
+
+def iter_token_batches(reviews, base_name, token_budget, max_review_tokens, format_review, max_batches=None):
+    """Yield (chunk_name, reviews) pairs for process_chunks, packed to a token budget"""
+    batches = enumerate(pack_reviews(reviews, token_budget, max_review_tokens, format_review), start=1)
+    for chunk_number, batch in islice(batches, max_batches):
+        yield f"{base_name}_chunk_{chunk_number}.json", batch
@@ -1,28 +1,93 @@
 import pandas as pd
 import os
-from openai import OpenAI
 from datetime import datetime
 import json
 import asyncio
+import argparse
+from itertools import chain
 from dotenv import load_dotenv
-from functions import get_input_file, process_chunks, initialize_directories, generate_journey_steps, map_reviews_to_journey, plot_average_ratings
+from functions.review_manifest import MANIFEST_FILE, review_fingerprint
+from functions.stage_runner import STATE_FILE
+from functions.process_chunks import iter_chunk_files
+from functions.map_reviews_to_journey import map_rows, save_mapped_reviews
+from functions.convert_date_format import convert_date_format
+from functions.review_sampling import stratified_sample, unconverged_steps
+from functions.pipelined_mapping import PipelinedMapper, split_sample_batches
+from functions.review_store import get_store
+from functions.company_batches import company_namespace
+from functions.model_cascade import configure_cascade
+from functions.plot_average_ratings import plot_rating_trends
+from functions.render_dashboards import render_dashboards, DASHBOARD_DIR
+from functions import get_input_file, get_input_files, plan_company_runs, run_companies, AdaptiveRateLimiter, process_chunks, initialize_directories, generate_journey_steps, map_reviews_to_journey, plot_average_ratings, configure_cache, load_manifest, load_latest_analyses, select_reviews_to_process, select_changed_keys, review_key, iter_reviews, iter_token_batches, format_review, find_duplicate_groups, iter_representatives, PipelineState, run_stages, fingerprint, file_fingerprint, get_telemetry, set_company, configure_transport, analysis_rows, write_records, SUMMARY_COLUMNS
 
-# Set chunk size
-NUM_REVIEWS_PER_CHUNK = 10
-# Set number of chunks to process
-NUM_CHUNKS = 9
+# Set the prompt token budget for each chunk of reviews
+CHUNK_TOKEN_BUDGET = 4000
+# Set the maximum tokens for a single review; longer descriptions are truncated
+MAX_REVIEW_TOKENS = 1000
+# Set maximum number of OpenAI requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+# Set OpenAI per-minute budgets (None means no limit)
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 200000
+# Reuse cached OpenAI responses for prompts that were sent in previous runs
+USE_LLM_CACHE = True
+# Only process reviews that are new or changed since the previous run, and merge them into its output
+INCREMENTAL = False
+# Stream reviews straight from the raw export instead of writing data-chunks files
+STREAM_INPUT = True
+# Map reviews to journey steps with the local classifier first; only low-confidence reviews (and a held-out
+# sample that checks the classifier against the LLM) go to the LLM
+USE_LOCAL_CLASSIFIER = True
+# Analyze one review per group of exact or near-duplicate reviews and weight its result by the group size
+DEDUPLICATE = True
+# Reuse the company's previous journey steps while its reviews drift at most this much (0 to 1, as 1 minus the
+# cosine similarity of term frequencies) from the reviews the steps came from; None always generates new steps
+JOURNEY_DRIFT_THRESHOLD = 0.2
+# Stream analyze and map replies and check each record as it arrives, abandoning malformed replies early; in
+# pipelined mode each summary is queued for mapping as soon as it arrives
+STREAM_COMPLETIONS = False
+# Models tried for each stage, cheapest first, replacing the defaults in functions/model_cascade.py; only
+# reviews (or journeys) that fail validation are sent again to the next model, e.g. {"map": ["gpt-4o-mini"]}
+MODEL_TIERS = {}
+# Send a duplicate request when one has not answered after this many seconds (None disables hedging)
+HEDGE_AFTER_SECONDS = None
+# Also write per-stage LLM metrics to this Prometheus textfile (None to skip), e.g. for the node exporter
+PROMETHEUS_TEXTFILE = None
+# Number of reviews in the stratified sample (by rating and quarter) that journey steps come from in
+# pipelined mode (--pipelined)
+PIPELINE_SAMPLE_SIZE = 500
+# Sampling mode (--sample) analyzes growing stratified samples (by rating and quarter) of the reviews, starting
+# with SAMPLE_START_SIZE and growing by SAMPLE_GROWTH_FACTOR, until the 95% confidence interval of the average
+# rating (-2 to +2) of every step holding at least SAMPLE_MIN_STEP_SHARE of the reviews is at most
+# SAMPLE_TARGET_CI_WIDTH wide, or SAMPLE_MAX_SIZE (None for no limit) reviews have been analyzed
+SAMPLE_START_SIZE = 500
+SAMPLE_GROWTH_FACTOR = 2
+SAMPLE_TARGET_CI_WIDTH = 0.5
+SAMPLE_MIN_STEP_SHARE = 0.02
+SAMPLE_MAX_SIZE = None
+# Also save each chart as a static image in this format ("png", "svg" or "pdf"; needs kaleido), or None for HTML only
+IMAGE_FORMAT = None
+# Number of companies processed at once in batch mode (--all-companies); they share one rate budget
+MAX_PARALLEL_COMPANIES = 4
+
+# Names of the pipeline stages, in the order they run
+STAGE_NAMES = ['analyze', 'compile', 'journey', 'map', 'plot']
+# Stages of pipelined and sampling modes, where the analyze stage also derives the journey steps and maps the reviews
+PIPELINED_STAGE_NAMES = ['analyze', 'compile', 'plot']
+# Previous analyses kept by incremental mode, merged in by compile_analyzed_files
+PREVIOUS_ANALYSES_FILE = os.path.join("analyzed-chunks", "previous_analyses.json")
 
 # Load environment variables
 load_dotenv()
 
-# Loads the raw source data from the input file and returns it as a list of dictionaries.
-input_file, base_name = get_input_file()
+# Set up the OpenAI response cache shared by all stages
+llm_cache = configure_cache(enabled=USE_LLM_CACHE)
 
-# Get base name from input file
-base_name = os.path.splitext(os.path.basename(input_file))[0]
+# Set up the per-stage model tiers shared by all stages
+configure_cascade(MODEL_TIERS)
 
-# This function deletes and recreates the working directories to ensure a clean start
-initialize_directories()
+# Set up the pooled OpenAI client shared by all stages
+transport = configure_transport(hedge_after=HEDGE_AFTER_SECONDS)
 
 # Load and validate JSON data
 def load_json_data(input_file):
@@ -35,8 +100,7 @@ def load_json_data(input_file):
             reviews_data = json.load(f)
             
         print(f"Successfully loaded {len(reviews_data):,} reviews")
-        print(f"Processing {NUM_CHUNKS:,} batches of {NUM_REVIEWS_PER_CHUNK:,} reviews each")
-        print(f"Total reviews to process: {NUM_CHUNKS * NUM_REVIEWS_PER_CHUNK:,}")
+        print(f"Packing reviews into batches of up to {CHUNK_TOKEN_BUDGET:,} tokens each")
         return reviews_data
                 
     except json.JSONDecodeError as e:
@@ -46,99 +110,528 @@ def load_json_data(input_file):
         print(f"Error loading file: {str(e)}")
         raise
 
-# Usage in main:
-reviews_data = load_json_data(input_file)
+# reviews is called for a fresh iterable of the reviews each time they are read.
+def sample_first(reviews, base_name, sample_keys=None):
+    """Return (base_name, reviews) groups with any sampled reviews first, under their own chunk names"""
+    if sample_keys is None:
+        return [(base_name, reviews())]
+    return [
+        (f"{base_name}_sample", (review for review in reviews() if review_key(review) in sample_keys)),
+        (base_name, (review for review in reviews() if review_key(review) not in sample_keys))
+    ]
 
-def create_chunk_filename(chunk_number, base_name):
-    """Create a filename for a chunk of reviews"""
-    output_dir = "data-chunks"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    filename = f"{base_name}_chunk_{chunk_number}.json"
-    return os.path.join(output_dir, filename)
+def review_row(review):
+    """Return the review store row of a raw review"""
+    try:
+        date = convert_date_format(review.get('reviewDateOfExperience'))
+    except ValueError:
+        date = None
+    return {
+        "reviewId": review_key(review),
+        "date": date,
+        "rating": review.get('reviewRatingScore'),
+        "title": review.get('reviewTitle'),
+        "fingerprint": review_fingerprint(review)
+    }
 
-# Calculate total chunks to set for loop range
-total_chunks = (len(reviews_data) + NUM_REVIEWS_PER_CHUNK - 1) // NUM_REVIEWS_PER_CHUNK
+def write_chunk_files(reviews_data, base_name, output_root=".", sample_keys=None):
+    """Split reviews into chunk files in data-chunks, with any sampled reviews in their own chunks"""
+    chunk_dir = os.path.join(output_root, "data-chunks")
+    if not os.path.exists(chunk_dir):
+        os.makedirs(chunk_dir)
+    
+    # Remove chunks from an earlier attempt so only this run's chunks are processed
+    for f in os.listdir(chunk_dir):
+        if f.endswith('.json'):
+            os.remove(os.path.join(chunk_dir, f))
+    
+    chunk_count = 0
+    groups = sample_first(lambda: reviews_data, base_name, sample_keys)
+    batches = chain.from_iterable(
+        iter_token_batches(reviews, name, CHUNK_TOKEN_BUDGET, MAX_REVIEW_TOKENS, format_review) for name, reviews in groups
+    )
+    for chunk_name, chunk_reviews in batches:
+        with open(os.path.join(chunk_dir, chunk_name), 'w') as f:
+            json.dump(chunk_reviews, f, indent=2)
+        
+        chunk_count += 1
+        print(f"Making batch {chunk_count} ({len(chunk_reviews)} reviews)...")
 
-# Process chunks
-# for i in range(total_chunks):
-for i in range(min(NUM_CHUNKS, total_chunks)):
-    start_idx = i * NUM_REVIEWS_PER_CHUNK
-    end_idx = min((i + 1) * NUM_REVIEWS_PER_CHUNK, len(reviews_data))
-    chunk_reviews = reviews_data[start_idx:end_idx]
+# This function selects the reviews for this run, collapses duplicates and splits them into chunks.
+# It returns the manifest (in incremental mode) and the batches to send to process_chunks.
+# With sample_size, a stratified sample of the reviews is chunked first, as <base_name>_sample_chunk_<n>.
+# Every review in the export is upserted into the review store under company, where incremental mode
+# looks up which of them changed.
+def prepare_review_batches(input_file, base_name, output_root=".", sample_size=None, company=None):
+    """Select, deduplicate and chunk the reviews to analyze"""
+    manifest_file = os.path.join(output_root, MANIFEST_FILE)
+    manifest = None
+    previous_analyses = []
+    review_batches = None
+    
+    if STREAM_INPUT:
+        get_store().save_reviews(company, map(review_row, iter_reviews(input_file)))
+        
+        # In incremental mode, drop reviews that were already processed in a previous run
+        changed_keys = None
+        if INCREMENTAL:
+            manifest = load_manifest(company, manifest_file)
+            changed_keys, previous_analyses = select_changed_keys(manifest, load_latest_analyses(company))
+    
+        def stream_selected_reviews():
+            """Stream the reviews selected for this run from the raw export"""
+            for review in iter_reviews(input_file):
+                if changed_keys is None or review_key(review) in changed_keys:
+                    yield review
+    
+        # Collapse duplicate reviews so each group is analyzed once
+        duplicate_groups = None
+        if DEDUPLICATE:
+            duplicate_groups = find_duplicate_groups(stream_selected_reviews())
+            print(f"Deduplication: {len(duplicate_groups):,} distinct reviews to analyze")
+    
+        def stream_reviews_to_analyze():
+            """Stream the selected reviews, one per duplicate group"""
+            reviews = stream_selected_reviews()
+            return reviews if duplicate_groups is None else iter_representatives(reviews, duplicate_groups)
+    
+        sample_keys = stratified_sample(stream_reviews_to_analyze(), sample_size) if sample_size else None
+    
+        # Stream review batches straight from the raw export into process_chunks
+        review_batches = chain.from_iterable(
+            iter_token_batches(reviews, name, CHUNK_TOKEN_BUDGET, MAX_REVIEW_TOKENS, format_review)
+            for name, reviews in sample_first(stream_reviews_to_analyze, base_name, sample_keys)
+        )
+        print(f"Streaming batches of up to {CHUNK_TOKEN_BUDGET:,} tokens each from {input_file}")
+    else:
+        # Load and validate JSON data
+        reviews_data = load_json_data(input_file)
+        get_store().save_reviews(company, map(review_row, reviews_data))
     
-    chunk_filename = create_chunk_filename(i + 1, base_name)
+        # In incremental mode, drop reviews that were already processed in a previous run
+        if INCREMENTAL:
+            manifest = load_manifest(company, manifest_file)
+            reviews_data, previous_analyses = select_reviews_to_process(reviews_data, manifest, load_latest_analyses(company))
     
-    with open(chunk_filename, 'w') as f:
-        json.dump(chunk_reviews, f, indent=2)
+        # Collapse duplicate reviews so each group is analyzed once
+        if DEDUPLICATE:
+            duplicate_groups = find_duplicate_groups(reviews_data)
+            reviews_data = list(iter_representatives(reviews_data, duplicate_groups))
+            print(f"Deduplication: {len(reviews_data):,} distinct reviews to analyze")
     
-    print(f"Making batch {i + 1} of {NUM_CHUNKS}...")
+        sample_keys = stratified_sample(reviews_data, sample_size) if sample_size else None
+        write_chunk_files(reviews_data, base_name, output_root, sample_keys)
+    
+    # Keep the previous analyses on disk so compile_analyzed_files can merge them, even after a resume
+    os.makedirs(os.path.join(output_root, "analyzed-chunks"), exist_ok=True)
+    with open(os.path.join(output_root, PREVIOUS_ANALYSES_FILE), 'w') as f:
+        json.dump(previous_analyses, f)
+    
+    return manifest, review_batches
 
-# This function runs the process_chunks function and then compiles all analyzed files into one structured JSON file.
-async def main():
-    await process_chunks()
+async def analyze_reviews(input_file, base_name, state, output_root=".", limiter=None, batch_api=False, company=None):
+    """Chunk the raw reviews and analyze each chunk with OpenAI"""
+    manifest, review_batches = prepare_review_batches(input_file, base_name, output_root, company=company)
+    
+    # Process reviews in chunks
+    failed_chunks = await process_chunks(
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE,
+        manifest=manifest,
+        batches=review_batches,
+        state=state,
+        transport=transport,
+        limiter=limiter,
+        output_root=output_root,
+        batch_api=batch_api,
+        stream=STREAM_COMPLETIONS
+    )
+    if failed_chunks:
+        raise RuntimeError(f"{len(failed_chunks)} chunks failed; run again with --resume to retry only those chunks")
+
+# Pipelined mode: a stratified sample of the reviews is analyzed first and the journey steps are derived
+# from it, so reviews can be mapped while the remaining chunks are still being analyzed. This replaces the
+# journey and map stages; compile and plot run afterwards as usual.
+async def analyze_and_map_reviews(input_file, base_name, state, output_root=".", limiter=None, company=None):
+    """Analyze the reviews and map them to journey steps derived from an early sample"""
+    manifest, review_batches = prepare_review_batches(input_file, base_name, output_root, PIPELINE_SAMPLE_SIZE, company)
+    sample_prefix = f"{base_name}_sample_chunk_"
+    if review_batches is None:
+        # Chunk files on disk are read in name order; put the sample chunks first
+        review_batches = sorted(iter_chunk_files(os.path.join(output_root, "data-chunks")),
+                                key=lambda batch: not batch[0].startswith(sample_prefix))
+    sample_batches, review_batches = split_sample_batches(review_batches, sample_prefix)
+    
+    # Analysis, journey steps and mapping share one rate budget
+    limiter = limiter or AdaptiveRateLimiter(
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE
+    )
+    mapper = PipelinedMapper(
+        sample_batches,
+        lambda rows: generate_journey_steps(max_concurrency=MAX_CONCURRENT_REQUESTS, transport=transport, limiter=limiter,
+                                            output_root=output_root, rows=rows, company=company,
+                                            drift_threshold=JOURNEY_DRIFT_THRESHOLD),
+        lambda rows, journey_steps, label: map_rows(rows, journey_steps, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                                                    use_local_classifier=USE_LOCAL_CLASSIFIER, transport=transport,
+                                                    limiter=limiter, output_root=output_root, stream=STREAM_COMPLETIONS,
+                                                    label=label)
+    )
+    
+    # Reviews analyzed in a previous run (incremental mode) are mapped again against the new steps
+    with open(os.path.join(output_root, PREVIOUS_ANALYSES_FILE), 'r') as f:
+        mapper.add_rows(json.load(f))
+    
+    failed_chunks = await process_chunks(
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        manifest=manifest,
+        batches=review_batches,
+        state=state,
+        transport=transport,
+        limiter=limiter,
+        output_root=output_root,
+        stream=STREAM_COMPLETIONS,
+        on_analyzed=mapper,
+        on_record=mapper.add_record
+    )
+    if failed_chunks:
+        mapper.cancel()
+        raise RuntimeError(f"{len(failed_chunks)} chunks failed; run again with --resume to retry only those chunks")
+    
+    journey_data, mapped_reviews, failed_batches, batch_count = await mapper.finish()
+    if batch_count and failed_batches == batch_count and not mapped_reviews:
+        raise ValueError("All mapping batches failed validation")
+    if failed_batches:
+        print(f"Mapping failed for {failed_batches} batches; their reviews are left out")
+    print(f"\nMapped reviews saved to: {save_mapped_reviews(mapped_reviews, output_root, company)}")
+
+# Sampling mode: each round analyzes the reviews added to the stratified sample and maps them to journey
+# steps derived from the first round, then checks the confidence intervals of the step averages in the
+# review store. Samples are drawn by review hash, so a resumed run draws the same rounds and skips the
+# chunks it already analyzed. Like pipelined mode this replaces the journey and map stages, and every
+# sampled review is analyzed (incremental mode does not apply).
+async def sample_and_map_reviews(input_file, base_name, state, output_root=".", limiter=None, company=None):
+    """Analyze and map growing samples of the reviews until the step averages are precise enough"""
+    get_store().save_reviews(company, map(review_row, iter_reviews(input_file)))
+    
+    # Collapse duplicate reviews so each group is analyzed once
+    duplicate_groups = find_duplicate_groups(iter_reviews(input_file)) if DEDUPLICATE else None
+    
+    def stream_reviews_to_analyze():
+        """Stream the reviews, one per duplicate group"""
+        reviews = iter_reviews(input_file)
+        return reviews if duplicate_groups is None else iter_representatives(reviews, duplicate_groups)
+    
+    total = sum(1 for _ in stream_reviews_to_analyze())
+    limit = min(total, SAMPLE_MAX_SIZE or total)
+    
+    # Analysis, journey steps and mapping share one rate budget
+    limiter = limiter or AdaptiveRateLimiter(
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE
+    )
+    sampled = set()
+    journey_steps = None
+    mapped_reviews = []
+    sample_size = SAMPLE_START_SIZE
+    round_number = 0
+    
+    while True:
+        round_number += 1
+        keys = stratified_sample(stream_reviews_to_analyze(), min(sample_size, limit)) - sampled
+        sampled |= keys
+        
+        rows = []
+        failed_chunks = await process_chunks(
+            max_concurrency=MAX_CONCURRENT_REQUESTS,
+            batches=iter_token_batches((review for review in stream_reviews_to_analyze() if review_key(review) in keys),
+                                       f"{base_name}_round_{round_number}", CHUNK_TOKEN_BUDGET, MAX_REVIEW_TOKENS,
+                                       format_review),
+            state=state,
+            transport=transport,
+            limiter=limiter,
+            output_root=output_root,
+            stream=STREAM_COMPLETIONS,
+            on_analyzed=lambda chunk_file, analysis: rows.extend(analysis_rows(chunk_file, analysis))
+        )
+        if failed_chunks:
+            raise RuntimeError(f"{len(failed_chunks)} chunks failed; run again with --resume to retry only those chunks")
+        
+        if journey_steps is None:
+            journey_data = await generate_journey_steps(max_concurrency=MAX_CONCURRENT_REQUESTS, transport=transport,
+                                                        limiter=limiter, output_root=output_root, rows=rows,
+                                                        company=company, drift_threshold=JOURNEY_DRIFT_THRESHOLD)
+            journey_steps = journey_data['journey_steps']
+        
+        round_mapped, failed_batches, _ = await map_rows(
+            rows, journey_steps, max_concurrency=MAX_CONCURRENT_REQUESTS, use_local_classifier=USE_LOCAL_CLASSIFIER,
+            transport=transport, limiter=limiter, output_root=output_root, stream=STREAM_COMPLETIONS,
+            label=f"round {round_number} mapping batch"
+        )
+        if failed_batches:
+            print(f"Mapping failed for {len(failed_batches)} batches; their reviews are left out")
+        mapped_reviews += round_mapped
+        get_store().save_mappings(company, mapped_reviews)
+        
+        wide_steps = unconverged_steps(get_store().step_ratings(company), SAMPLE_TARGET_CI_WIDTH, SAMPLE_MIN_STEP_SHARE)
+        print(f"Sampling round {round_number}: {len(sampled):,} of {total:,} reviews analyzed; "
+              + (f"{len(wide_steps)} step intervals wider than {SAMPLE_TARGET_CI_WIDTH}: "
+                 + ", ".join(f"{step} ({width:.2f})" for step, width in wide_steps.items())
+                 if wide_steps else f"every step interval is within {SAMPLE_TARGET_CI_WIDTH}"))
+        if not wide_steps or len(sampled) >= limit:
+            break
+        sample_size = int(sample_size * SAMPLE_GROWTH_FACTOR)
+    
+    print(f"\nMapped reviews saved to: {save_mapped_reviews(mapped_reviews, output_root, company)}")
 
-# This function compiles all analyzed files into one structured JSON file using the process_chunks function.
-def compile_analyzed_files():
-    """Compile all analyzed files into one structured JSON file"""
-    analyzed_dir = "analyzed-chunks"
-    output_dir = "summarized-reviews"
+# This function compiles all analyzed files into the company's latest analyses in the review store (and a
+# summary record file), one row per analyzed review. Previous rows (from incremental mode) are merged
+# ahead of the new ones.
+def compile_analyzed_files(output_root=".", company=None):
+    """Compile all analyzed files into one summary record file"""
+    analyzed_dir = os.path.join(output_root, "analyzed-chunks")
+    output_dir = os.path.join(output_root, "summarized-reviews")
+    previous_analyses_file = os.path.join(output_root, PREVIOUS_ANALYSES_FILE)
     
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
+    previous_analyses = []
+    if os.path.exists(previous_analyses_file):
+        with open(previous_analyses_file, 'r') as f:
+            previous_analyses = json.load(f)
+    
     # Get all analyzed files
     analyzed_files = sorted([f for f in os.listdir(analyzed_dir) if f.startswith('analyzed_')])
     
     # Combine analyses
-    combined_data = {
-        # "metadata": {
-        #     "total_files": len(analyzed_files),
-        #     "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        # },
-        "analyses": []
-    }
+    rows = list(previous_analyses or [])
     
     # Process each file
     for file in analyzed_files:
         try:
             with open(os.path.join(analyzed_dir, file), 'r') as f:
-                analysis = json.load(f)
-                combined_data["analyses"].append({
-                    "analysis": analysis["response"]
-                })
+                rows.extend(analysis_rows(file, json.load(f)))
         except Exception as e:
             print(f"Error processing {file}: {str(e)}")
     
-    # Save combined file
-    output_file = os.path.join(output_dir, f"summarized_reviews_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
-    with open(output_file, 'w') as f:
-        json.dump(combined_data, f, indent=2)
+    # Save combined rows
+    get_store().save_analyses(company, rows)
+    output_file = write_records(
+        os.path.join(output_dir, f"summarized_reviews_{datetime.now().strftime('%Y%m%d_%H%M%S')}"),
+        rows, SUMMARY_COLUMNS
+    )
+    print(f"Compiled {len(rows):,} analysis rows into: {output_file}")
 
 
+def analyzed_files_fingerprint(output_root="."):
+    """Fingerprint the analyzed chunk files"""
+    analyzed_dir = os.path.join(output_root, "analyzed-chunks")
+    if not os.path.exists(analyzed_dir):
+        return None
+    files = sorted(os.listdir(analyzed_dir))
+    return fingerprint([file_fingerprint(os.path.join(analyzed_dir, f)) for f in files])
+
+def plot_charts(output_root=".", show=False, company=None):
+    """Plot the average rating and the weekly trend of each journey step"""
+    plot_average_ratings(output_root, show=show, company=company, image_format=IMAGE_FORMAT)
+    plot_rating_trends(output_root, show=show, company=company, image_format=IMAGE_FORMAT)
+
+# Dashboard mode (--render-dashboards) runs no stages: it redraws the charts of every company in the review
+# store from its rollups, headless, into dashboards/<company>/visualizations
+def render_all_dashboards():
+    """Render the charts of every company in the review store"""
+    errors = render_dashboards(output_root=DASHBOARD_DIR, image_format=IMAGE_FORMAT)
+    failed = sorted(company for company, error in errors.items() if error)
+    print(f"\nRendered dashboards for {len(errors) - len(failed)} of {len(errors)} companies into {DASHBOARD_DIR}")
+    if failed:
+        raise RuntimeError(f"{len(failed)} dashboards failed: {failed}")
+
+# Each stage is (name, run, input fingerprint); --resume skips stages that completed with the same
+# fingerprint. In pipelined and sampling modes the analyze stage also derives the journey steps and maps
+# the reviews, so there are no journey and map stages.
+def build_stages(input_file, base_name, state, output_root=".", limiter=None, show_plot=False, batch_api=False,
+                 pipelined=False, company=None, sampling=False):
+    """Return the pipeline stages in the order they run"""
+    company = company or company_namespace(input_file, base_name)
+    latest_summary = lambda: fingerprint(get_store().latest_run("analyses", company))
+    latest_journey = lambda: fingerprint(get_store().latest_run("journey_steps", company))
+    latest_mapping = lambda: fingerprint(get_store().latest_run("mappings", company))
+    
+    if sampling:
+        return [
+            ("analyze",
+             lambda: sample_and_map_reviews(input_file, base_name, state, output_root, limiter, company),
+             lambda: fingerprint(file_fingerprint(input_file), CHUNK_TOKEN_BUDGET, MAX_REVIEW_TOKENS, DEDUPLICATE,
+                                 USE_LOCAL_CLASSIFIER, JOURNEY_DRIFT_THRESHOLD, SAMPLE_START_SIZE, SAMPLE_GROWTH_FACTOR,
+                                 SAMPLE_TARGET_CI_WIDTH, SAMPLE_MIN_STEP_SHARE, SAMPLE_MAX_SIZE)),
+            ("compile",
+             lambda: compile_analyzed_files(output_root, company),
+             lambda: analyzed_files_fingerprint(output_root)),
+            ("plot",
+             lambda: plot_charts(output_root, show=show_plot, company=company),
+             lambda: fingerprint(latest_mapping(), latest_journey(), IMAGE_FORMAT))
+        ]
+    
+    if pipelined:
+        return [
+            ("analyze",
+             lambda: analyze_and_map_reviews(input_file, base_name, state, output_root, limiter, company),
+             lambda: fingerprint(file_fingerprint(input_file), CHUNK_TOKEN_BUDGET, MAX_REVIEW_TOKENS,
+                                 STREAM_INPUT, INCREMENTAL, DEDUPLICATE, USE_LOCAL_CLASSIFIER, PIPELINE_SAMPLE_SIZE,
+                                 JOURNEY_DRIFT_THRESHOLD)),
+            ("compile",
+             lambda: compile_analyzed_files(output_root, company),
+             lambda: analyzed_files_fingerprint(output_root)),
+            ("plot",
+             lambda: plot_charts(output_root, show=show_plot, company=company),
+             lambda: fingerprint(latest_mapping(), latest_journey(), IMAGE_FORMAT))
+        ]
+    
+    return [
+        ("analyze",
+         lambda: analyze_reviews(input_file, base_name, state, output_root, limiter, batch_api, company),
+         lambda: fingerprint(file_fingerprint(input_file), CHUNK_TOKEN_BUDGET, MAX_REVIEW_TOKENS,
+                             STREAM_INPUT, INCREMENTAL, DEDUPLICATE)),
+        ("compile",
+         lambda: compile_analyzed_files(output_root, company),
+         lambda: analyzed_files_fingerprint(output_root)),
+        ("journey",
+         lambda: generate_journey_steps(max_concurrency=MAX_CONCURRENT_REQUESTS, transport=transport, limiter=limiter,
+                                        output_root=output_root, company=company, drift_threshold=JOURNEY_DRIFT_THRESHOLD),
+         lambda: fingerprint(latest_summary(), JOURNEY_DRIFT_THRESHOLD)),
+        ("map",
+         lambda: map_reviews_to_journey(max_concurrency=MAX_CONCURRENT_REQUESTS, use_local_classifier=USE_LOCAL_CLASSIFIER,
+                                        transport=transport, limiter=limiter, output_root=output_root,
+                                        batch_api=batch_api, stream=STREAM_COMPLETIONS, company=company),
+         lambda: fingerprint(latest_summary(), latest_journey(), USE_LOCAL_CLASSIFIER)),
+        ("plot",
+         lambda: plot_charts(output_root, show=show_plot, company=company),
+         lambda: fingerprint(latest_mapping(), latest_journey(), IMAGE_FORMAT))
+    ]
+
+# This function runs every stage for one export. With --resume or --stage the previous progress in
+# output_root is kept; otherwise the working directories are recreated. company keys the run's rows in
+# the review store (by default the export's company namespace).
+async def run_pipeline(input_file, base_name, args, output_root=".", limiter=None, show_plot=False, company=None):
+    """Run the pipeline stages for one raw export"""
+    state = PipelineState(os.path.join(output_root, STATE_FILE))
+    
+    if args.resume or args.stage:
+        failed_chunks = state.failed_chunks()
+        if failed_chunks:
+            print(f"Retrying {len(failed_chunks)} failed chunks in {output_root}")
+    else:
+        # Start from scratch: forget previous progress and delete and recreate the working directories
+        state.reset()
+        initialize_directories(incremental=INCREMENTAL, output_root=output_root)
+    
+    stages = build_stages(input_file, base_name, state, output_root, limiter, show_plot, args.batch_api, args.pipelined,
+                          company, args.sample)
+    await run_stages(stages, state, resume=args.resume, only=args.stage)
+
+# Batch mode runs every export in raw_trustpilot_data, MAX_PARALLEL_COMPANIES at a time, with outputs
+# under companies/<company>. One limiter holds the API budget for all of them.
+async def run_all_companies(args):
+    """Run the pipeline for every company export in parallel"""
+    runs = plan_company_runs(get_input_files())
+    limiter = AdaptiveRateLimiter(
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE
+    )
+    
+    async def run_company(input_file, base_name, output_root):
+        set_company(os.path.basename(output_root))
+        await run_pipeline(input_file, base_name, args, output_root, limiter, show_plot=False,
+                           company=os.path.basename(output_root))
+    
+    errors = await run_companies(runs, run_company, MAX_PARALLEL_COMPANIES)
+    
+    failed = sorted(output_root for output_root, error in errors.items() if error)
+    print(f"\nProcessed {len(errors) - len(failed)} of {len(errors)} companies")
+    if failed:
+        raise RuntimeError(f"{len(failed)} companies failed: {failed}; run again with --resume to retry them")
+
+def write_telemetry():
+    """Save the run's LLM telemetry and print per-stage totals"""
+    telemetry = get_telemetry()
+    summary = telemetry.summary()
+    for name, stage in summary["stages"].items():
+        print(f"LLM {name}: {stage['requests']} requests, {stage['retries']} retries, "
+              f"{stage['escalations']} escalations, {stage['hedges']} hedges, "
+              f"{stage['prompt_tokens']:,} prompt + {stage['completion_tokens']:,} completion tokens, "
+              f"p95 {stage['latency_seconds']['p95']}s, ~${stage['cost_usd']}")
+    for name, cascade in summary["cascade"].items():
+        print(f"Model cascade {name}: {cascade['escalated']:,} of {cascade['items']:,} items escalated "
+              f"({cascade['escalation_rate']:.1%}), answered by {cascade['answered_by']}")
+    if transport.hedged_count:
+        print(f"Hedged {transport.hedged_count} slow requests; the duplicate answered first {transport.hedge_wins} times")
+    print(f"LLM telemetry saved to: {telemetry.write_summary()}")
+    if PROMETHEUS_TEXTFILE:
+        telemetry.write_prometheus(PROMETHEUS_TEXTFILE)
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Analyze Trustpilot reviews and map them to customer journey steps")
+    parser.add_argument("--resume", action="store_true",
+                        help="keep previous outputs and resume from the first incomplete stage or chunk")
+    parser.add_argument("--stage", choices=STAGE_NAMES,
+                        help="run only this stage, using the outputs of earlier stages")
+    parser.add_argument("--all-companies", action="store_true",
+                        help="process every export in raw_trustpilot_data, with outputs under companies/")
+    parser.add_argument("--batch-api", action="store_true",
+                        help="send analyze and map requests through the OpenAI Batch API (slower, cheaper; for unattended runs)")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="derive journey steps from an early sample and map reviews while the rest are analyzed")
+    parser.add_argument("--sample", action="store_true",
+                        help="analyze growing stratified samples until every step's average rating is precise enough")
+    parser.add_argument("--show", action="store_true",
+                        help="open the charts in a browser when they are plotted (single-company runs)")
+    parser.add_argument("--render-dashboards", action="store_true",
+                        help="run no stages; redraw the charts of every company in the review store under dashboards/")
+    args = parser.parse_args()
+    if args.pipelined and args.batch_api:
+        parser.error("--pipelined and --batch-api cannot be combined")
+    if args.pipelined and args.stage and args.stage not in PIPELINED_STAGE_NAMES:
+        parser.error(f"--stage {args.stage} is part of the analyze stage with --pipelined; use --stage analyze")
+    if args.sample and args.stage and args.stage not in PIPELINED_STAGE_NAMES:
+        parser.error(f"--stage {args.stage} is part of the analyze stage with --sample; use --stage analyze")
+    if args.sample and (args.pipelined or args.batch_api):
+        parser.error("--sample cannot be combined with --pipelined or --batch-api")
+    return args
+
 async def main():
+    args = parse_args()
+    if args.render_dashboards:
+        try:
+            render_all_dashboards()
+        finally:
+            await transport.close()
+        return
+    
     try:
-        # Process reviews in chunks
-        await process_chunks()
-        
-        # Compile all analyzed files
-        compile_analyzed_files()
-        
-        # Generate customer journey steps
-        await generate_journey_steps()
-        print("\nCustomer journey analysis complete")
-        
-        # Map reviews to journey
-        await map_reviews_to_journey()
-        print("\nReview journey mapping complete")
+        if args.all_companies:
+            await run_all_companies(args)
+        else:
+            # Find the raw source data file
+            input_file, base_name = get_input_file()
+            await run_pipeline(input_file, base_name, args, show_plot=args.show)
+        print("\nPipeline complete")
         
-        # Generate and save plot
-        plot_average_ratings()
-        print("\nPlotting complete")
+        # Report cache usage and trim the cache to its size and age limits
+        llm_cache.evict()
+        print(f"\nLLM cache: {llm_cache.stats()}")
         
     except Exception as e:
         print(f"\nError in main execution: {str(e)}")
         raise
+    finally:
+        write_telemetry()
+        await transport.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())